@@ -0,0 +1,119 @@
+import os
+import shutil
+from six import string_types
+from sklearn.externals.joblib import hash as joblib_hash, dump, load
+
+class FoldCache(object):
+    '''
+    An on-disk cache for the results of cross-validation fold fits.  Entries are keyed on a hash
+    of the estimator's class and parameters, a fingerprint of the data, and the fold indices, so
+    rerunning a fit after an interruption or after changing some other part of a model reuses
+    every fold that was already done.
+
+    directory : str
+        The directory in which to store cached results.  It is created if necessary.
+
+    max_bytes : int, optional (default=None)
+        If not None, the least recently used entries are evicted whenever the total size of the
+        cache exceeds max_bytes.
+    '''
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def fingerprint(self, data):
+        return joblib_hash(data)
+
+    def key(self, estimator, fingerprint, train=None, test=None):
+        return joblib_hash((type(estimator), estimator.get_params(), fingerprint, train, test))
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pkl')
+
+    def get(self, key):
+        '''
+        Return the value stored under key, or None if there isn't one.
+        '''
+        path = self._path(key)
+        try:
+            result = load(path)
+        except (IOError, OSError, EOFError):
+            return None
+
+        # Mark the entry as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return result
+
+    def set(self, key, value):
+        try:
+            os.makedirs(self.directory)
+        except OSError:
+            if not os.path.isdir(self.directory):
+                raise
+
+        # Write to a temporary file and move it into place so that readers never see a
+        # partially written entry.
+        path = self._path(key)
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        dump(value, temp_path)
+        try:
+            os.rename(temp_path, path)
+        except OSError:
+            os.remove(path)
+            os.rename(temp_path, path)
+        self.evict()
+
+    def evict(self):
+        '''
+        Remove least recently used entries until the cache is no larger than max_bytes.
+        '''
+        if self.max_bytes is None:
+            return
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.pkl'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(entry[1] for entry in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+def check_cache(cache):
+    '''
+    Convert the cache argument of an estimator into a FoldCache (or None).  A string is taken
+    to be a cache directory.
+    '''
+    if isinstance(cache, string_types):
+        return FoldCache(cache)
+    return cache
+
+def cached_call(cache, key, fn, *args):
+    '''
+    Return fn(*args), using the cached value stored under key if there is one and storing the
+    result if there isn't.  With cache=None this is just fn(*args).
+    '''
+    if cache is not None:
+        result = cache.get(key)
+        if result is not None:
+            return result
+    result = fn(*args)
+    if cache is not None:
+        cache.set(key, result)
+    return result
@@ -21,6 +21,7 @@ from sympy.core.numbers import RealNumber
 from sympy.functions.elementary.miscellaneous import Max
 from .sklearntools import shrinkd
 from sklearn.isotonic import IsotonicRegression
+from time import time
 # from .sym.input_size import input_size
 
 # def _fit_and_predict(estimator, X, y, train, test, sample_weight=None, exposure=None):
@@ -380,13 +381,19 @@ class CalibratedEstimatorCV(STSimpleEstimator, MetaEstimatorMixin):
             fit_args['exposure'] = exposure
         
         # Do the cross validation fits
-        cv_fits = parallel(delayed(_fit_and_predict)(clone(self.estimator), fit_args, train, test) for train, test in cv)
+        cv_fits = parallel(delayed(_fit_and_predict)(clone(self.estimator), fit_args, train, test, 
+                                                     dispatch_time=time()) for train, test in cv)
         
         # Combine predictions from cv fits
         prediction = np.empty_like(y)
         for fit in cv_fits:
             safe_assign_subset(prediction, fit[2], fit[1])
         
+        # Store timing and memory information for each fold
+        self.fold_info_ = [fit[3] for fit in cv_fits]
+        self.fit_times_ = [info['fit_time'] for info in self.fold_info_]
+        self.predict_times_ = [info['predict_time'] for info in self.fold_info_]
+        
 #         fit_predict_results = parallel(delayed(_fit_and_predict)(estimator=clone(self.estimator),
 #                                        train=train, test=test, **fit_args) for train, test in cv)
 #         
@@ -9,6 +9,7 @@ from sklearn.externals.joblib.parallel import Parallel, delayed
 from sklearn.feature_selection.base import SelectorMixin
 from sklearn.utils.metaestimators import if_delegate_has_method
 from sklearn.utils import safe_mask
+from time import time
 
 def weighted_average_score_combine(scores):
     scores_arr = np.array([tup[:2] for tup in scores])
@@ -53,9 +54,13 @@ class BaseFeatureImportanceEstimatorCV(BaseDelegatingEstimator):
         col_X = self._baseline_feature_subset(X, n_features)
         data['X'] = col_X
         full_scores = parallel(delayed(_fit_and_score)(clone(self.estimator), data_, scorer,
-                                      train, test)
+                                      train, test, time())
                               for train, test in cv)
         self.score_ = combiner(full_scores)
+        self.fold_info_ = [score[3] for score in full_scores]
+        self.fit_times_ = [info['fit_time'] for info in self.fold_info_]
+        self.score_times_ = [info['score_time'] for info in self.fold_info_]
+        self.feature_fold_info_ = []
         
         # For each feature, remove that feature and get the cross-validation scores
         for col in range(n_features):
@@ -63,8 +68,9 @@ class BaseFeatureImportanceEstimatorCV(BaseDelegatingEstimator):
             data_ = data.copy()
             data_['X'] = col_X
             scores = parallel(delayed(_fit_and_score)(clone(self.estimator), data_, scorer,
-                                          train, test)
+                                          train, test, time())
                                   for train, test in cv)
+            self.feature_fold_info_.append([score[3] for score in scores])
 #             test_features = np.ones(shape=n_features, dtype=bool)
 #             if col_X is not None:
 #                 data_ = data.copy()
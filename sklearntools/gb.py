@@ -1,12 +1,19 @@
 from .sklearntools import fit_predict, shrinkd, LinearCombination, BaseDelegatingEstimator, \
-    STSimpleEstimator, AlreadyFittedEstimator, growd
+    STSimpleEstimator, AlreadyFittedEstimator, growd, safer_call, _subset_data,\
+    ColumnSubsetTransformer
+from sklearn.utils import check_random_state
+from sklearn.externals.joblib import hash as joblib_hash
+from .cache import FoldCache
+from .histogram import bin_edges, apply_bins
+from .linear_cv import _design
 from sklearn.base import clone
 from toolz.dicttoolz import valmap, dissoc
 from .line_search import golden_section_search, zoom_search, zoom
 import numpy as np
 from sklearn.ensemble.gradient_boosting import RegressionLossFunction,\
     QuantileEstimator, QuantileLossFunction, ExponentialLoss,\
-    ScaledLogOddsEstimator
+    ScaledLogOddsEstimator, LeastSquaresError, BinomialDeviance
+from scipy.special import expit
 from operator import __sub__, __lt__
 from toolz.itertoolz import sliding_window
 from itertools import starmap
@@ -17,6 +24,7 @@ from .sym.sym_score_to_decision import sym_score_to_decision
 from .sym.syms import syms
 from .sym.sym_score_to_proba import sym_score_to_proba
 from distutils.version import LooseVersion
+from .sklearntools import getargspec
 import sklearn
 from types import MethodType
 from sklearn.linear_model.base import LinearRegression
@@ -59,51 +67,45 @@ if LooseVersion(sklearn.__version__) <= LooseVersion('0.19.1'):
         ExponentialLoss.negative_gradient = negative_gradient
 
 
-def log_one_plus_exp_x(x):
-    lower = -10.
-    upper = 35.
-    result = np.zeros_like(x)
-    low_idx = x < lower
-    result[low_idx] = np.exp(x[low_idx])
-    high_idx = x > upper
-    result[high_idx] = x[high_idx]
-    middle_idx = ~(low_idx | high_idx)
-    result[middle_idx] = np.log(1+np.exp(x[middle_idx]))
-    return result
+def log_one_plus_exp_x(x, out=None):
+    return np.logaddexp(0., x, out=out)
 
-def one_over_one_plus_exp_x(x):
-    lower = -100.
-    upper = 100.
-    result = np.zeros_like(x)
-    low_idx = x < lower
-    result[low_idx] = 1.
-    high_idx = x > upper
-    result[high_idx] = 0.
-    middle_idx = ~(low_idx | high_idx)
-    result[middle_idx] = 1. / (1. + np.exp(x[middle_idx]))
-    return result
+def one_over_one_plus_exp_x(x, out=None):
+    out = np.negative(np.asarray(x, dtype=float), out=out)
+    return expit(out, out=out)
 
 class STExponentialLossFunction(object):
     def init_estimator(self):
         return ScaledLogOddsEstimator()
     
-    def __call__(self, y, pred, sample_weight=None):
-        print(y)
-        print(pred)
-        pred = pred.ravel()
+    def __call__(self, y, pred, sample_weight=None, out=None):
+        out = np.multiply(y, np.ravel(pred), out=out)
+        np.negative(out, out=out)
+        np.exp(out, out=out)
         if sample_weight is None:
-            return np.exp(- y * pred)
+            return np.sum(out)
         else:
-            return np.sum(sample_weight * np.exp(- y * pred))
+            return np.dot(sample_weight, out)
     
-    def negative_gradient(self, y, pred, sample_weight=None, **kargs):
-        result = - y * np.exp(- y * pred.ravel())
+    def negative_gradient(self, y, pred, sample_weight=None, out=None, **kargs):
+        out = np.multiply(y, np.ravel(pred), out=out)
+        np.negative(out, out=out)
+        np.exp(out, out=out)
+        out *= y
+        np.negative(out, out=out)
         if sample_weight is not None:
-            return sample_weight * result
-        return result
+            out *= sample_weight
+        return out
 #         y_ = -(2. * y - 1.)
 #         return y_ * np.exp(y_ * pred.ravel()) 
     
+    def step_derivatives(self, y, pred, direction, step, sample_weight=None):
+        y = shrinkd(1, y)
+        exp_part = np.exp(- y * (shrinkd(1, pred) + step * direction))
+        weights = 1. if sample_weight is None else sample_weight
+        return (np.sum(weights * (- y * direction) * exp_part), 
+                np.sum(weights * (y * direction) ** 2 * exp_part))
+    
 class SmoothQuantileLossFunction(RegressionLossFunction):
     def __init__(self, n_classes, tau, alpha):
         super(SmoothQuantileLossFunction, self).__init__(n_classes)
@@ -113,25 +115,179 @@ class SmoothQuantileLossFunction(RegressionLossFunction):
     def init_estimator(self):
         return QuantileEstimator(self.tau)
     
-    def __call__(self, y, pred, sample_weight=None):
-        x = y - pred
-#         n = float(y.shape[0])
-        if sample_weight is not None:
-            return np.dot(sample_weight, (self.tau * x + self.alpha * log_one_plus_exp_x(-(1./self.alpha)*x)))
-        else:
-            return np.sum(self.tau * x + self.alpha * log_one_plus_exp_x(-(1./self.alpha)*x))
+    def __call__(self, y, pred, sample_weight=None, out=None):
+        out = np.subtract(y, pred, out=out)
+        linear_part = np.sum(out) if sample_weight is None else np.dot(sample_weight, out)
+        out *= -1. / self.alpha
+        log_one_plus_exp_x(out, out=out)
+        smooth_part = np.sum(out) if sample_weight is None else np.dot(sample_weight, out)
+        return self.tau * linear_part + self.alpha * smooth_part
     
-    def negative_gradient(self, y, pred, sample_weight=None):
-        x =  y - pred
-#         n = float(y.shape[0])
+    def negative_gradient(self, y, pred, sample_weight=None, out=None):
+        out = np.subtract(y, pred, out=out)
+        out *= 1. / self.alpha
+        one_over_one_plus_exp_x(out, out=out)
+        np.subtract(self.tau, out, out=out)
         if sample_weight is not None:
-            return  sample_weight * (self.tau - one_over_one_plus_exp_x((1. / self.alpha) * x))
-        else:
-            return (self.tau - one_over_one_plus_exp_x((1. / self.alpha) * x))
+            out *= sample_weight
+        return out
+    
+    def step_derivatives(self, y, pred, direction, step, sample_weight=None):
+        prob = expit((y - (pred + step * direction)) / self.alpha)
+        weights = 1. if sample_weight is None else sample_weight
+        return (np.sum(weights * direction * (1. - self.tau - prob)), 
+                np.sum(weights * direction ** 2 * prob * (1. - prob)) / self.alpha)
         
     def _update_terminal_region(self, *args, **kwargs):
         raise NotImplementedError()
 
+step_derivatives_dispatcher = {}
+
+def register_step_derivatives(cls, function, quadratic=False):
+    '''
+    Register function(loss_function, y, pred, direction, step, sample_weight=None) as the 
+    way to get the first and second derivatives, with respect to step, of the total loss at 
+    pred + step * direction for instances of cls.  Derivatives may be scaled by any positive 
+    constant.  If quadratic is True the loss is quadratic in step, so a single Newton step is 
+    exact.
+    '''
+    step_derivatives_dispatcher[cls] = (function, quadratic)
+    return function
+
+def step_derivatives(loss_function):
+    '''
+    Return (function, quadratic) for computing line search derivatives of loss_function, 
+    called as function(loss_function, **kwargs) with unneeded kwargs discarded.  It comes 
+    either from the step_derivatives method (in which case quadratic is its quadratic 
+    attribute, if any) or from a function registered with register_step_derivatives.  Return 
+    (None, False) if neither is available.
+    '''
+    if hasattr(loss_function, 'step_derivatives'):
+        return (lambda loss, **kwargs: safer_call(loss.step_derivatives, **kwargs), 
+                getattr(loss_function, 'quadratic', False))
+    for klass in type(loss_function).mro():
+        if klass in step_derivatives_dispatcher:
+            function, quadratic = step_derivatives_dispatcher[klass]
+            return (lambda loss, **kwargs: safer_call(function, loss, **kwargs)), quadratic
+    return None, False
+
+def newton_step(derivatives, quadratic=False, max_iter=10, tolerance=1e-10):
+    '''
+    Minimize a one dimensional function, starting from 0, by Newton's method.  derivatives(step) 
+    should return the first and second derivatives at step.  Returns the step and the number 
+    of times derivatives was called.  The step is None if the second derivative is not 
+    positive somewhere along the way.
+    '''
+    step = 0.
+    n_evaluations = 0
+    for _ in range(max_iter):
+        first, second = derivatives(step)
+        n_evaluations += 1
+        if not (second > 0 and np.isfinite(first)):
+            return None, n_evaluations
+        delta = first / second
+        step -= delta
+        if quadratic or abs(delta) <= tolerance * (1. + abs(step)):
+            break
+    return step, n_evaluations
+
+def find_step(loss, line_search, loss_function, partial_arguments, prediction, direction, current_loss):
+    '''
+    Return the step size along direction from prediction, and the number of passes over the 
+    data used to find it.  loss is the loss object, loss_function(pred) its total over the 
+    data, partial_arguments the arguments other than pred to pass to it, and current_loss 
+    the value of loss_function(prediction).  line_search is 'auto' or 'golden' (see 
+    GradientBoostingEstimator).
+    '''
+    n_evaluations = [0]
+    def counted_loss_function(pred):
+        n_evaluations[0] += 1
+        return loss_function(pred)
+    
+    if line_search not in ('auto', 'golden'):
+        raise ValueError('line_search must be auto or golden.  Got %s.' % str(line_search))
+    derivatives_function, quadratic = step_derivatives(loss)
+    if line_search == 'auto' and derivatives_function is not None:
+        args = valmap(shrinkd(1), partial_arguments)
+        pred = shrinkd(1, prediction)
+        direction_ = shrinkd(1, direction)
+        derivatives = lambda step: derivatives_function(loss, pred=pred, direction=direction_, 
+                                                        step=step, **args)
+        step, n_newton = newton_step(derivatives, quadratic=quadratic)
+        n_evaluations[0] += n_newton
+        if step is not None and np.isfinite(step):
+            # The minimum of a quadratic is exact.  Otherwise make sure Newton's method 
+            # actually went downhill.
+            if quadratic or counted_loss_function(prediction + step * direction) <= current_loss:
+                return step, n_evaluations[0]
+    step = zoom_search(golden_section_search(1e-16), zoom(1., 20, 2.), counted_loss_function, 
+                       prediction, direction)
+    return step, n_evaluations[0]
+
+def least_squares_step_derivatives(loss_function, y, pred, direction, step, sample_weight=None):
+    weights = 1. if sample_weight is None else sample_weight
+    return (np.sum(weights * direction * (pred + step * direction - y)), 
+            np.sum(weights * direction ** 2))
+
+register_step_derivatives(LeastSquaresError, least_squares_step_derivatives, quadratic=True)
+
+def binomial_deviance_step_derivatives(loss_function, y, pred, direction, step, sample_weight=None):
+    prob = expit(pred + step * direction)
+    weights = 1. if sample_weight is None else sample_weight
+    return (np.sum(weights * direction * (prob - y)), 
+            np.sum(weights * direction ** 2 * prob * (1. - prob)))
+
+register_step_derivatives(BinomialDeviance, binomial_deviance_step_derivatives)
+
+def exponential_loss_step_derivatives(loss_function, y, pred, direction, step, sample_weight=None):
+    y_ = 2. * y - 1.
+    exp_part = np.exp(- y_ * (pred + step * direction))
+    weights = 1. if sample_weight is None else sample_weight
+    return (np.sum(weights * (- y_ * direction) * exp_part), 
+            np.sum(weights * direction ** 2 * exp_part))
+
+register_step_derivatives(ExponentialLoss, exponential_loss_step_derivatives)
+
+def _accepts_out(function):
+    try:
+        spec = getargspec(function)
+    except TypeError:
+        return False
+    return 'out' in spec.args
+
+class BoostingWorkspace(object):
+    '''
+    Buffers for the per-row arrays of a boosting loop, allocated once and reused every round.  
+    Losses whose __call__ and negative_gradient take an out argument (such as 
+    SmoothQuantileLossFunction and STExponentialLossFunction) compute into these buffers 
+    instead of allocating new arrays.  Other losses are called as usual.  The gradient buffer 
+    is overwritten every round, so it is copied before being used as a base estimator's target.
+    '''
+    def __init__(self, loss_function, n_rows):
+        self.loss_function = loss_function
+        self.scratch = np.empty(n_rows)
+        self.gradient = np.empty(n_rows)
+        self.loss_out = _accepts_out(loss_function.__call__)
+        self.gradient_out = _accepts_out(loss_function.negative_gradient)
+    
+    def loss(self, pred, args):
+        if self.loss_out:
+            return self.loss_function(pred=pred, out=self.scratch, **args)
+        return self.loss_function(pred=pred, **args)
+    
+    def negative_gradient(self, pred, args):
+        if self.gradient_out:
+            return self.loss_function.negative_gradient(pred=pred, out=self.gradient, **args)
+        return shrinkd(1, self.loss_function.negative_gradient(pred=pred, **args))
+    
+    def step(self, prediction, alpha, direction):
+        '''
+        prediction += alpha * direction, in place.
+        '''
+        np.multiply(direction, alpha, out=self.scratch)
+        prediction += self.scratch
+        return prediction
+
 def never_stop_early(**kwargs):
     return False
 
@@ -141,7 +297,10 @@ class NIterationsWithoutImprovementOverThreshold(object):
         self.n = n
         self.threshold = threshold
     
-    def __call__(self, losses, **kwargs):
+    def __call__(self, losses, validation_losses=None, **kwargs):
+        # Stop on held out losses when there are any
+        if validation_losses is not None:
+            losses = validation_losses
         if len(losses) <= self.n:
             return False
         return all(map(curry(__lt__)(-self.threshold), starmap(self.stat, sliding_window(2, losses[-(self.n+1):]))))
@@ -182,7 +341,68 @@ stop_after_n_iterations_without_percent_improvement_over_threshold = stop_after_
 
 class GradientBoostingEstimator(BaseDelegatingEstimator):
     def __init__(self, base_estimator, loss_function, learning_rate=.1, n_estimators=100,
-                 stopper=never_stop_early, verbose=0, extra_fit=False):
+                 stopper=never_stop_early, verbose=0, extra_fit=False, line_search='auto',
+                 subsample=1., max_features=None, random_state=None, validation_fraction=None,
+                 warm_start=False, checkpoint_dir=None, checkpoint_every=10, max_bins=None):
+        '''
+        extra_fit : bool, optional (default=False)
+            If True, after each base estimator is fit, an intercept and a coefficient for each 
+            column of its transform of X are fit to minimize the loss (see _extra_fit), in place 
+            of the line search.
+        
+        line_search : str, optional (default='auto')
+            How to choose the step size for each base estimator.  With 'auto', losses that 
+            provide step derivatives (see register_step_derivatives) get a closed form step 
+            (for quadratic losses) or a few Newton steps, falling back to golden section 
+            search if Newton's method fails to reduce the loss.  With 'golden', golden section 
+            search is always used.  The number of loss (or derivative) passes over the data 
+            used by each line search is stored in loss_evaluations_.
+        
+        subsample : float, optional (default=1.)
+            The fraction of rows, drawn without replacement, on which to fit each base 
+            estimator.  The prediction update and line search always use all rows.
+        
+        max_features : int, float, or None, optional (default=None)
+            The number (if int) or fraction (if float) of columns, drawn without replacement, 
+            on which to fit each base estimator.  None means all columns.  Base estimators fit 
+            on a subset of columns are stored with a ColumnSubsetTransformer in front of them.
+        
+        random_state : int, RandomState, or None, optional (default=None)
+            Used to draw the row and column subsamples and the validation set.
+        
+        validation_fraction : float or None, optional (default=None)
+            If not None, this fraction of the rows is held out from fitting.  Predictions for 
+            the held out rows are updated along with the training predictions, the held out 
+            loss after each round is stored in validation_losses_, and the stopper receives 
+            it as validation_losses (stoppers such as 
+            NIterationsWithoutImprovementOverThreshold use it in place of the training 
+            losses).  The held out rows are stored in validation_mask_, and warm starts hold 
+            out the same rows.  Alternatively, pass eval_set to fit.
+        
+        warm_start : bool, optional (default=False)
+            If True and the model is already fit, fit continues from the previous fit, adding 
+            rounds until there are n_estimators of them, instead of starting over.
+        
+        checkpoint_dir : str or None, optional (default=None)
+            If not None, the state of the fitting loop (estimators, coefficients, losses, and 
+            the current predictions) is saved in this directory every checkpoint_every rounds 
+            and at the end of the fit.  Each checkpoint writes only the estimators fit since the 
+            previous one.  A fit with the same parameters (other than n_estimators, stopper, and 
+            verbose) on the same data resumes from the saved state, so an interrupted fit can 
+            be restarted and a finished fit can be continued to a larger n_estimators.  The 
+            other parameters must be picklable.
+        
+        checkpoint_every : int, optional (default=10)
+            How many rounds to fit between checkpoints.
+        
+        max_bins : int or None, optional (default=None)
+            If not None, each column of X is quantised once, before the first round, into at 
+            most max_bins (at most 256) bins, and every base estimator is fit on the resulting 
+            BinnedMatrix instead of on X.  The base estimator must have a bin_edges parameter, 
+            which is set to the bin edges of the columns it sees, and must accept the binned 
+            matrix in fit and predict and unbinned data in predict.  HistogramTreeRegressor 
+            does.  The bin edges are stored in bin_edges_.
+        '''
         self.base_estimator = base_estimator
         self.loss_function = loss_function
         self.learning_rate = learning_rate
@@ -190,9 +410,39 @@ class GradientBoostingEstimator(BaseDelegatingEstimator):
         self.stopper = stopper
         self.verbose = verbose
         self.extra_fit = extra_fit
+        self.line_search = line_search
+        self.subsample = subsample
+        self.max_features = max_features
+        self.random_state = random_state
+        self.validation_fraction = validation_fraction
+        self.warm_start = warm_start
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_every = checkpoint_every
+        self.max_bins = max_bins
         
-    def fit(self, X, y, sample_weight=None, exposure=None, previous_prediction=None):
+    def fit(self, X, y, sample_weight=None, exposure=None, previous_prediction=None, eval_set=None):
+        '''
+        eval_set, if given, is a tuple (X, y), (X, y, sample_weight), or 
+        (X, y, sample_weight, exposure) of held out data used for early stopping, in which 
+        case validation_fraction is ignored.
+        '''
+        random_state = check_random_state(self.random_state)
         
+        # A warm start holds out the same rows as the fit it continues, so that rows the earlier 
+        # rounds were trained on never end up in the held out data
+        validation_mask = None
+        if (self.warm_start and hasattr(self, 'estimator_') and eval_set is None and 
+                self.validation_fraction is not None):
+            validation_mask = getattr(self, 'validation_mask_', None)
+            if validation_mask is None or validation_mask.shape[0] != X.shape[0]:
+                raise ValueError('warm_start with validation_fraction requires a previous fit on the '
+                                 'same data with validation_fraction.')
+        X, y, sample_weight, exposure, validation_args = self._validation_split(X, y, sample_weight, 
+                                                                                exposure, eval_set, 
+                                                                                random_state, 
+                                                                                validation_mask)
+        if validation_args is not None and previous_prediction is not None:
+            raise ValueError('Held out data can not be used with previous_prediction.')
         fit_args = {'X': growd(2,X), 'y': shrinkd(1,y)}
         if sample_weight is not None:
             fit_args['sample_weight'] = shrinkd(1, sample_weight)
@@ -202,54 +452,117 @@ class GradientBoostingEstimator(BaseDelegatingEstimator):
 #                                       exposure=exposure)
         if self._estimator_type == 'classifier':
             self.classes_, y = np.unique(growd(2,y), return_inverse=True)
+            if validation_args is not None:
+                validation_args['y'] = np.searchsorted(self.classes_, validation_args['y'])
         else:
             self.y = growd(2,y)
-        coefficients = []
-        estimators = []
-        if previous_prediction is None:
-            initial_estimator = self.loss_function.init_estimator()
-            initial_estimator.fit(**fit_args)
-            coefficients.append(1.)
-            estimators.append(initial_estimator)
         predict_args = {'X':X}
         if exposure is not None:
             predict_args['exposure'] = exposure
-        if previous_prediction is None:
-            prediction = shrinkd(1, initial_estimator.predict(**valmap(shrinkd(1), predict_args)))
-        else:
-            prediction = previous_prediction.copy()
-            
-#         prediction_cv = prediction.copy()
-        gradient_args = {'y':y, 'pred':prediction}
-        if sample_weight is not None:
-            gradient_args['sample_weight': sample_weight]
-        if exposure is not None:
-            gradient_args['exposure': exposure]
-        gradient = shrinkd(1, self.loss_function.negative_gradient(**valmap(shrinkd(1), gradient_args)))
         partial_arguments = {'y':y}
         if sample_weight is not None:
             partial_arguments['sample_weight'] = sample_weight
         if exposure is not None:
             partial_arguments['exposure'] = exposure
-        loss_function = lambda pred: self.loss_function(pred=shrinkd(1, pred), **valmap(shrinkd(1), partial_arguments))
-        self.initial_loss_ = loss_function(prediction)
-        loss = self.initial_loss_
+        
+        # Per-row buffers are allocated once here and reused by every round
+        workspace = BoostingWorkspace(self.loss_function, fit_args['X'].shape[0])
+        loss_args = valmap(shrinkd(1), partial_arguments)
+        loss_function = lambda pred: workspace.loss(shrinkd(1, pred), loss_args)
+        if validation_args is not None:
+            validation_predict_args = dissoc(validation_args, 'y', 'sample_weight')
+            validation_partial_arguments = dissoc(validation_args, 'X')
+            validation_loss_function = lambda pred: self.loss_function(pred=shrinkd(1, pred), 
+                                                                       **validation_partial_arguments)
+        else:
+            validation_predict_args = None
+            validation_loss_function = None
+        
+        # Pick up where a previous fit or a checkpoint left off, if possible
+        if self.checkpoint_dir is not None:
+            checkpoint_cache = FoldCache(self.checkpoint_dir)
+            checkpoint_key = self._checkpoint_key(checkpoint_cache, fit_args, previous_prediction, 
+                                                  validation_args)
+            state, checkpoint_chunks = self._load_checkpoint(checkpoint_cache, checkpoint_key)
+            if state is not None and state['n_rounds'] > self.n_estimators:
+                state, checkpoint_chunks = None, []
+            if state is not None and self.verbose >= 1:
+                print('Resuming from checkpoint after %d iterations.' % state['n_rounds'])
+        else:
+            state = None
+        if state is None and self.warm_start and hasattr(self, 'estimator_'):
+            state = self._warm_start_state(predict_args, previous_prediction, validation_predict_args, 
+                                           validation_loss_function)
+        
+        if state is None:
+            coefficients = []
+            estimators = []
+            if previous_prediction is None:
+                initial_estimator = self.loss_function.init_estimator()
+                initial_estimator.fit(**fit_args)
+                coefficients.append(1.)
+                estimators.append(initial_estimator)
+            if previous_prediction is None:
+                prediction = shrinkd(1, initial_estimator.predict(**valmap(shrinkd(1), predict_args)))
+            else:
+                prediction = previous_prediction.copy()
+            self.initial_loss_ = loss_function(prediction)
+            losses = [self.initial_loss_]
+            loss_evaluations = []
+            
+            # Held out predictions are updated incrementally, one base estimator at a time
+            if validation_args is not None:
+                validation_prediction = shrinkd(1, initial_estimator.predict(**validation_predict_args))
+                validation_losses = [validation_loss_function(validation_prediction)]
+            else:
+                validation_prediction = None
+                validation_losses = None
+            n_rounds = 0
+        else:
+            coefficients = list(state['coefficients'])
+            estimators = list(state['estimators'])
+            prediction = state['prediction']
+            self.initial_loss_ = state['initial_loss']
+            losses = list(state['losses'])
+            loss_evaluations = list(state['loss_evaluations'])
+            validation_prediction = state['validation_prediction']
+            validation_losses = state['validation_losses']
+            if validation_losses is not None:
+                validation_losses = list(validation_losses)
+            random_state = state['random_state']
+            n_rounds = state['n_rounds']
+        loss = losses[-1]
+            
+#         prediction_cv = prediction.copy()
+        gradient = workspace.negative_gradient(prediction, loss_args)
 #         loss_cv = loss
-        losses = [self.initial_loss_]
 #         losses_cv = [self.initial_loss_]
         predict_args = {'X': X}
         if exposure is not None:
             predict_args['exposure'] = shrinkd(1, exposure)
+        
+        # In histogram mode the base estimators see only the binned matrix
+        if self.max_bins is not None:
+            if 'bin_edges' not in self.base_estimator.get_params(deep=False):
+                raise ValueError('max_bins requires a base_estimator with a bin_edges parameter, '
+                                 'such as HistogramTreeRegressor.')
+            self.bin_edges_ = bin_edges(fit_args['X'], self.max_bins)
+            fit_args['X'] = apply_bins(fit_args['X'], self.bin_edges_)
+        
         self.early_stop_ = False
-        for iteration in range(self.n_estimators):
+        for iteration in range(n_rounds, self.n_estimators):
             previous_loss = loss
 #             previous_loss_cv = loss_cv
             if self.verbose >= 1:
                 print('Fitting estimator %d...' % (iteration + 1))
-            fit_args['y'] = shrinkd(1, gradient)
-            estimator = clone(self.base_estimator)
+            # The gradient buffer is overwritten next round, so base estimators get their own copy
+            fit_args['y'] = shrinkd(1, gradient).copy()
+            estimator = self._fit_base_estimator(fit_args, random_state)
             try:
-                approx_gradient = shrinkd(1, fit_predict(estimator, **fit_args))
+                if self._subsampling_rows(fit_args):
+                    approx_gradient = shrinkd(1, estimator.predict(**dissoc(fit_args, 'y', 'sample_weight')))
+                else:
+                    approx_gradient = shrinkd(1, fit_predict(estimator, **fit_args))
             except:
                 raise
             if self.verbose >= 1:
@@ -262,15 +575,10 @@ class GradientBoostingEstimator(BaseDelegatingEstimator):
                 transform_args = {'X': X}
                 if exposure is not None:
                     transform_args['exposure'] = exposure 
-                extra_fit_args = {'X': estimator.transform(**transform_args), 'y': y, 'previous_prediction': prediction}
-                if sample_weight is not None:
-                    extra_fit_args['sample_weight'] = sample_weight
-                extra_predict_args = dissoc(extra_fit_args, 'y', 'previous_prediction')
-                extra_estimator = GradientBoostingEstimator(LinearRegression(), loss_function=self.loss_function,
-                                                            stopper=stop_after_n_iterations_without_percent_improvement_over_threshold(1, .001))
-                extra_estimator.fit(**valmap(shrinkd(1), extra_fit_args))
-                prediction += extra_estimator.decision_function(**extra_predict_args)
-                loss = loss_function(prediction)
+                extra_estimator, loss, n_evaluations = self._extra_fit(estimator.transform(**transform_args), 
+                                                                       prediction, loss_function, 
+                                                                       partial_arguments, loss)
+                loss_evaluations.append(n_evaluations)
                 coefficients.append(1.)
                 estimators.append((AlreadyFittedEstimator(estimator) >> AlreadyFittedEstimator(extra_estimator)).fit(X,y))
                 losses.append(loss)
@@ -279,54 +587,326 @@ class GradientBoostingEstimator(BaseDelegatingEstimator):
                 if self.verbose >= 1:
                     print('Computing alpha for estimator %d...' % (iteration + 1))
 #                 alpha, _, _, _, _, _ = line_search(loss_function, loss_grad, shrinkd(1, prediction), shrinkd(1,gradient))
-                alpha = zoom_search(golden_section_search(1e-16), zoom(1., 20, 2.), loss_function, prediction, approx_gradient)
+                alpha, n_evaluations = self._line_search(loss_function, partial_arguments, prediction, 
+                                                         approx_gradient, loss)
+                loss_evaluations.append(n_evaluations)
                 alpha *= self.learning_rate
                 if self.verbose >= 1:
                     print('alpha = %f' % alpha)
                 if self.verbose >= 1:
                     print('Computing alpha for estimator %d complete.' % (iteration + 1))
             
-                prediction += alpha * approx_gradient
+                workspace.step(prediction, alpha, approx_gradient)
                 loss = loss_function(prediction)
                 coefficients.append(alpha)
                 estimators.append(estimator)
                 losses.append(loss)
 #                 losses_cv.append(loss_cv)
+            if validation_args is not None:
+                validation_prediction += coefficients[-1] * shrinkd(1, estimators[-1].predict(**validation_predict_args))
+                validation_losses.append(validation_loss_function(validation_prediction))
+            n_rounds = iteration + 1
             if self.verbose >= 1:
                 print('Loss after %d iterations is %f, a reduction of %f%%.' % (iteration + 1, loss, 100*(previous_loss - loss)/float(previous_loss)))
 #                 if loss_cv != loss:
 #                     print('Cross-validated loss after %d iterations is %f, a reduction of %f%%.' % (iteration + 1, loss_cv, 100*(previous_loss_cv - loss_cv)/float(previous_loss_cv)))
+                if validation_losses is not None:
+                    print('Held out loss after %d iterations is %f.' % (iteration + 1, validation_losses[-1]))
                 print('Checking early stopping condition for estimator %d...' % (iteration + 1))
             
             if self.stopper(iteration=iteration, coefficients=coefficients, losses=losses, 
-                            gradient=gradient, approx_gradient=approx_gradient):#, approx_gradient_cv=approx_gradient_cv):
+                            gradient=gradient, approx_gradient=approx_gradient, 
+                            validation_losses=validation_losses):#, approx_gradient_cv=approx_gradient_cv):
                 self.early_stop_ = True
                 if self.verbose >= 1:
                     print('Stopping early after %d iterations.' % (iteration + 1))
                 break
             if self.verbose >= 1:
                 print('Not stopping early.')
-            gradient_args['pred'] = prediction
-            gradient = shrinkd(1, self.loss_function.negative_gradient(**valmap(shrinkd(1), gradient_args)))
+            gradient = workspace.negative_gradient(prediction, loss_args)
+            if self.checkpoint_dir is not None and n_rounds % self.checkpoint_every == 0:
+                if self.verbose >= 1:
+                    print('Saving checkpoint after %d iterations.' % n_rounds)
+                self._save_checkpoint(checkpoint_cache, checkpoint_key, checkpoint_chunks, 
+                                      self._state(coefficients, estimators, prediction, losses, 
+                                                  loss_evaluations, validation_prediction, 
+                                                  validation_losses, random_state, n_rounds))
+        if self.checkpoint_dir is not None:
+            self._save_checkpoint(checkpoint_cache, checkpoint_key, checkpoint_chunks, 
+                                  self._state(coefficients, estimators, prediction, losses, 
+                                              loss_evaluations, validation_prediction, 
+                                              validation_losses, random_state, n_rounds))
+        self.random_state_ = random_state
         self.coefficients_ = coefficients
         self.estimators_ = estimators
         self.losses_ = losses
+        self.loss_evaluations_ = loss_evaluations
+        if validation_losses is not None:
+            self.validation_losses_ = validation_losses
+            self.best_iteration_ = int(np.argmin(validation_losses))
 #         self.losses_cv_ = losses_cv
         self.score_ = (self.initial_loss_ - loss) / self.initial_loss_
         self.estimator_ = LinearCombination(self.estimators_, self.coefficients_)
         self._create_delegates('estimator', ['syms'])
         return self
     
-    def statistic_over_steps(self, X, y, statistic, exposure=None):
+    def _state(self, coefficients, estimators, prediction, losses, loss_evaluations, 
+               validation_prediction, validation_losses, random_state, n_rounds):
+        return {'coefficients': coefficients, 'estimators': estimators, 'prediction': prediction, 
+                'initial_loss': self.initial_loss_, 'losses': losses, 
+                'loss_evaluations': loss_evaluations, 'validation_prediction': validation_prediction, 
+                'validation_losses': validation_losses, 'random_state': random_state, 
+                'n_rounds': n_rounds}
+    
+    def _checkpoint_key(self, checkpoint_cache, fit_args, previous_prediction, validation_args):
+        # Parameters that don't change what the first n rounds look like are left out, so that 
+        # a fit can be resumed with more rounds.  The stopper only decides when to stop, and is 
+        # often a lambda or closure, which can't be hashed.
+        params = dissoc(self.get_params(deep=False), 'n_estimators', 'verbose', 'warm_start', 
+                        'checkpoint_dir', 'checkpoint_every', 'stopper')
+        hashed_params = {}
+        for name, value in params.items():
+            try:
+                hashed_params[name] = joblib_hash(value)
+            except Exception:
+                raise ValueError('checkpoint_dir requires parameters that can be pickled, but %s '
+                                 '(%r) can not.' % (name, value))
+        fingerprint = checkpoint_cache.fingerprint((fit_args, previous_prediction, validation_args))
+        return joblib_hash((type(self), hashed_params, fingerprint))
+    
+    def _chunk_key(self, checkpoint_key, start, stop):
+        return joblib_hash((checkpoint_key, 'estimators', start, stop))
+    
+    def _save_checkpoint(self, checkpoint_cache, checkpoint_key, chunks, state):
+        '''
+        Save state under checkpoint_key.  Only the estimators added since the last checkpoint 
+        are written, under their own key, and their (start, stop) range is appended to chunks, 
+        so each estimator is written once no matter how many checkpoints there are.
+        '''
+        estimators = state['estimators']
+        start = chunks[-1][1] if chunks else 0
+        if len(estimators) > start:
+            checkpoint_cache.set(self._chunk_key(checkpoint_key, start, len(estimators)), 
+                                 list(estimators[start:]))
+            chunks.append((start, len(estimators)))
+        state = dissoc(state, 'estimators')
+        state['estimator_chunks'] = list(chunks)
+        checkpoint_cache.set(checkpoint_key, state)
+    
+    def _load_checkpoint(self, checkpoint_cache, checkpoint_key):
+        '''
+        Return the state saved by _save_checkpoint and its list of estimator chunks, or None 
+        and an empty list if there isn't a complete checkpoint.
+        '''
+        state = checkpoint_cache.get(checkpoint_key)
+        if state is None or 'estimator_chunks' not in state:
+            return None, []
+        estimators = []
+        for start, stop in state['estimator_chunks']:
+            chunk = checkpoint_cache.get(self._chunk_key(checkpoint_key, start, stop))
+            if chunk is None or len(chunk) != stop - start:
+                return None, []
+            estimators.extend(chunk)
+        chunks = list(state['estimator_chunks'])
+        state = dissoc(state, 'estimator_chunks')
+        state['estimators'] = estimators
+        return state, chunks
+    
+    def _warm_start_state(self, predict_args, previous_prediction, validation_predict_args, 
+                          validation_loss_function):
+        '''
+        The state of the fitting loop at the end of the previous fit, for warm_start.
+        '''
+        if previous_prediction is not None:
+            raise ValueError('warm_start can not be used with previous_prediction.')
+        
+        # Rounds are counted after the initial estimator, which a fit with previous_prediction 
+        # does not have
+        if (not self.estimators_ or self.coefficients_[0] != 1. or 
+                type(self.estimators_[0]) is not type(self.loss_function.init_estimator())):
+            raise ValueError('warm_start requires a previous fit that starts with the initial '
+                             'estimator of the loss function.')
+        n_rounds = len(self.estimators_) - 1
+        if n_rounds > self.n_estimators:
+            raise ValueError('n_estimators=%d must be at least the number of rounds already fit '
+                             '(%d) when warm_start is True.' % (self.n_estimators, n_rounds))
+        prediction = shrinkd(1, np.asarray(self.estimator_.predict(**valmap(shrinkd(1), predict_args)), 
+                                           dtype=float))
+        if validation_predict_args is not None:
+            validation_prediction = shrinkd(1, np.asarray(self.estimator_.predict(**validation_predict_args), 
+                                                          dtype=float))
+            validation_losses = list(getattr(self, 'validation_losses_', [])) or \
+                [validation_loss_function(validation_prediction)]
+        else:
+            validation_prediction = None
+            validation_losses = None
+        return self._state(self.coefficients_, self.estimators_, prediction, self.losses_, 
+                           self.loss_evaluations_, validation_prediction, validation_losses, 
+                           getattr(self, 'random_state_', check_random_state(self.random_state)), 
+                           n_rounds)
+    
+    def _validation_split(self, X, y, sample_weight, exposure, eval_set, random_state, 
+                          validation_mask=None):
+        '''
+        Return the training X, y, sample_weight, and exposure, and a dict of held out data 
+        (or None if there isn't any).  If validation_fraction is used, the held out rows are 
+        those in validation_mask if given, and are drawn with random_state otherwise.  Either 
+        way they are stored in validation_mask_.
+        '''
+        self.validation_mask_ = None
+        if eval_set is not None:
+            names = ['X', 'y', 'sample_weight', 'exposure']
+            validation_args = {name: value for name, value in zip(names, eval_set) if value is not None}
+        elif self.validation_fraction is not None:
+            if not 0. < self.validation_fraction < 1.:
+                raise ValueError('validation_fraction must be in (0, 1).  Got %s.' % 
+                                 str(self.validation_fraction))
+            if validation_mask is None:
+                n_rows = X.shape[0]
+                n_validation = max(1, int(round(self.validation_fraction * n_rows)))
+                validation_mask = np.zeros(n_rows, dtype=bool)
+                validation_mask[random_state.permutation(n_rows)[:n_validation]] = True
+            self.validation_mask_ = validation_mask
+            train_rows = np.flatnonzero(~validation_mask)
+            validation_rows = np.flatnonzero(validation_mask)
+            data = {'X': X, 'y': y, 'sample_weight': sample_weight, 'exposure': exposure}
+            data = {name: value for name, value in data.items() if value is not None}
+            train = _subset_data(data, train_rows)
+            validation_args = _subset_data(data, validation_rows)
+            X, y = train['X'], train['y']
+            sample_weight, exposure = train.get('sample_weight'), train.get('exposure')
+        else:
+            return X, y, sample_weight, exposure, None
+        validation_args['X'] = growd(2, validation_args['X'])
+        validation_args.update(valmap(shrinkd(1), dissoc(validation_args, 'X')))
+        return X, y, sample_weight, exposure, validation_args
+    
+    def _n_rows(self, n_rows):
+        if not 0. < self.subsample <= 1.:
+            raise ValueError('subsample must be in (0, 1].  Got %s.' % str(self.subsample))
+        return max(1, int(round(self.subsample * n_rows)))
+    
+    def _n_columns(self, n_columns):
+        if self.max_features is None:
+            return n_columns
+        if isinstance(self.max_features, float):
+            if not 0. < self.max_features <= 1.:
+                raise ValueError('max_features must be in (0, 1] if it is a float.  Got %s.' % 
+                                 str(self.max_features))
+            return max(1, int(round(self.max_features * n_columns)))
+        return min(max(1, int(self.max_features)), n_columns)
+    
+    def _subsampling_rows(self, fit_args):
+        n_rows = fit_args['X'].shape[0]
+        return self._n_rows(n_rows) < n_rows
+    
+    def _fit_base_estimator(self, fit_args, random_state):
+        '''
+        Clone the base estimator and, if subsampling rows, fit it on a random subset of rows.  
+        If subsampling columns, the result is a StagedEstimator that selects a random subset 
+        of columns before the base estimator.  If not subsampling rows the result is unfitted, 
+        so that it can be fit with fit_predict.  In histogram mode the clone gets the bin edges 
+        of its columns.
+        '''
+        X = fit_args['X']
+        n_rows, n_columns = X.shape
+        estimator = clone(self.base_estimator)
+        n_features = self._n_columns(n_columns)
+        if n_features < n_columns:
+            columns = np.sort(random_state.choice(n_columns, size=n_features, replace=False))
+            if self.max_bins is not None:
+                estimator.set_params(bin_edges=[self.bin_edges_[column] for column in columns])
+            if hasattr(X, 'columns'):
+                columns = list(X.columns[columns])
+            estimator = ColumnSubsetTransformer(x_cols=columns) >> estimator
+        elif self.max_bins is not None:
+            estimator.set_params(bin_edges=self.bin_edges_)
+        n_subsample = self._n_rows(n_rows)
+        if n_subsample < n_rows:
+            rows = np.sort(random_state.choice(n_rows, size=n_subsample, replace=False))
+            estimator.fit(**_subset_data(fit_args, rows))
+        return estimator
+    
+    def _extra_fit(self, basis, prediction, loss_function, partial_arguments, current_loss, 
+                   tolerance=1e-5, max_iter=100):
+        '''
+        Fit an intercept and coefficients for the columns of basis so that adding the resulting 
+        linear function to prediction minimizes the loss, updating prediction in place.  Each 
+        iteration fits the negative gradient by weighted least squares on basis and line 
+        searches along the fit, stopping when the loss improves by less than a fraction 
+        tolerance.  The weighted Gram matrix of basis is formed and inverted once, so each 
+        iteration costs only a few passes over the data, and for least squares loss the first 
+        iteration is exact.  Return a fitted LinearRegression, the new loss, and the number 
+        of passes over the data used.
+        '''
+        design = _design(basis, True)
+        args = valmap(shrinkd(1), partial_arguments)
+        weighted_design = design.T if 'sample_weight' not in args else design.T * args['sample_weight']
+        gram_inverse = np.linalg.pinv(np.dot(weighted_design, design))
+        coef = np.zeros(design.shape[1])
+        loss = current_loss
+        n_evaluations = 0
+        for _ in range(max_iter):
+            gradient = shrinkd(1, self.loss_function.negative_gradient(pred=prediction, **args))
+            direction_coef = np.dot(gram_inverse, np.dot(weighted_design, gradient))
+            direction = np.dot(design, direction_coef)
+            step, n_step_evaluations = self._line_search(loss_function, partial_arguments, prediction, 
+                                                         direction, loss)
+            prediction += step * direction
+            new_loss = loss_function(prediction)
+            n_evaluations += n_step_evaluations + 2
+            if new_loss > loss:
+                prediction -= step * direction
+                break
+            coef += step * direction_coef
+            improvement = loss - new_loss
+            loss = new_loss
+            if improvement <= tolerance * abs(loss):
+                break
+        estimator = LinearRegression()
+        estimator.intercept_ = coef[0]
+        estimator.coef_ = coef[1:]
+        return estimator, loss, n_evaluations
+    
+    def _line_search(self, loss_function, partial_arguments, prediction, direction, current_loss):
+        return find_step(self.loss_function, self.line_search, loss_function, partial_arguments, 
+                         prediction, direction, current_loss)
+    
+    def statistic_over_steps(self, X, y, statistic, exposure=None, every=1):
+        '''
+        Return statistic(y, score) for the scores after each of stages every, 2*every, ... of 
+        the fitted model.  Each base estimator predicts only once.
+        '''
         result = []
-        predict_args = {'X': X}
-        if exposure is not None:
-            predict_args['exposure'] = exposure
-        for j in range(1, len(self.estimators_)+1):
-            model = LinearCombination(self.estimators_[:j], self.coefficients_[:j])
-            pred = model.predict(X)
-            result.append(statistic(y, pred))
+        for j, score in enumerate(self._staged_scores(X, exposure=exposure), start=1):
+            if j % every == 0:
+                result.append(statistic(y, score))
         return result
+    
+    def _staged_scores(self, X, exposure=None):
+        if not hasattr(self, 'estimator_'):
+            raise NotFittedError()
+        return self.estimator_.staged_predict(**self._process_args(X=X, exposure=exposure))
+    
+    def staged_decision_function(self, X, exposure=None):
+        '''
+        Generate the decision function after each stage.  The first element comes from the 
+        initial estimator alone.
+        '''
+        if not hasattr(self.loss_function, '_score_to_decision'):
+            raise AttributeError()
+        return self._staged_scores(X, exposure=exposure)
+    
+    def staged_predict(self, X, exposure=None):
+        '''
+        Generate the prediction after each stage.  The first element comes from the initial 
+        estimator alone.
+        '''
+        for score in self._staged_scores(X, exposure=exposure):
+            if hasattr(self.loss_function, '_score_to_decision'):
+                yield self.loss_function._score_to_decision(score)
+            else:
+                yield score
 
     def score(self, X, y, sample_weight=None, exposure=None):
         partial_arguments = self._process_args(y=y, sample_weight=sample_weight, exposure=exposure)
@@ -409,4 +989,112 @@ class GradientBoostingEstimator(BaseDelegatingEstimator):
             return 'classifier'
         else:
             return 'regressor'
-        
\ No newline at end of file
+        
+class MultiQuantileGradientBoostingEstimator(STSimpleEstimator):
+    '''
+    Boosts several quantiles of y at once with SmoothQuantileLossFunction.  Each round fits a
+    single multi-output base estimator to the pseudo-residuals of all the quantiles, stacked
+    as columns, and then chooses a separate step size for each quantile.  This costs about one
+    base estimator fit per round instead of one per quantile per round, so base_estimator must
+    support multi-output y (as sklearn's trees and LinearRegression do).  predict returns one
+    column per element of taus.
+    
+    alpha is the smoothing parameter of SmoothQuantileLossFunction.  The stopper receives
+    the total loss over all quantiles.  The other parameters are as for
+    GradientBoostingEstimator.
+    '''
+    def __init__(self, base_estimator, taus=(.1, .5, .9), alpha=.0001, learning_rate=.1, 
+                 n_estimators=100, stopper=never_stop_early, line_search='auto', verbose=0):
+        self.base_estimator = base_estimator
+        self.taus = taus
+        self.alpha = alpha
+        self.learning_rate = learning_rate
+        self.n_estimators = n_estimators
+        self.stopper = stopper
+        self.line_search = line_search
+        self.verbose = verbose
+    
+    def fit(self, X, y, sample_weight=None):
+        X = growd(2, X)
+        y = shrinkd(1, np.asarray(y, dtype=float))
+        fit_args = {'X': X}
+        partial_arguments = {'y': y}
+        if sample_weight is not None:
+            sample_weight = shrinkd(1, np.asarray(sample_weight, dtype=float))
+            fit_args['sample_weight'] = sample_weight
+            partial_arguments['sample_weight'] = sample_weight
+        loss_functions = [SmoothQuantileLossFunction(1, tau, self.alpha) for tau in self.taus]
+        n_quantiles = len(loss_functions)
+        
+        # Predictions and gradients are stored one quantile per row so that each quantile's 
+        # values are contiguous
+        # Some initial estimators' fit methods return None, so keep the estimators themselves
+        self.initial_estimators_ = [loss.init_estimator() for loss in loss_functions]
+        for initial_estimator in self.initial_estimators_:
+            safer_call(initial_estimator.fit, X=X, y=y, sample_weight=sample_weight)
+        prediction = np.empty((n_quantiles, X.shape[0]))
+        for j, initial_estimator in enumerate(self.initial_estimators_):
+            prediction[j] = shrinkd(1, initial_estimator.predict(X))
+        gradient = np.empty((n_quantiles, X.shape[0]))
+        scratch = np.empty(X.shape[0])
+        def quantile_loss(j):
+            return lambda pred: loss_functions[j](pred=shrinkd(1, pred), out=scratch, **partial_arguments)
+        
+        loss = np.array([quantile_loss(j)(prediction[j]) for j in range(n_quantiles)])
+        losses = [loss]
+        coefficients = []
+        estimators = []
+        loss_evaluations = []
+        self.early_stop_ = False
+        for iteration in range(self.n_estimators):
+            for j, loss_function in enumerate(loss_functions):
+                loss_function.negative_gradient(pred=prediction[j], out=gradient[j], **partial_arguments)
+            if self.verbose >= 1:
+                print('Fitting estimator %d...' % (iteration + 1))
+            estimator = clone(self.base_estimator)
+            fit_args['y'] = gradient.T.copy()
+            approx_gradient = np.asarray(fit_predict(estimator, **fit_args), dtype=float)
+            approx_gradient = np.ascontiguousarray(approx_gradient.reshape((X.shape[0], n_quantiles)).T)
+            
+            # The quantiles' losses are separate, so each gets its own step size
+            alphas = np.empty(n_quantiles)
+            evaluations = []
+            loss = np.empty(n_quantiles)
+            for j, loss_function in enumerate(loss_functions):
+                step, n_evaluations = find_step(loss_function, self.line_search, quantile_loss(j), 
+                                                partial_arguments, prediction[j], approx_gradient[j], 
+                                                losses[-1][j])
+                alphas[j] = step * self.learning_rate
+                evaluations.append(n_evaluations)
+                np.multiply(approx_gradient[j], alphas[j], out=scratch)
+                prediction[j] += scratch
+                loss[j] = quantile_loss(j)(prediction[j])
+            coefficients.append(alphas)
+            estimators.append(estimator)
+            losses.append(loss)
+            loss_evaluations.append(evaluations)
+            if self.verbose >= 1:
+                print('Losses after %d iterations are %s.' % (iteration + 1, str(loss)))
+            if self.stopper(iteration=iteration, coefficients=coefficients, 
+                            losses=[np.sum(l) for l in losses], gradient=gradient, 
+                            approx_gradient=approx_gradient):
+                self.early_stop_ = True
+                if self.verbose >= 1:
+                    print('Stopping early after %d iterations.' % (iteration + 1))
+                break
+        self.estimators_ = estimators
+        self.coefficients_ = coefficients
+        self.losses_ = np.array(losses)
+        self.loss_evaluations_ = loss_evaluations
+        return self
+    
+    def predict(self, X):
+        if not hasattr(self, 'estimators_'):
+            raise NotFittedError()
+        X = growd(2, X)
+        result = np.empty((X.shape[0], len(self.initial_estimators_)))
+        for j, initial_estimator in enumerate(self.initial_estimators_):
+            result[:, j] = shrinkd(1, initial_estimator.predict(X))
+        for coefficient, estimator in zip(self.coefficients_, self.estimators_):
+            result += np.asarray(estimator.predict(X)).reshape(result.shape) * coefficient
+        return result
@@ -2,8 +2,20 @@
 import statsmodels.api
 import statsmodels.genmod.families.family
 import numpy as np
-from .sklearntools import STSimpleEstimator
+from .sklearntools import STSimpleEstimator, _subset
 from statsmodels.genmod.families.links import log
+from .linear_cv import leverage, SufficientStatistics, register_downdate_fits
+from sklearn.base import clone
+
+def _as_float_array(X):
+    '''
+    Convert X to a float32 or float64 array.  Arrays that already are one, in any memory 
+    layout, are returned without copying.
+    '''
+    X = np.asarray(X)
+    if X.dtype != np.float64 and X.dtype != np.float32:
+        X = X.astype(np.float64)
+    return X
 
 class GLM(STSimpleEstimator):
     '''
@@ -44,7 +56,7 @@ class GLM(STSimpleEstimator):
             self.xlabels = kwargs['xlabels']
         
         #Convert to internally used data type
-        X = np.asarray(X,dtype=np.float64)
+        X = _as_float_array(X)
         m,n = X.shape
         
         if offset is not None:
@@ -69,8 +81,9 @@ class GLM(STSimpleEstimator):
         if y is None and type(X) is tuple:
             y, X = X
         
-        #Handle X separately
+        #Handle X separately.  Fitting is always done in double precision.
         X, offset, exposure = self._scrub_x(X, offset, exposure, **kwargs)
+        X = np.asarray(X, dtype=np.float64)
         
         #Convert y to internally used data type
         y = np.asarray(y,dtype=np.float64)
@@ -133,9 +146,6 @@ class GLM(STSimpleEstimator):
             The training predictors.  The X parameter can be a numpy array, a pandas DataFrame, or a 
             patsy DesignMatrix.
         '''
-        #Format the data
-        X, offset, exposure = self._scrub_x(X, offset, exposure)
-        
         #Linear transformation
         eta = self.transform(X, offset, exposure)
         
@@ -153,24 +163,68 @@ class GLM(STSimpleEstimator):
         ----------
         X : array-like, shape = [m, n] where m is the number of samples and n is the number of features
             The training predictors.  The X parameter can be a numpy array, a pandas DataFrame, or a 
-            patsy DesignMatrix.
+            patsy DesignMatrix.  Float32 and float64 arrays are used as they are, without 
+            copying, and the linear combination of float32 data is computed in single precision.
         '''
         #Format the data
         X, offset, exposure = self._scrub_x(X, offset, exposure)
         
+        #Compute linear combination, adding the intercept as a scalar rather than as a column.  
+        #There is no intercept if there was no constant column to add when fitting (either 
+        #because add_constant is False or because X already had a constant column).
+        coef = np.asarray(self.coef_)
+        weights = coef.astype(X.dtype, copy=False)
+        if coef.shape[0] == X.shape[1] + 1:
+            eta = np.dot(X, weights[1:]).astype(np.float64, copy=False)
+            eta += coef[0]
+        else:
+            eta = np.dot(X, weights).astype(np.float64, copy=False)
+        
+        #Apply offset and exposure
+        if offset is not None:
+            eta += offset
+        if exposure is not None:
+            eta += np.log(exposure)
+        return eta
+    
+    def loo_predict(self, X, y, indices, offset = None, exposure = None):
+        '''
+        Approximate leave-one-out predictions for the rows in indices, computed from the current
+        fit with a one-step influence update instead of a refit.  The approximation is exact for 
+        the Gaussian family with identity link.
+        
+        
+        Parameters 
+        ----------
+        X : array-like, shape = [m, n] where m is the number of samples and n is the number of features
+            The training predictors the model was fit on.
+        
+        y : array-like, shape = [m] where m is the number of samples
+            The training response the model was fit on.
+        
+        indices : array of ints
+            The rows for which to compute leave-one-out predictions.
+        '''
+        X, y, offset, exposure = self._scrub(X, y, offset, exposure)
+        
         #Add a constant column
         if self.add_constant:
             X = statsmodels.api.add_constant(X, prepend=True)
         
-        #Compute linear combination
-        eta = np.dot(X,self.coef_)
-        
-        #Apply offset and exposure
+        #Linear predictor and IRLS weights at the fitted coefficients
+        eta = np.dot(X, self.coef_)
         if offset is not None:
             eta += offset
         if exposure is not None:
             eta += np.log(exposure)
-        return eta
+        mu = self.family.fitted(eta)
+        weights = self.family.weights(mu)
+        
+        #Remove each row's influence on its own linear predictor
+        h = leverage(X, weights, indices)
+        working_residual = self.family.link.deriv(mu[indices]) * (y[indices] - mu[indices])
+        loo_eta = eta[indices] - h * working_residual / (1. - h)
+        return self.family.fitted(loo_eta)
     
 #     def score(self, X, y = None, offset = None, exposure = None, xlabels = None):
 #         X, y, offset, exposure = self._scrub(X,y,offset,exposure,**self.__dict__)
@@ -194,6 +248,56 @@ class GammaRegressor(GLMFamily):
     
 class GaussianRegressor(GLMFamily):
     family = statsmodels.genmod.families.family.Gaussian
+
+def _has_identity_link(family):
+    '''
+    True if family's link function leaves the mean unchanged.
+    '''
+    probe = np.array([.25, .5, 2.])
+    return np.allclose(family.link(probe), probe)
+
+def _refit_folds(estimator, X, y, holdouts, offset=None, exposure=None):
+    '''
+    Fold fits for estimator by refitting a clone on all rows except each holdout.
+    '''
+    n = X.shape[0]
+    result = []
+    for holdout in holdouts:
+        train = np.ones(n, dtype=bool)
+        train[holdout] = False
+        train = np.flatnonzero(train)
+        result.append(clone(estimator).fit(_subset(X, train), _subset(y, train), 
+                                           offset=None if offset is None else _subset(offset, train), 
+                                           exposure=None if exposure is None else _subset(exposure, train)))
+    return result
+
+def downdate_fits_gaussian_regressor(estimator, X, y, holdouts, offset=None, exposure=None):
+    '''
+    Fold fits for a GaussianRegressor from one pass over the data.  With the identity link the 
+    GLM fit is ordinary least squares on y minus the offset and log exposure, so each fold's 
+    coefficients come from downdating the full data sufficient statistics.  With any other 
+    link each fold is refit.
+    '''
+    if not _has_identity_link(estimator.family):
+        return _refit_folds(estimator, X, y, holdouts, offset=offset, exposure=exposure)
+    estimator_ = clone(estimator)
+    X, y, offset, exposure = estimator_._scrub(X, y, offset, exposure)
+    if estimator.add_constant:
+        X = statsmodels.api.add_constant(X, prepend=True)
+    if offset is not None:
+        y = y - offset
+    if exposure is not None:
+        y = y - np.log(exposure)
+    stats = SufficientStatistics(X, y, intercept=False)
+    result = []
+    for holdout in holdouts:
+        fold_estimator = clone(estimator)
+        fold_estimator.xlabels = estimator_.xlabels
+        fold_estimator.coef_ = stats.solve(holdout)
+        result.append(fold_estimator)
+    return result
+
+register_downdate_fits(GaussianRegressor, downdate_fits_gaussian_regressor)
     
 class InverseGaussianRegressor(GLMFamily):
     family = statsmodels.genmod.families.family.InverseGaussian
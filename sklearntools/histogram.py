@@ -0,0 +1,245 @@
+'''
+Histogram based regression trees.  Each column of X is quantised once into at most 256 bins,
+stored as a uint8 BinnedMatrix, and trees are grown from per-bin sums of the target instead of
+from sorted columns.  A GradientBoostingEstimator with max_bins set bins X once before its loop
+and passes the binned matrix to every round's HistogramTreeRegressor.
+'''
+import numpy as np
+from .sklearntools import STSimpleEstimator, growd, shrinkd
+
+def bin_edges(X, max_bins=256):
+    '''
+    For each column of X, return an increasing array of at most max_bins - 1 thresholds that
+    divide the column into bins of roughly equal size.  Columns with few distinct values get
+    a threshold halfway between each pair of adjacent values.
+    '''
+    if not 2 <= max_bins <= 256:
+        raise ValueError('max_bins must be between 2 and 256.  Got %s.' % str(max_bins))
+    X = growd(2, np.asarray(X, dtype=np.float64))
+    result = []
+    for j in range(X.shape[1]):
+        column = X[:, j]
+        values = np.unique(column[~np.isnan(column)])
+        if values.shape[0] > max_bins:
+            percentiles = np.linspace(0., 100., max_bins + 1)[1:-1]
+            values = np.unique(np.percentile(column[~np.isnan(column)], percentiles))
+        result.append(np.ascontiguousarray((values[:-1] + values[1:]) / 2.))
+    return result
+
+class BinnedMatrix(np.ndarray):
+    '''
+    A uint8 matrix of bin numbers, as returned by apply_bins.  HistogramTreeRegressor treats X
+    as already binned only if it is a BinnedMatrix, so that ordinary uint8 data (such as pixel
+    values) is binned like any other.  Indexing a BinnedMatrix gives another BinnedMatrix.
+    '''
+    pass
+
+def apply_bins(X, edges, out=None):
+    '''
+    Return the BinnedMatrix of bin numbers of X for the given bin_edges.  Row i falls in bin b of
+    column j if edges[j][b-1] < X[i, j] <= edges[j][b], so that bin <= b exactly when
+    X[i, j] <= edges[j][b].
+    '''
+    X = growd(2, np.asarray(X))
+    if X.shape[1] != len(edges):
+        raise ValueError('X has %d columns but there are bin edges for %d.' % (X.shape[1], len(edges)))
+    if out is None:
+        out = np.empty(X.shape, dtype=np.uint8)
+    for j, column_edges in enumerate(edges):
+        out[:, j] = np.searchsorted(column_edges, X[:, j], side='left')
+    return out.view(BinnedMatrix)
+
+class HistogramTreeRegressor(STSimpleEstimator):
+    '''
+    A weighted least squares regression tree grown from gradient histograms.  At each node,
+    the weighted sums of y and of the weights in every bin of every column are accumulated in
+    one pass and the best split is read off their cumulative sums.  Only the smaller child of
+    each split is scanned; the larger child's histograms are the parent's minus the smaller's.
+
+    max_depth : int, optional (default=3)
+        The maximum depth of the tree.
+
+    min_samples_leaf : int, optional (default=1)
+        The minimum number of rows in each leaf.
+
+    l2_regularization : float, optional (default=0.)
+        Added to the total weight of each leaf when computing split gains and leaf values.
+
+    max_bins : int, optional (default=256)
+        The number of bins per column when the tree bins X itself.
+
+    bin_edges : list of arrays or None, optional (default=None)
+        If not None, the bin edges (as returned by bin_edges) to use instead of computing them
+        from X.  In that case a BinnedMatrix passed to fit or predict is taken to be already
+        binned with these edges, as GradientBoostingEstimator does when max_bins is set.
+        Otherwise X is binned on each call to fit.
+    '''
+    def __init__(self, max_depth=3, min_samples_leaf=1, l2_regularization=0., max_bins=256,
+                 bin_edges=None):
+        self.max_depth = max_depth
+        self.min_samples_leaf = min_samples_leaf
+        self.l2_regularization = l2_regularization
+        self.max_bins = max_bins
+        self.bin_edges = bin_edges
+
+    def _is_binned(self, X):
+        if not isinstance(X, BinnedMatrix):
+            return False
+        if self.bin_edges is None:
+            raise ValueError('Binned X can only be used with the bin_edges it was binned with.')
+        return True
+
+    def _binned(self, X):
+        if self._is_binned(X):
+            return X.view(np.ndarray)
+        return apply_bins(X, self.edges_).view(np.ndarray)
+
+    def fit(self, X, y, sample_weight=None):
+        X = growd(2, np.asanyarray(X))
+        self.edges_ = (bin_edges(X, self.max_bins) if self.bin_edges is None
+                       else list(self.bin_edges))
+        binned = self._binned(X)
+        y = shrinkd(1, np.asarray(y, dtype=np.float64))
+        weights = (np.ones(y.shape[0]) if sample_weight is None
+                   else shrinkd(1, np.asarray(sample_weight, dtype=np.float64)))
+        self._grow(binned, y, weights)
+        return self
+
+    def fit_predict(self, X, y, sample_weight=None):
+        '''
+        Fit and return the predictions for the training rows, which are known from the fit
+        without walking the tree again.
+        '''
+        self.fit(X, y, sample_weight=sample_weight)
+        return self.training_leaves_value_
+
+    def _histograms(self, binned, rows, weighted_y, weights):
+        '''
+        The per-bin sums of weighted y, sums of weights and counts of the given rows, one 
+        column at a time so that only a column's worth of bin numbers is in memory at once.
+        '''
+        n_features = binned.shape[1]
+        shape = (n_features, 256)
+        sums = np.empty(shape)
+        node_weights = np.empty(shape)
+        counts = np.empty(shape, dtype=np.intp)
+        node_weighted_y = weighted_y[rows]
+        node_weight_rows = weights[rows]
+        for j in range(n_features):
+            codes = binned[rows, j]
+            sums[j] = np.bincount(codes, weights=node_weighted_y, minlength=256)
+            node_weights[j] = np.bincount(codes, weights=node_weight_rows, minlength=256)
+            counts[j] = np.bincount(codes, minlength=256)
+        return sums, node_weights, counts
+
+    def _best_split(self, histograms):
+        '''
+        Return the column and bin of the best split of a node with the given histograms, or
+        None if no split improves the fit.
+        '''
+        sums, weights, counts = histograms
+        total_sum = sums[0].sum()
+        total_weight = weights[0].sum()
+        total_count = counts[0].sum()
+        left_sum = np.cumsum(sums, axis=1)[:, :-1]
+        left_weight = np.cumsum(weights, axis=1)[:, :-1]
+        left_count = np.cumsum(counts, axis=1)[:, :-1]
+        right_sum = total_sum - left_sum
+        right_weight = total_weight - left_weight
+        right_count = total_count - left_count
+        min_samples_leaf = max(1, self.min_samples_leaf)
+        allowed = ((left_count >= min_samples_leaf) & (right_count >= min_samples_leaf) &
+                   (left_weight > 0.) & (right_weight > 0.))
+        if not np.any(allowed):
+            return None
+        l2 = self.l2_regularization
+        with np.errstate(divide='ignore', invalid='ignore'):
+            gain = (left_sum ** 2 / (left_weight + l2) + right_sum ** 2 / (right_weight + l2) -
+                    total_sum ** 2 / (total_weight + l2))
+        gain[~allowed] = -np.inf
+        feature, threshold = np.unravel_index(np.argmax(gain), gain.shape)
+        if not gain[feature, threshold] > 0.:
+            return None
+        return feature, threshold
+
+    def _grow(self, binned, y, weights):
+        weighted_y = weights * y
+        features = []
+        bin_thresholds = []
+        thresholds = []
+        lefts = []
+        rights = []
+        values = []
+        leaves = np.empty(y.shape[0], dtype=np.intp)
+        self.tree_depth_ = 0
+
+        def add_node(histograms):
+            sums, node_weights, _ = histograms
+            node = len(values)
+            features.append(0)
+            bin_thresholds.append(255)
+            thresholds.append(np.inf)
+            lefts.append(node)
+            rights.append(node)
+            values.append(sums[0].sum() / (node_weights[0].sum() + self.l2_regularization))
+            return node
+
+        rows = np.arange(y.shape[0])
+        histograms = self._histograms(binned, rows, weighted_y, weights)
+        stack = [(add_node(histograms), rows, histograms, 0)]
+        while stack:
+            node, rows, histograms, depth = stack.pop()
+            split = self._best_split(histograms) if depth < self.max_depth else None
+            if split is None:
+                leaves[rows] = node
+                continue
+            feature, threshold = split
+            self.tree_depth_ = max(self.tree_depth_, depth + 1)
+            go_left = binned[rows, feature] <= threshold
+            left_rows = rows[go_left]
+            right_rows = rows[~go_left]
+            if left_rows.shape[0] <= right_rows.shape[0]:
+                left_histograms = self._histograms(binned, left_rows, weighted_y, weights)
+                right_histograms = tuple(p - c for p, c in zip(histograms, left_histograms))
+            else:
+                right_histograms = self._histograms(binned, right_rows, weighted_y, weights)
+                left_histograms = tuple(p - c for p, c in zip(histograms, right_histograms))
+            features[node] = feature
+            bin_thresholds[node] = threshold
+            thresholds[node] = self.edges_[feature][threshold]
+            left = add_node(left_histograms)
+            right = add_node(right_histograms)
+            lefts[node] = left
+            rights[node] = right
+            stack.append((right, right_rows, right_histograms, depth + 1))
+            stack.append((left, left_rows, left_histograms, depth + 1))
+        self.feature_ = np.array(features, dtype=np.intp)
+        self.bin_threshold_ = np.array(bin_thresholds, dtype=np.uint8)
+        self.threshold_ = np.array(thresholds, dtype=np.float64)
+        self.children_left_ = np.array(lefts, dtype=np.intp)
+        self.children_right_ = np.array(rights, dtype=np.intp)
+        self.value_ = np.array(values, dtype=np.float64)
+        self.training_leaves_value_ = self.value_[leaves]
+
+    def apply(self, X):
+        '''
+        Return the index of the leaf that each row of X falls in.
+        '''
+        X = growd(2, np.asanyarray(X))
+        if self._is_binned(X):
+            X = X.view(np.ndarray)
+            threshold = self.bin_threshold_
+        else:
+            X = np.asarray(X, dtype=np.float64)
+            threshold = self.threshold_
+
+        # Leaves are their own children, so every row can take tree_depth_ steps
+        row_index = np.arange(X.shape[0])
+        nodes = np.zeros(X.shape[0], dtype=np.intp)
+        for _ in range(self.tree_depth_):
+            left = X[row_index, self.feature_[nodes]] <= threshold[nodes]
+            nodes = np.where(left, self.children_left_[nodes], self.children_right_[nodes])
+        return nodes
+
+    def predict(self, X):
+        return self.value_[self.apply(X)]
@@ -2,8 +2,12 @@ from sklearn.externals.joblib.parallel import Parallel, delayed
 from .calibration import no_cv
 from sklearn.cross_validation import check_cv
 from sklearn.base import is_classifier, clone
-from .sklearntools import _fit_and_predict, non_fit_methods, BaseDelegatingEstimator, safe_assign_subset, safer_call
+from .sklearntools import _fit_and_predict, non_fit_methods, BaseDelegatingEstimator, safe_assign_subset, safer_call,\
+    _memmap_data, _fit, LinearCombination, _predict_fold, _peak_rss, _subset_data
 import numpy as np
+import tempfile
+import shutil
+from time import time
 # from .sym.sym_predict import sym_predict
 # from .sym.syms import syms
 # from .sym.sym_predict_parts import sym_predict_parts
@@ -17,16 +21,63 @@ from _collections_abc import Iterable
 from six import with_metaclass
 from abc import ABCMeta, abstractmethod
 from toolz.curried import valmap
+from sklearn.utils import check_random_state
+from itertools import chain
+from .cache import check_cache, cached_call
+from .linear_cv import has_loo_predict, loo_predict, has_downdate_fits, downdate_fits
 
 class CrossValidatingEstimator(BaseDelegatingEstimator):
+    '''
+    share_data : bool, optional (default=False)
+        If True, the fit arguments are written once to a temporary memory mapped store and 
+        each fold task receives read-only views of them instead of its own pickled copy.  The 
+        time spent writing the store is stored as share_time_, and the number of bytes each 
+        worker held privately and each task's dispatch latency (the time from handing it to 
+        joblib until it started, including any wait for a free worker) are stored in 
+        cv_data_nbytes_ and cv_dispatch_latencies_.  Per fold fit and predict times are always 
+        stored in fit_times_ and predict_times_, and cv_fold_info_ holds everything 
+        _fit_and_predict reports (including train and test sizes and the growth of the 
+        worker's peak RSS during the task).
+    
+    final_model : str, optional (default='refit')
+        How to produce estimator_, the model used for prediction after fitting.  With 'refit', 
+        a clone of estimator is fit on the full data set after the fold fits.  With 
+        'fold_ensemble', no extra fit is done and estimator_ averages the predictions of 
+        cv_estimators_ (only sensible for regressors).  With 'refit_in_parallel', the full 
+        data fit is scheduled in the same parallel batch as the fold fits.
+    
+    cache : FoldCache or str, optional (default=None)
+        If not None, fold results (fitted fold estimators, their predictions and indices) and 
+        the full data fit are stored in and loaded from this cache, so that repeated or 
+        interrupted fits only redo work that isn't already done.  A string is taken to be 
+        the cache directory.  Which folds were loaded from the cache is stored in cv_from_cache_.
+    
+    analytic_loo : bool, optional (default=False)
+        If True, cv is a HybridCV, and leave-one-out predictions can be computed analytically 
+        for estimator (see linear_cv.has_loo_predict), the leave-one-out rows are predicted 
+        from the single full data fit instead of being refit one at a time.  Only the k-fold 
+        splits are refit.  The leave-one-out rows are stored in cv_loo_indices_.
+    
+    downdate : bool, optional (default=True)
+        If True and estimator supports it (see linear_cv.has_downdate_fits), all fold fits are 
+        computed in the main process from sufficient statistics accumulated in one pass over 
+        the data, with each fold's contribution subtracted, instead of being refit in parallel.  
+        Set to False to always refit.
+    '''
     def __init__(self, estimator, metric=None, cv=2, n_jobs=1, verbose=0, 
-                 pre_dispatch='2*n_jobs'):
+                 pre_dispatch='2*n_jobs', share_data=False, final_model='refit', cache=None,
+                 analytic_loo=False, downdate=True):
         self.estimator = estimator
         self.metric = metric
         self.cv = cv
         self.n_jobs = n_jobs
         self.verbose = verbose
         self.pre_dispatch = pre_dispatch
+        self.share_data = share_data
+        self.final_model = final_model
+        self.cache = cache
+        self.analytic_loo = analytic_loo
+        self.downdate = downdate
         self._create_delegates('estimator', non_fit_methods)
     
     @property
@@ -49,45 +100,182 @@ class CrossValidatingEstimator(BaseDelegatingEstimator):
 #         return syms(self.estimator_)
     
     def fit(self, X, y=None, sample_weight=None, exposure=None):
-        # For later
         parallel = Parallel(n_jobs=self.n_jobs, verbose=self.verbose,
                         pre_dispatch=self.pre_dispatch,
                         max_nbytes=None)
+        plan = self._start_fit(X=X, y=y, sample_weight=sample_weight, exposure=exposure)
+        try:
+            results = parallel(plan['tasks'])
+        finally:
+            self._cleanup_fit(plan)
+        return self._finish_fit(plan, results)
+    
+    def _start_fit(self, X, y=None, sample_weight=None, exposure=None):
+        '''
+        Do everything in fit that comes before the parallel fold fits.  Returns a plan dict whose 
+        'tasks' entry is a generator of plan['n_tasks'] delayed calls.  Running them (in any 
+        Parallel) and passing the results to _finish_fit completes the fit.  _cleanup_fit must 
+        be called after running the tasks, whether or not they succeed.  This lets meta-
+        estimators such as SuperLearner run the fold fits of several CrossValidatingEstimators 
+        in one task pool.
+        '''
+        if self.final_model not in ('refit', 'fold_ensemble', 'refit_in_parallel'):
+            raise ValueError('final_model must be one of refit, fold_ensemble, or refit_in_parallel.  '
+                             'Got %s.' % str(self.final_model))
         
         # Extract arguments
         fit_args = self._process_args(X=X, y=y, sample_weight=sample_weight,
                                       exposure=exposure)
         
+        # Estimators such as LinearRegression reject column vectors of weights
+        if 'sample_weight' in fit_args:
+            fit_args['sample_weight'] = shrinkd(1, fit_args['sample_weight'])
+        plan = {'X': X, 'y': y, 'fit_args': fit_args, 'share_folder': None}
+        
         # Sort out cv parameters
-        if self.cv == 1:
-            cv = no_cv(X=X, y=y)
+        analytic = (self.analytic_loo and isinstance(self.cv, HybridCV) and 
+                    has_loo_predict(self.estimator))
+        plan['analytic'] = analytic
+        contiguous = hasattr(self.cv, 'split_slices')
+        if analytic:
+            cv_args = dict(X=X)
+            if y is not None:
+                cv_args['y'] = np.ravel(y)
+            plan['loo_indices'] = self.cv.choose_loo(**cv_args)
+            folds = list(self.cv.split_kfold(**cv_args))
+        elif contiguous:
+            # Splitters with contiguous folds (see ContiguousKFold) get all their fold data as 
+            # views of a single permuted copy of the data.  The folds themselves are still 
+            # recorded as indices into the original data.
+            n = X.shape[0]
+            layout = self.cv.layout(n)
+            slices = list(self.cv.split_slices(n))
+            folds = [(layout[train], layout[test]) for train, test in slices]
+        else:
+            folds = check_folds(self.cv, X, y, classifier=is_classifier(self.estimator))
+        plan['folds'] = folds
+        
+        # Look up any folds that have already been fit
+        cache = check_cache(self.cache)
+        plan['cache'] = cache
+        if cache is not None:
+            fingerprint = cache.fingerprint(fit_args)
+            fold_keys = [cache.key(self.estimator, fingerprint, train, test) for train, test in folds]
+            plan['full_key'] = full_key = cache.key(self.estimator, fingerprint)
+            cv_fits = [cache.get(key) for key in fold_keys]
+        else:
+            fold_keys = [None] * len(folds)
+            plan['full_key'] = full_key = None
+            cv_fits = [None] * len(folds)
+        plan['cv_fits'] = cv_fits
+        self.cv_from_cache_ = [fit is not None for fit in cv_fits]
+        todo = [i for i, fit in enumerate(cv_fits) if fit is None]
+        if self.verbose > 0 and cache is not None:
+            print('Loaded %d of %d folds from cache.' % (len(folds) - len(todo), len(folds)))
+        full_estimator = None
+        if self.final_model == 'refit_in_parallel' and cache is not None:
+            full_estimator = cache.get(full_key)
+        plan['full_estimator'] = full_estimator
+        
+        # Estimators that support it get all their fold fits from one pass over the data
+        if self.downdate and todo and has_downdate_fits(self.estimator):
+            n = fit_args['X'].shape[0]
+            holdouts = [_complement(folds[i][0], n) for i in todo]
+            start_time = time()
+            fold_estimators = downdate_fits(self.estimator, holdouts, **fit_args)
+            fit_time = (time() - start_time) / len(todo)
+            for i, holdout, estimator_ in zip(todo, holdouts, fold_estimators):
+                info = {'data_nbytes': 0, 'dispatch_latency': None, 'fit_time': fit_time,
+                        'n_train': n - len(holdout), '_peak_rss_start': _peak_rss()}
+                cv_fits[i] = _predict_fold(estimator_, fit_args, folds[i][1], info)
+                if cache is not None:
+                    cache.set(fold_keys[i], cv_fits[i])
+            todo = []
+        plan['todo'] = todo
+        
+        # Prepare the data for the fold tasks
+        refit_task = self.final_model == 'refit_in_parallel' and full_estimator is None
+        plan['refit_task'] = refit_task
+        plan['n_tasks'] = len(todo) + (1 if refit_task else 0)
+        if contiguous and plan['n_tasks'] > 0:
+            task_args = _subset_data(fit_args, layout)
+            task_folds = slices
         else:
-            if hasattr(self.cv, 'split'):
-                cv_args = dict(X=X)
-                if y is not None:
-                    cv_args['y'] = np.ravel(y)
-                cv = self.cv.split(**cv_args)
-            else:
-                cv_args = dict(X=X)
-                if y is not None:
-                    cv_args['y'] = shrinkd(1,np.asarray(y))
-                cv = check_cv(self.cv, classifier=is_classifier(self.estimator), **cv_args)
-                
-        # Do the cross validation fits
+            task_args = fit_args
+            task_folds = folds
+        if self.share_data and plan['n_tasks'] > 0:
+            plan['share_folder'] = tempfile.mkdtemp(prefix='sklearntools_')
+            start_time = time()
+            task_args = _memmap_data(task_args, plan['share_folder'])
+            self.share_time_ = time() - start_time
+        
+        # Create the tasks
 #         print(valmap(lambda x: x.shape, fit_args))
 #         print('num_folds = %d' % self.cv.get_n_splits(X=X))
-        cv_fits = parallel(delayed(_fit_and_predict)(clone(self.estimator), fit_args, train, test, self.verbose) for train, test in cv)
+        tasks = (delayed(cached_call)(cache, fold_keys[i], _fit_and_predict, clone(self.estimator), 
+                                      task_args, task_folds[i][0], task_folds[i][1], self.verbose, 
+                                      time()) 
+                 for i in todo)
+        if refit_task:
+            # The full data fit goes first because it is usually the slowest task
+            full_args = _subset_data(task_args, slice(0, n)) if contiguous else task_args
+            tasks = chain([delayed(cached_call)(cache, full_key, _fit, clone(self.estimator), 
+                                                full_args)], tasks)
+        plan['tasks'] = tasks
+        return plan
+    
+    def _cleanup_fit(self, plan):
+        '''
+        Remove any temporary shared data created by _start_fit.
+        '''
+        plan['tasks'] = None
+        if plan['share_folder'] is not None:
+            shutil.rmtree(plan['share_folder'], ignore_errors=True)
+    
+    def _finish_fit(self, plan, results):
+        '''
+        Do everything in fit that comes after the parallel fold fits.  results should be the 
+        results of running plan['tasks'], in order.
+        '''
+        X = plan['X']
+        y = plan['y']
+        fit_args = plan['fit_args']
+        folds = plan['folds']
+        cv_fits = plan['cv_fits']
+        cache = plan['cache']
+        full_estimator = plan['full_estimator']
+        results = list(results)
+        if plan['refit_task']:
+            full_estimator = results[0]
+            results = results[1:]
+        for i, result in zip(plan['todo'], results):
+            cv_fits[i] = result
+        
+        # Fit on entire data set.  The analytic leave-one-out predictions need this fit too.
+        if self.final_model == 'refit' or (plan['analytic'] and full_estimator is None):
+            full_estimator = cached_call(cache, plan['full_key'], _fit, self.estimator, fit_args)
         
         # Combine predictions from cv fits
         prediction = np.empty_like(y) if y is not None else np.empty(shape=X.shape[0])
-        for fit in cv_fits:
-            safe_assign_subset(prediction, fit[2], fit[1])
+        for (_, test), fit in zip(folds, cv_fits):
+            safe_assign_subset(prediction, test, fit[1])
+        if plan['analytic']:
+            loo_indices = plan['loo_indices']
+            safe_assign_subset(prediction, loo_indices, loo_predict(full_estimator, loo_indices, **fit_args))
+            self.cv_loo_indices_ = loo_indices
         
         # Store cross validation models
         self.cv_estimators_ = [fit[0] for fit in cv_fits]
-        self.cv_indices_ = [fit[2] for fit in cv_fits]
+        self.cv_indices_ = [test for _, test in folds]
         self.cv_predictions_ = prediction
         
+        # Store timing and memory information for each fold
+        self.cv_fold_info_ = [fit[3] for fit in cv_fits]
+        self.fit_times_ = [info['fit_time'] for info in self.cv_fold_info_]
+        self.predict_times_ = [info['predict_time'] for info in self.cv_fold_info_]
+        self.cv_data_nbytes_ = [info['data_nbytes'] for info in self.cv_fold_info_]
+        self.cv_dispatch_latencies_ = [info['dispatch_latency'] for info in self.cv_fold_info_]
+        
         # If a metric was provided, compute the score
         if self.metric is not None:
             metric_args = {}
@@ -97,15 +285,58 @@ class CrossValidatingEstimator(BaseDelegatingEstimator):
                 metric_args['exposure'] = fit_args['exposure']
             self.score_ = safer_call(self.metric, y, self.cv_predictions_, **metric_args)
         
-        # Fit on entire data set
-        self.estimator_ = clone(self.estimator)
-        self.estimator_.fit(**fit_args)
+        # Choose the final model
+        if self.final_model == 'fold_ensemble':
+            n_folds = len(self.cv_estimators_)
+            self.estimator_ = LinearCombination(self.cv_estimators_, [1. / n_folds] * n_folds)
+        else:
+            self.estimator_ = full_estimator
         return self
         
     def fit_predict(self, X, y=None, sample_weight=None, exposure=None):
         self.fit(X=X, y=y, sample_weight=sample_weight, exposure=exposure)
         return self.cv_predictions_.copy()
 
+def check_folds(cv, X, y=None, classifier=False):
+    '''
+    Turn the cv argument of a cross-validating estimator into a list of (train, test) pairs.  
+    cv=1 means no cross-validation (train and test are both the full data set).  Objects with 
+    a split method are used as splitters, and anything else is passed to check_cv.
+    '''
+    if cv == 1:
+        return list(no_cv(X=X, y=y))
+    cv_args = dict(X=X)
+    if hasattr(cv, 'split'):
+        if y is not None:
+            cv_args['y'] = np.ravel(y)
+        return list(cv.split(**cv_args))
+    if y is not None:
+        cv_args['y'] = shrinkd(1,np.asarray(y))
+    return list(check_cv(cv, classifier=classifier, **cv_args))
+
+class PredefinedFolds(object):
+    '''
+    A splitter that always gives the same, precomputed folds.  Used to make several 
+    cross-validating estimators see identical splits.
+    '''
+    def __init__(self, folds):
+        self.folds = folds
+    
+    def get_n_splits(self, X=None, y=None, groups=None):
+        return len(self.folds)
+    
+    def split(self, X=None, y=None, groups=None):
+        return iter(self.folds)
+
+def _complement(rows, n):
+    '''
+    Indices of the rows of an n-row data set that are not in rows (an index array or boolean mask).
+    '''
+    rows = np.asarray(rows)
+    if rows.dtype == bool:
+        return np.where(~rows)[0]
+    return np.setdiff1d(np.arange(n), rows)
+
 @s2c_sym_predict.register(CrossValidatingEstimator)
 def s2c_sym_predict_cross_validating_estimator(estimator):
     return s2c_sym_predict(estimator.estimator_)
@@ -128,9 +359,63 @@ class ThresholdStratifiedKFold(object):
         for train, test in self.stratified.split(X, y_thresh):
             yield train, test
         
+class ContiguousKFold(object):
+    '''
+    K-fold cross-validation whose train and test sets are contiguous blocks of rows.  The data 
+    are permuted once into the row order given by layout, which is the permutation followed by 
+    a repeat of its leading rows.  In that layout each test set is a block of the permutation 
+    and the corresponding train set is the block that wraps around after it, so split_slices 
+    can describe both with slice objects and _subset returns views instead of copies.  
+    The split method gives the same folds as index arrays into the unpermuted data.
+    '''
+    def __init__(self, n_folds=3, shuffle=True, random_state=None):
+        self.n_folds = n_folds
+        self.shuffle = shuffle
+        self.random_state = random_state
+    
+    def get_n_splits(self, X=None, y=None, groups=None):
+        return self.n_folds
+    
+    def _bounds(self, n):
+        sizes = np.full(self.n_folds, n // self.n_folds, dtype=int)
+        sizes[:n % self.n_folds] += 1
+        return np.concatenate([[0], np.cumsum(sizes)])
+    
+    def permutation(self, n):
+        order = np.arange(n)
+        if self.shuffle:
+            check_random_state(self.random_state).shuffle(order)
+        return order
+    
+    def layout(self, n):
+        '''
+        Row order of the permuted copy of an n-row data set that split_slices refers to.  With 
+        random_state=None every call gives a different permutation.
+        '''
+        order = self.permutation(n)
+        return np.concatenate([order, order[:self._bounds(n)[-2]]])
+    
+    def split_slices(self, n):
+        '''
+        Yield (train, test) slices into the rows of the layout.
+        '''
+        bounds = self._bounds(n)
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            yield slice(stop, start + n), slice(start, stop)
+    
+    def split(self, X, y=None, groups=None):
+        n = X.shape[0]
+        layout = self.layout(n)
+        for train, test in self.split_slices(n):
+            yield layout[train], layout[test]
+        
 class HybridCV(with_metaclass(ABCMeta, BaseCrossValidator)):
+    '''
+    Leave-one-out for the rows chosen by choose_loo, k-fold for everything else.  Splits are 
+    generated as index arrays, so leave-one-out test sets cost one element each.
+    '''
     @abstractmethod
-    def choose_loo(self, y):
+    def choose_loo(self, X, y=None, groups=None):
         pass
     
     def __init__(self, n_folds, shuffle=True, **kwargs):
@@ -141,18 +426,40 @@ class HybridCV(with_metaclass(ABCMeta, BaseCrossValidator)):
     def get_n_splits(self, X, y, groups):
         pass
     
-    def _iter_test_masks(self, X=None, y=None, groups=None):
+    def _iter_kfold_test_indices(self, X, y, groups, loo_indices):
+        for test in self.base_kfold._iter_test_indices(X=X, y=y, groups=groups):
+            test = np.setdiff1d(test, loo_indices, assume_unique=True)
+            if len(test) > 0:
+                yield test
+    
+    def _iter_test_indices(self, X=None, y=None, groups=None):
         loo_indices = self.choose_loo(X, y, groups)
-        not_loo_mask = np.ones(X.shape[0], dtype=bool)
         for idx in loo_indices:
+            yield np.array([idx])
+        for test in self._iter_kfold_test_indices(X, y, groups, loo_indices):
+            yield test
+    
+    def _iter_test_masks(self, X=None, y=None, groups=None):
+        for test in self._iter_test_indices(X, y, groups):
             result = np.zeros(X.shape[0], dtype=bool)
-            result[idx] = True
-            not_loo_mask[idx] = False
+            result[test] = True
             yield result
-        for result in self.base_kfold._iter_test_masks(X=X, y=y, groups=groups):
-            result_ = (result & not_loo_mask)
-            if np.any(result_!=0):
-                return result_
+    
+    def _split_indices(self, X, tests):
+        indices = np.arange(X.shape[0])
+        for test in tests:
+            yield np.delete(indices, test), test
+    
+    def split(self, X, y=None, groups=None):
+        return self._split_indices(X, self._iter_test_indices(X, y, groups))
+    
+    def split_kfold(self, X, y=None, groups=None):
+        '''
+        Like split, but skip the leave-one-out splits.  Training sets still include the rows 
+        chosen by choose_loo.
+        '''
+        loo_indices = self.choose_loo(X, y, groups)
+        return self._split_indices(X, self._iter_kfold_test_indices(X, y, groups, loo_indices))
     
 def all_false_predicate(X, y=None, groups=None):
     return np.zeros(shape=X.shape[0], dtype=bool)
@@ -193,7 +500,7 @@ class ThresholdHybridCV(HybridCV):
     def get_n_splits(self, X, y, groups=None):
         return np.sum((y > self.upper) | (y < self.lower)) + self.n_folds
     
-    def choose_loo(self, X, y, groups):
+    def choose_loo(self, X, y, groups=None):
         return np.where((y > self.upper) | (y < self.lower))[0]
     
     
@@ -1,5 +1,6 @@
 from toolz.functoolz import curry
 import math
+import numpy as np
 
 @curry
 def golden_section_search(tolerance, lower, upper, f, start, direction):
@@ -39,3 +40,85 @@ def zoom_search(searcher, zoomer, f, start, direction):
     return searcher(0., zoomer(f, start, direction), f, start, direction)
 
 
+
+# The batched searches below call f once per round with a whole set of candidate steps.  f 
+# receives an array whose last axis runs over candidate steps (n x s when start and direction 
+# have n elements) and must return the s losses, for example by summing over axis 0.  They 
+# return the step along with the number of candidate steps evaluated, and stop early if that 
+# number would exceed max_evaluations.
+
+def _batched_candidates(start, direction, steps):
+    return np.expand_dims(np.asarray(start), -1) + np.expand_dims(np.asarray(direction), -1) * steps
+
+@curry
+def batched_grid_search(n_points, tolerance, lower, upper, f, start, direction, max_evaluations=None):
+    '''
+    Evaluate f at n_points evenly spaced steps covering [lower, upper], then repeatedly at 
+    n_points new steps spread over the interval between the neighbours of the best step so far, 
+    until that interval is narrower than tolerance or stops shrinking.  Each round shrinks the interval by a factor 
+    of about n_points / 2 + 1, so fewer rounds (and calls to f) are needed than with 
+    golden_section_search.  Returns the best step evaluated and the number of evaluations.
+    '''
+    if n_points < 2:
+        raise ValueError('n_points must be at least 2.  Got %s.' % str(n_points))
+    n_first = n_points if max_evaluations is None else max(min(n_points, max_evaluations), 1)
+    steps = np.linspace(lower, upper, n_first) if n_first > 1 else np.array([(lower + upper) / 2.])
+    losses = np.asarray(f(_batched_candidates(start, direction, steps)), dtype=float)
+    n_evaluations = n_first
+    width = np.inf
+    while True:
+        best = int(np.argmin(losses))
+        a = steps[max(best - 1, 0)]
+        b = steps[min(best + 1, steps.shape[0] - 1)]
+        
+        # Far from zero, tolerance may be finer than floating point spacing, in which case the 
+        # interval eventually stops shrinking
+        if abs(b - a) <= tolerance or not abs(b - a) < width:
+            break
+        width = abs(b - a)
+        n_new = n_points
+        if max_evaluations is not None:
+            n_new = min(n_new, max_evaluations - n_evaluations)
+            if n_new < 1:
+                break
+        
+        # New steps go on either side of the best one, which (like the ends of the interval) has 
+        # already been evaluated
+        center = steps[best]
+        n_left = 0 if center == a else n_new if center == b else n_new // 2
+        inside = np.concatenate([np.linspace(a, center, n_left + 2)[1:-1], 
+                                 np.linspace(center, b, n_new - n_left + 2)[1:-1]])
+        inside_losses = np.asarray(f(_batched_candidates(start, direction, inside)), dtype=float)
+        n_evaluations += n_new
+        keep = (steps >= a) & (steps <= b)
+        steps = np.concatenate([steps[keep], inside])
+        losses = np.concatenate([losses[keep], inside_losses])
+        steps, unique = np.unique(steps, return_index=True)
+        losses = losses[unique]
+    return steps[int(np.argmin(losses))], n_evaluations
+
+@curry
+def batched_zoom(first_step, max_steps, step_factor, f, start, direction):
+    '''
+    The batched counterpart of zoom.  Evaluates f at step 0 and at first_step * step_factor ** k 
+    for k = 0, ..., max_steps in a single call, and returns the interval between the 
+    neighbours of the best of those steps (so that it contains the minimum if the loss is 
+    unimodal along direction) and the number of evaluations.
+    '''
+    steps = np.concatenate([[0.], first_step * step_factor ** np.arange(max_steps + 1, dtype=float)])
+    losses = np.asarray(f(_batched_candidates(start, direction, steps)), dtype=float)
+    best = int(np.argmin(losses))
+    return steps[max(best - 1, 0)], steps[min(best + 1, steps.shape[0] - 1)], steps.shape[0]
+
+def batched_zoom_search(searcher, zoomer, f, start, direction, max_evaluations=None):
+    '''
+    Bracket the minimum with zoomer (such as batched_zoom(1., 20, 2.)) and then find it with 
+    searcher (such as batched_grid_search(8, 1e-8)).  Returns the step and the total number 
+    of evaluations, which is at most max_evaluations apart from those used by zoomer.
+    '''
+    lower, upper, n_zoom = zoomer(f, start, direction)
+    remaining = None if max_evaluations is None else max(max_evaluations - n_zoom, 0)
+    if remaining == 0:
+        return lower + (upper - lower) / 2., n_zoom
+    step, n_search = searcher(lower, upper, f, start, direction, max_evaluations=remaining)
+    return step, n_zoom + n_search
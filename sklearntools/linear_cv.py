@@ -0,0 +1,165 @@
+'''
+Cross-validation shortcuts for linear models.  Instead of refitting a linear model once per
+fold, these functions get the same (or approximately the same) predictions from algebra on a
+single fit.
+'''
+import numpy as np
+from sklearn.linear_model.base import LinearRegression
+from sklearn.base import clone
+from .sklearntools import safer_call
+
+loo_predict_dispatcher = {}
+
+def register_loo_predict(cls, function):
+    loo_predict_dispatcher[cls] = function
+    return function
+
+def _registered_loo_predict(estimator):
+    for klass in type(estimator).mro():
+        if klass in loo_predict_dispatcher:
+            return loo_predict_dispatcher[klass]
+    return None
+
+def has_loo_predict(estimator):
+    '''
+    True if analytic leave-one-out predictions are available for estimator, either through a
+    loo_predict method or a function registered with register_loo_predict.
+    '''
+    return hasattr(estimator, 'loo_predict') or _registered_loo_predict(estimator) is not None
+
+def loo_predict(estimator, indices, X, y, sample_weight=None, exposure=None):
+    '''
+    Given an estimator already fit on X and y, return for each row in indices the prediction
+    of the estimator fit on all rows except that one.
+    '''
+    args = dict(X=X, y=y, indices=indices, sample_weight=sample_weight, exposure=exposure)
+    if hasattr(estimator, 'loo_predict'):
+        return safer_call(estimator.loo_predict, **args)
+    fn = _registered_loo_predict(estimator)
+    if fn is None:
+        raise TypeError('Analytic leave-one-out predictions are not available for %s.' %
+                        type(estimator).__name__)
+    return safer_call(fn, estimator, **args)
+
+def _design(X, intercept):
+    X = np.asarray(X, dtype=np.float64)
+    if len(X.shape) == 1:
+        X = X[:, None]
+    if intercept:
+        X = np.concatenate([np.ones(shape=(X.shape[0], 1)), X], axis=1)
+    return X
+
+def leverage(X, weights, indices):
+    '''
+    Diagonal of the weighted hat matrix W^(1/2) X (X^T W X)^-1 X^T W^(1/2) at the rows in indices.
+    Only the requested diagonal elements are computed.
+    '''
+    gram_inverse = np.linalg.pinv(np.dot(X.T * weights, X))
+    rows = X[indices]
+    return weights[indices] * np.einsum('ij,jk,ik->i', rows, gram_inverse, rows)
+
+def loo_predict_linear_regression(estimator, X, y, indices, sample_weight=None):
+    '''
+    Exact leave-one-out predictions for (weighted) least squares, using the identity
+    y_i - e_i / (1 - h_ii) where e_i is the residual and h_ii the leverage of row i.
+    '''
+    design = _design(X, estimator.fit_intercept)
+    if sample_weight is None:
+        weights = np.ones(design.shape[0])
+    else:
+        weights = np.ravel(np.asarray(sample_weight, dtype=np.float64))
+    h = leverage(design, weights, indices)
+    y = np.asarray(y, dtype=np.float64)[indices]
+    residual = y - estimator.predict(np.asarray(X)[indices]).reshape(y.shape)
+    h = h.reshape((-1,) + (1,) * (len(residual.shape) - 1))
+    return y - residual / (1. - h)
+
+register_loo_predict(LinearRegression, loo_predict_linear_regression)
+
+class SufficientStatistics(object):
+    '''
+    Accumulates X^T W X and X^T W y for a weighted least squares problem in one pass over the
+    data.  The least squares fit on all rows except some subset is then obtained by subtracting
+    that subset's contribution, so the fits for all k folds of a cross-validation cost about
+    as much as one fit.
+    '''
+    def __init__(self, X, y, sample_weight=None, intercept=True):
+        self.X = np.asarray(X, dtype=np.float64)
+        if len(self.X.shape) == 1:
+            self.X = self.X[:, None]
+        self.y = np.asarray(y, dtype=np.float64)
+        if sample_weight is None:
+            self.weights = None
+        else:
+            self.weights = np.ravel(np.asarray(sample_weight, dtype=np.float64))
+        self.intercept = intercept
+        self.gram, self.moment = self._accumulate(self.X, self.y, self.weights)
+
+    def _accumulate(self, X, y, weights):
+        design = _design(X, self.intercept)
+        weighted = design.T if weights is None else design.T * weights
+        return np.dot(weighted, design), np.dot(weighted, y)
+
+    def solve(self, rows=None):
+        '''
+        Least squares coefficients fit on all rows except those in rows (an index array or
+        boolean mask).  If there is an intercept, it is the first coefficient.
+        '''
+        gram = self.gram
+        moment = self.moment
+        if rows is not None:
+            weights = None if self.weights is None else self.weights[rows]
+            fold_gram, fold_moment = self._accumulate(self.X[rows], self.y[rows], weights)
+            gram = gram - fold_gram
+            moment = moment - fold_moment
+        return np.dot(np.linalg.pinv(gram), moment)
+
+downdate_fits_dispatcher = {}
+
+def register_downdate_fits(cls, function):
+    downdate_fits_dispatcher[cls] = function
+    return function
+
+def _registered_downdate_fits(estimator):
+    for klass in type(estimator).mro():
+        if klass in downdate_fits_dispatcher:
+            return downdate_fits_dispatcher[klass]
+    return None
+
+def has_downdate_fits(estimator):
+    '''
+    True if cross-validation fold fits for estimator can be computed by downdating sufficient
+    statistics, either through a downdate_fits method or a function registered with
+    register_downdate_fits.
+    '''
+    return hasattr(estimator, 'downdate_fits') or _registered_downdate_fits(estimator) is not None
+
+def downdate_fits(estimator, holdouts, X, y, sample_weight=None, exposure=None):
+    '''
+    Return a list of fitted clones of estimator, one for each element of holdouts (index arrays
+    or boolean masks), each fit on all rows except those in its holdout.
+    '''
+    args = dict(X=X, y=y, holdouts=holdouts, sample_weight=sample_weight, exposure=exposure)
+    if hasattr(estimator, 'downdate_fits'):
+        return safer_call(estimator.downdate_fits, **args)
+    fn = _registered_downdate_fits(estimator)
+    if fn is None:
+        raise TypeError('Downdated fold fits are not available for %s.' % type(estimator).__name__)
+    return safer_call(fn, estimator, **args)
+
+def downdate_fits_linear_regression(estimator, X, y, holdouts, sample_weight=None):
+    stats = SufficientStatistics(X, y, sample_weight, intercept=estimator.fit_intercept)
+    result = []
+    for holdout in holdouts:
+        coef = stats.solve(holdout)
+        estimator_ = clone(estimator)
+        if estimator.fit_intercept:
+            estimator_.intercept_ = coef[0]
+            estimator_.coef_ = coef[1:].T
+        else:
+            estimator_.intercept_ = 0.
+            estimator_.coef_ = coef.T
+        result.append(estimator_)
+    return result
+
+register_downdate_fits(LinearRegression, downdate_fits_linear_regression)
@@ -1,17 +1,236 @@
 from .sklearntools import BaseDelegatingEstimator,\
-    non_fit_methods, safer_call, sym_methods
+    non_fit_methods, safer_call, sym_methods, _memmap_data, _subset_data,\
+    StagedEstimator
 from sklearn.base import clone
+from sklearn.model_selection import ParameterGrid
+from sklearn.externals.joblib import hash as joblib_hash
+from collections import defaultdict, OrderedDict
+import threading
 from sklearn.metrics.scorer import check_scoring
+from sklearn.externals.joblib.parallel import Parallel, delayed
+import tempfile
+import shutil
+from time import time
+import numpy as np
+from sklearn.utils import check_random_state
 
-def candidate_grid(estimator, param_grid):
-    pass
+class PrefixCache(object):
+    '''
+    An in-memory store of fitted leading stages, and the data they produce, shared by the 
+    SharedPrefixStagedEstimators created by candidate_grid.  Copies and clones of a 
+    PrefixCache are the same object, so cloned candidates keep sharing it.  A PrefixCache 
+    sent to another process arrives empty, so reuse only happens among candidates fit in the 
+    same process (n_jobs=1 or the threading backend).  ModelSelector clears the caches of its 
+    candidates at the end of each fit.
+    
+    max_entries : int or None, optional (default=32)
+        If not None, the least recently used entries are evicted whenever there are more than 
+        max_entries of them.
+    '''
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.fingerprints = {}
+        self.lock = threading.Lock()
+    
+    def __copy__(self):
+        return self
+    
+    def __deepcopy__(self, memo):
+        return self
+    
+    def __getstate__(self):
+        return {'max_entries': self.max_entries}
+    
+    def __setstate__(self, state):
+        self.__init__(state['max_entries'])
+    
+    def fingerprint(self, data):
+        '''
+        A hash of the data dict.  Each distinct set of arrays is hashed only once, so the 
+        candidates fit on the same data don't each hash all of it.  The arrays must not be 
+        modified in place while the cache is in use.
+        '''
+        identity = tuple(sorted((name, _memory_identity(value)) for name, value in data.items()))
+        with self.lock:
+            entry = self.fingerprints.get(identity)
+        if entry is not None:
+            return entry[1]
+        result = joblib_hash(data)
+        with self.lock:
+            # Keeping the arrays alive keeps their memory from being reused by other arrays
+            if self.max_entries is not None and len(self.fingerprints) >= self.max_entries:
+                self.fingerprints.clear()
+            self.fingerprints[identity] = (list(data.values()), result)
+        return result
+    
+    def key(self, stages, fingerprint):
+        return joblib_hash((tuple((type(stage), stage.get_params()) for stage in stages), fingerprint))
+    
+    def get(self, key):
+        with self.lock:
+            result = self.entries.get(key)
+            if result is not None:
+                # Mark the entry as recently used
+                del self.entries[key]
+                self.entries[key] = result
+            return result
+    
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while self.max_entries is not None and len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.fingerprints.clear()
+
+def _memory_identity(value):
+    '''
+    Something that identifies the memory holding value, so that different views of the same 
+    array (such as the column vectors made by _process_args) are recognized.
+    '''
+    if isinstance(value, np.ndarray):
+        return (value.__array_interface__['data'][0], value.shape, value.strides, value.dtype.str)
+    return id(value)
+
+class SharedPrefixStagedEstimator(StagedEstimator):
+    '''
+    A StagedEstimator that looks up its longest already fitted prefix of intermediate stages 
+    (same classes, same parameters, same data) in prefix_cache before fitting, and stores 
+    each prefix it fits.  Candidates that differ only in later stages therefore fit their 
+    common leading stages once.
+    '''
+    def __init__(self, stages, prefix_cache=None):
+        super(SharedPrefixStagedEstimator, self).__init__(stages)
+        self.prefix_cache = prefix_cache
+    
+    def fit_update(self, data):
+        if self.prefix_cache is None:
+            return super(SharedPrefixStagedEstimator, self).fit_update(data)
+        fingerprint = self.prefix_cache.fingerprint(data)
+        keys = [self.prefix_cache.key(self.intermediate_stages[:i + 1], fingerprint) 
+                for i in range(len(self.intermediate_stages))]
+        
+        # Start from the longest prefix that has already been fit
+        self.intermediate_stages_ = []
+        start = 0
+        for i in reversed(range(len(keys))):
+            entry = self.prefix_cache.get(keys[i])
+            if entry is not None:
+                stages_, prefix_data = entry
+                self.intermediate_stages_ = list(stages_)
+                data = dict(prefix_data)
+                start = i + 1
+                break
+        
+        # Fit the rest, storing each new prefix
+        for i in range(start, len(keys)):
+            self.intermediate_stages_.append(self._fit_stage(self.intermediate_stages[i], data))
+            self.prefix_cache.set(keys[i], (list(self.intermediate_stages_), dict(data)))
+        return data
+
+def candidate_grid(estimator, param_grid, share_prefixes=True):
+    '''
+    Expand estimator and param_grid into a list of (name, candidate) pairs suitable for 
+    ModelSelector.  The keys of param_grid (a dict or list of dicts, as for 
+    sklearn's ParameterGrid) have the form <stage index>__<parameter>, where stage index 
+    refers to estimator.stages.  A non-staged estimator is treated as a single stage.
+    
+    If share_prefixes is True, the candidates are SharedPrefixStagedEstimators with a common 
+    PrefixCache, so leading stages that are identical across candidates are fit once and 
+    their output reused by every downstream variant.
+    '''
+    stages = list(estimator.stages) if isinstance(estimator, StagedEstimator) else [estimator]
+    prefix_cache = PrefixCache() if share_prefixes else None
+    result = []
+    for params in ParameterGrid(param_grid):
+        stage_params = defaultdict(dict)
+        for key, value in params.items():
+            index, _, name = key.partition('__')
+            try:
+                index = int(index)
+            except ValueError:
+                index = None
+            if index is None or not name or not 0 <= index < len(stages):
+                raise ValueError('Parameter names must have the form <stage index>__<parameter> '
+                                 'with a valid stage index.  Got %s.' % key)
+            stage_params[index][name] = value
+        candidate_stages = [clone(stage).set_params(**stage_params[i]) if i in stage_params else stage 
+                            for i, stage in enumerate(stages)]
+        name = ', '.join('%s=%r' % item for item in sorted(params.items()))
+        result.append((name, SharedPrefixStagedEstimator(candidate_stages, prefix_cache)))
+    return result
+
+def _fit_and_score_candidate(candidate, candidate_name, method, fit_args, scoring, verbose):
+    if verbose:
+        print('Fitting candidate: %s' % candidate_name)
+    scorer = check_scoring(candidate, scoring=scoring)
+    
+    # Do the actual fitting and scoring
+    start_time = time()
+    candidate_ = clone(candidate)
+    output = getattr(candidate_, method)(**fit_args)
+    fit_time = time() - start_time
+    if scoring is None and hasattr(candidate_, 'score_'):
+        score = candidate_.score_
+    else:
+        score = safer_call(scorer, candidate_, **fit_args)
+    return candidate_, output, score, fit_time
 
 class ModelSelector(BaseDelegatingEstimator):
-    def __init__(self, candidates, scoring=None, verbose=False):
+    def __init__(self, candidates, scoring=None, verbose=False, n_jobs=1, 
+                 pre_dispatch='2*n_jobs', backend=None, racing=False, min_samples=.1, 
+                 eta=3, random_state=None):
+        '''
+        n_jobs : int, optional (default=1)
+            The number of candidates to fit and score concurrently.
+        
+        pre_dispatch : int or str, optional (default='2*n_jobs')
+            Passed to joblib's Parallel.
+        
+        backend : str, optional (default=None)
+            The joblib backend to use, such as 'multiprocessing' or 'threading'.  None means 
+            joblib's default.  For process based backends the data are written once to a 
+            temporary memory mapped store that all workers share.
+        
+        racing : bool, optional (default=False)
+            If True, select by successive halving.  All candidates are first fit and scored on 
+            a random subsample of min_samples rows.  Only the best 1/eta of them survive to 
+            the next round, which uses eta times as many rows.  This repeats until one 
+            candidate is left or the next subsample would not be smaller than the data.  Only 
+            the survivors are fit on the full data.  The rounds are recorded in race_history_.  
+            The fraction of row-fits avoided, compared with fitting every candidate on all 
+            rows, is stored in compute_saved_.
+        
+        min_samples : int or float, optional (default=.1)
+            The subsample size for the first racing round, as a number of rows or a fraction 
+            of the rows.
+        
+        eta : float, optional (default=3)
+            The factor by which the number of candidates shrinks, and the subsample grows, in 
+            each racing round.
+        
+        random_state : int, RandomState, or None, optional (default=None)
+            Used to draw the racing subsamples.
+        
+        Whatever the order in which candidates finish, best_estimator_ is the first candidate 
+        (in the order given) with the highest score.
+        '''
         self.candidates = candidates
         self._process_candidates(candidates)
         self.scoring = scoring
         self.verbose = verbose
+        self.n_jobs = n_jobs
+        self.pre_dispatch = pre_dispatch
+        self.backend = backend
+        self.racing = racing
+        self.min_samples = min_samples
+        self.eta = eta
+        self.random_state = random_state
     
     def _process_candidates(self, candidates):
         '''
@@ -26,6 +245,7 @@ class ModelSelector(BaseDelegatingEstimator):
         if not converted:
             try:
                 pairs = [(cand[0], cand[1]) for cand in candidates]
+                converted = True
             except IndexError:
                 pass
             except TypeError:
@@ -64,30 +284,36 @@ class ModelSelector(BaseDelegatingEstimator):
         if 'sample_weight' in predict_args:
             del predict_args['sample_weight']
         
-        # Find the best scoring candidate
+        # Optionally eliminate candidates by racing them on subsamples
+        n_candidates = len(self.candidate_models)
+        try:
+            if self.racing:
+                finalists = self._race(fit_args)
+            else:
+                finalists = list(range(n_candidates))
+            
+            # Fit and score the remaining candidates on all the data
+            results = self._fit_candidates(method, fit_args, finalists)
+        finally:
+            # Shared prefixes are only useful during the fit, and they hold copies of the data
+            for candidate in self.candidate_models:
+                prefix_cache = getattr(candidate, 'prefix_cache', None)
+                if prefix_cache is not None:
+                    prefix_cache.clear()
+        
+        # Find the best scoring candidate.  Results are in candidate order, so ties always go 
+        # to the earliest candidate.  Candidates eliminated in a race have None for their 
+        # fitted model, score, and fit time.
         best_score = float('-inf')
         best_candidate = None
-        self.candidates_ = []
-        self.candidate_scores_ = []
-        outputs = []
-        for i, candidate in enumerate(self.candidate_models):
-            candidate_name = self.candidate_names[i]
-            if self.verbose:
-                print('Fitting candidate: %s' % candidate_name)
-            scorer = check_scoring(candidate, scoring=self.scoring)
-            
-            # Do the actual fitting and scoring
-            candidate_ = clone(candidate)
-            output = getattr(candidate_, method)(**fit_args)
-            outputs.append(output)
-            if self.scoring is None and hasattr(candidate_, 'score_'):
-                score = candidate_.score_
-            else:
-                score = safer_call(scorer, candidate_, **fit_args)
-                    
+        self.candidates_ = [None] * n_candidates
+        self.candidate_scores_ = [None] * n_candidates
+        self.candidate_fit_times_ = [None] * n_candidates
+        for i, (candidate_, output, score, fit_time) in zip(finalists, results):
             # Store the results
-            self.candidate_scores_.append(score)
-            self.candidates_.append(candidate_)
+            self.candidate_scores_[i] = score
+            self.candidates_[i] = candidate_
+            self.candidate_fit_times_[i] = fit_time
             
             # If it's the best so far, keep it
             if score > best_score:
@@ -95,7 +321,7 @@ class ModelSelector(BaseDelegatingEstimator):
                 best_candidate = candidate_
                 best_candidate_index = i
                 best_output = output
-                best_candidate_name = candidate_name
+                best_candidate_name = self.candidate_names[i]
         
         self.best_estimator_ = best_candidate
         self.best_score_ = best_score
@@ -106,6 +332,75 @@ class ModelSelector(BaseDelegatingEstimator):
         self._create_delegates('best_estimator', non_fit_methods + sym_methods)
         return best_output
         
+    def _fit_candidates(self, method, fit_args, indices):
+        '''
+        Fit and score the candidates at the given indices.  Returns a list of (fitted candidate, 
+        method output, score, fit time) tuples in the same order as indices.
+        '''
+        parallel_args = dict(n_jobs=self.n_jobs, verbose=self.verbose, 
+                             pre_dispatch=self.pre_dispatch, max_nbytes=None)
+        if self.backend is not None:
+            parallel_args['backend'] = self.backend
+        share_folder = None
+        if self.n_jobs != 1 and self.backend != 'threading':
+            share_folder = tempfile.mkdtemp(prefix='sklearntools_')
+        try:
+            shared_args = fit_args if share_folder is None else _memmap_data(fit_args, share_folder)
+            return Parallel(**parallel_args)(delayed(_fit_and_score_candidate)(self.candidate_models[i], 
+                                                                               self.candidate_names[i], 
+                                                                               method, shared_args, 
+                                                                               self.scoring, self.verbose)
+                                             for i in indices)
+        finally:
+            if share_folder is not None:
+                shutil.rmtree(share_folder, ignore_errors=True)
+    
+    def _race(self, fit_args):
+        '''
+        Run the racing rounds and return the indices of the surviving candidates.
+        '''
+        n = fit_args['X'].shape[0]
+        n_candidates = len(self.candidate_models)
+        if self.eta <= 1:
+            raise ValueError('eta must be greater than 1.  Got %s.' % str(self.eta))
+        if isinstance(self.min_samples, float):
+            n_samples = int(np.ceil(self.min_samples * n))
+        else:
+            n_samples = int(self.min_samples)
+        random_state = check_random_state(self.random_state)
+        survivors = list(range(n_candidates))
+        self.race_history_ = []
+        sample_fits = 0
+        while len(survivors) > 1 and n_samples < n:
+            rows = np.sort(random_state.choice(n, size=n_samples, replace=False))
+            if self.verbose:
+                print('Racing %d candidates on %d rows' % (len(survivors), n_samples))
+            start_time = time()
+            results = self._fit_candidates('fit', _subset_data(fit_args, rows), survivors)
+            round_time = time() - start_time
+            sample_fits += n_samples * len(survivors)
+            
+            # Keep the best scoring candidates.  The sort is stable so ties go to earlier 
+            # candidates, and nan scores sort last.
+            scores = [result[2] for result in results]
+            n_keep = max(1, int(np.ceil(len(survivors) / float(self.eta))))
+            order = np.argsort(-np.asarray(scores, dtype=float), kind='mergesort')
+            kept = sorted(order[:n_keep])
+            self.race_history_.append({'n_samples': n_samples, 
+                                       'candidates': [self.candidate_names[i] for i in survivors],
+                                       'scores': scores,
+                                       'eliminated': [self.candidate_names[survivors[j]] 
+                                                      for j in sorted(order[n_keep:])],
+                                       'time': round_time})
+            survivors = [survivors[j] for j in kept]
+            n_samples = int(n_samples * self.eta)
+        
+        # Record how much work was avoided, measured in rows used for fitting
+        sample_fits += n * len(survivors)
+        self.race_sample_fits_ = sample_fits
+        self.compute_saved_ = 1. - float(sample_fits) / (n * n_candidates)
+        return survivors
+    
     def fit(self, X, y=None, sample_weight=None, exposure=None):
         return self._run_fit('fit', X=X, y=y, sample_weight=sample_weight, exposure=exposure)
     
@@ -0,0 +1,139 @@
+'''
+Fast evaluation of fitted linear combinations of decision trees, such as the estimator_ of a
+GradientBoostingEstimator with tree base estimators.  All trees are packed into a few
+contiguous arrays and evaluated together, one tree level at a time, instead of calling predict
+on each tree.
+'''
+import numpy as np
+from sklearn.tree.tree import DecisionTreeRegressor
+from .sklearntools import STSimpleEstimator, LinearCombination, StagedEstimator,\
+    ColumnSubsetTransformer
+
+def _tree_parts(estimator):
+    '''
+    If estimator is a fitted single output DecisionTreeRegressor, possibly behind a
+    ColumnSubsetTransformer with integer columns, return its tree_ and an array mapping the
+    tree's feature indices to columns of the original data (or None for the identity).
+    Otherwise return None.
+    '''
+    if isinstance(estimator, StagedEstimator):
+        stages = getattr(estimator, 'intermediate_stages_', None)
+        if stages is None or len(stages) != 1 or not isinstance(stages[0], ColumnSubsetTransformer):
+            return None
+        subsetter = stages[0]
+        if (subsetter.y_cols is not None or subsetter.sample_weight_cols is not None or
+            subsetter.exposure_cols is not None):
+            return None
+        columns = np.asarray(subsetter.x_cols)
+        if columns.ndim != 1 or columns.dtype.kind not in 'iu':
+            return None
+        parts = _tree_parts(estimator.final_stage_)
+        if parts is None:
+            return None
+        tree, mapping = parts
+        return tree, (columns if mapping is None else columns[mapping])
+    tree = getattr(estimator, 'tree_', None)
+    if isinstance(estimator, DecisionTreeRegressor) and tree is not None and tree.n_outputs == 1:
+        return tree, None
+    return None
+
+class PackedTreeEnsemble(STSimpleEstimator):
+    '''
+    A fitted weighted sum of decision trees stored as flat arrays.  Node i splits on column
+    feature[i] at threshold[i] and has children children_left[i] and children_right[i].  Leaves
+    are their own children, with an infinite threshold, and value[i] is the leaf value with the
+    tree's coefficient folded in.  roots holds the index of each tree's root and max_depth the
+    depth of the deepest tree.  remainder, if not None, is a LinearCombination of the terms
+    that aren't trees, and is added to the result.  Use pack_trees to create one.
+    '''
+    def __init__(self, roots, feature, threshold, children_left, children_right, value,
+                 max_depth, remainder=None, chunk_size=2 ** 20):
+        self.roots = roots
+        self.feature = feature
+        self.threshold = threshold
+        self.children_left = children_left
+        self.children_right = children_right
+        self.value = value
+        self.max_depth = max_depth
+        self.remainder = remainder
+        self.chunk_size = chunk_size
+
+    def fit(self, X, y=None, sample_weight=None, exposure=None):
+        raise NotImplementedError('Packed tree ensembles should only be created after fitting.')
+
+    def predict(self, X, exposure=None):
+        # Trees compare single precision inputs against their thresholds
+        data = np.asarray(X, dtype=np.float32)
+        if len(data.shape) == 1:
+            data = data[:, None]
+        n_rows = data.shape[0]
+        result = np.zeros(n_rows)
+        n_trees = self.roots.shape[0]
+        if n_trees > 0:
+            # Work on blocks of rows so the node index array stays at most chunk_size elements
+            block = max(1, self.chunk_size // n_trees)
+            for start in range(0, n_rows, block):
+                rows = data[start:start + block]
+                row_index = np.arange(rows.shape[0])[:, None]
+                nodes = np.tile(self.roots, (rows.shape[0], 1))
+                for _ in range(self.max_depth):
+                    left = rows[row_index, self.feature[nodes]] <= self.threshold[nodes]
+                    nodes = np.where(left, self.children_left[nodes], self.children_right[nodes])
+                result[start:start + block] = self.value[nodes].sum(axis=1)
+        if self.remainder is not None:
+            args = {'X': X}
+            if exposure is not None:
+                args['exposure'] = exposure
+            result += np.ravel(self.remainder.predict(**args))
+        return result
+
+def pack_trees(estimator):
+    '''
+    Compile a fitted LinearCombination into a PackedTreeEnsemble.  Terms that are single output
+    DecisionTreeRegressors (alone, or behind a ColumnSubsetTransformer with integer columns, as
+    produced by GradientBoostingEstimator with max_features) are packed.  Any other terms are
+    kept in a LinearCombination and evaluated as usual.
+    '''
+    offset = 0
+    roots = []
+    features = []
+    thresholds = []
+    lefts = []
+    rights = []
+    values = []
+    max_depth = 0
+    other_estimators = []
+    other_coefficients = []
+    for coefficient, term in zip(estimator.coefficients, estimator.estimators):
+        parts = _tree_parts(term)
+        if parts is None:
+            other_estimators.append(term)
+            other_coefficients.append(coefficient)
+            continue
+        tree, mapping = parts
+        n_nodes = tree.node_count
+        left = tree.children_left[:n_nodes].astype(np.intp)
+        right = tree.children_right[:n_nodes].astype(np.intp)
+        leaf = left == -1
+        own = np.arange(n_nodes)
+        feature = np.where(leaf, 0, tree.feature[:n_nodes]).astype(np.intp)
+        if mapping is not None:
+            feature = np.where(leaf, 0, mapping[feature])
+        roots.append(offset)
+        features.append(feature)
+        thresholds.append(np.where(leaf, np.inf, tree.threshold[:n_nodes]))
+        lefts.append(np.where(leaf, own, left) + offset)
+        rights.append(np.where(leaf, own, right) + offset)
+        values.append(coefficient * tree.value[:n_nodes, 0, 0])
+        max_depth = max(max_depth, tree.max_depth)
+        offset += n_nodes
+    concat = lambda parts, dtype: (np.ascontiguousarray(np.concatenate(parts), dtype=dtype) if parts
+                                   else np.zeros(0, dtype=dtype))
+    remainder = LinearCombination(other_estimators, other_coefficients) if other_estimators else None
+    return PackedTreeEnsemble(roots=np.asarray(roots, dtype=np.intp),
+                              feature=concat(features, np.intp),
+                              threshold=concat(thresholds, np.float64),
+                              children_left=concat(lefts, np.intp),
+                              children_right=concat(rights, np.intp),
+                              value=concat(values, np.float64),
+                              max_depth=max_depth, remainder=remainder)
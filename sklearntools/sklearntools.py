@@ -8,6 +8,12 @@ import numpy as np
 from six import with_metaclass
 from functools import update_wrapper
 import sys
+import os
+from time import time
+try:
+    import resource
+except ImportError:
+    resource = None
 from sklearn2code.sym.function import comp
 if sys.version_info[0] < 3:
     from inspect import getargspec
@@ -143,6 +149,13 @@ def safe_column_select(data, col):
         return data[:, col]
 
 def _subset(data, idx):
+    if isinstance(idx, slice):
+        # Slices give views instead of copies
+        if hasattr(data, 'iloc'):
+            result = data.iloc[idx]
+            result.index = pandas.RangeIndex(result.shape[0])
+            return result
+        return data[idx]
     if len(data.shape) == 1:
         return data[idx]
     else:
@@ -157,6 +170,52 @@ def _subset_data(data, idx):
         result[k] = _subset(data[k], idx)
     return result
 
+def _backing_memmap(data):
+    '''
+    Return the np.memmap whose memory backs data, or None if data is not memory mapped.
+    '''
+    values = getattr(data, 'values', data)
+    while isinstance(values, np.ndarray):
+        if isinstance(values, np.memmap):
+            return values
+        values = values.base
+    return None
+
+def _memmap_data(data, folder):
+    '''
+    Write each value in data to folder once and return a dict of read-only memory mapped 
+    versions.  Worker processes that receive the result get views of the same pages instead 
+    of private pickled copies.  Values that can't be memory mapped (object arrays, mixed dtype 
+    DataFrames) are returned unchanged.
+    '''
+    result = {}
+    for k, v in data.items():
+        values = np.asarray(getattr(v, 'values', v))
+        if values.dtype.hasobject:
+            result[k] = v
+            continue
+        filename = os.path.join(folder, '%s.npy' % k)
+        np.save(filename, values)
+        mapped = np.load(filename, mmap_mode='r')
+        if hasattr(v, 'columns'):
+            result[k] = pandas.DataFrame(mapped, index=v.index, columns=v.columns, copy=False)
+        elif hasattr(v, 'index'):
+            result[k] = pandas.Series(mapped, index=v.index, name=v.name, copy=False)
+        else:
+            result[k] = mapped
+    return result
+
+def _payload_nbytes(data):
+    '''
+    Number of bytes in data that have to be pickled to ship it to a worker process.  Memory 
+    mapped values are shipped by reference, so they don't count.
+    '''
+    result = 0
+    for v in data.values():
+        if _backing_memmap(v) is None:
+            result += np.asarray(getattr(v, 'values', v)).nbytes
+    return result
+
 def safe_assign_subset(arr, idx, value):
     try:
         arr.loc[idx, :] = value
@@ -192,23 +251,92 @@ def clean_column_name(xlabels, col):
     else:
         return col
     
-def _fit_and_score(estimator, data, scorer, train, test):
+def _peak_rss():
+    '''
+    Peak resident set size of the current process in bytes, or None if it can't be determined.
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, OS X reports bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def _task_info(data, dispatch_time):
+    '''
+    Start the info dict returned by _fit_and_score and _fit_and_predict.  If dispatch_time is 
+    given, it should be the time at which the task was handed to joblib, and dispatch_latency 
+    is the time from then until the task started in its worker.  That includes any wait for a 
+    free worker as well as the time taken to ship the data.
+    '''
+    return {'data_nbytes': _payload_nbytes(data), 
+            'dispatch_latency': time() - dispatch_time if dispatch_time is not None else None,
+            '_peak_rss_start': _peak_rss()}
+
+def _end_task_info(info):
+    '''
+    Replace the peak resident set size recorded by _task_info with peak_rss_increase, the 
+    growth in the worker's peak resident set size during the task.  The worker's absolute peak 
+    is not reported, since a reused worker's peak includes its earlier tasks.
+    '''
+    start = info.pop('_peak_rss_start', None)
+    end = _peak_rss()
+    info['peak_rss_increase'] = None if start is None or end is None else end - start
+    return info
+
+def _fit_and_score(estimator, data, scorer, train, test, dispatch_time=None):
+    '''
+    Fit on the train set and score on the test set.  The last element of the result is a dict 
+    with the sizes of the train and test sets, the fit and score times, the growth of the 
+    worker's peak resident set size, the number of bytes of data the worker holds privately and 
+    the dispatch latency (see _task_info).
+    '''
+    info = _task_info(data, dispatch_time)
     train_data = _subset_data(data, train)
+    start_time = time()
     estimator_ = clone(estimator).fit(**train_data)
+    info['fit_time'] = time() - start_time
     test_data = _subset_data(data, test)
+    start_time = time()
     score = safer_call(scorer, estimator_, **test_data)
-    return (score, np.sum(test), estimator_)
+    info['score_time'] = time() - start_time
+    info['n_train'] = train_data['X'].shape[0]
+    info['n_test'] = test_data['X'].shape[0]
+    _end_task_info(info)
+    return (score, np.sum(test), estimator_, info)
 
-def _fit_and_predict(estimator, data, train, test, verbose=False):
+def _fit_and_predict(estimator, data, train, test, verbose=False, dispatch_time=None):
+    '''
+    Fit on the train set and predict on the test set.  The last element of the result is a dict 
+    with the same timing and memory information as for _fit_and_score, except that it has 
+    predict_time instead of score_time.
+    '''
+    info = _task_info(data, dispatch_time)
     train_data = _subset_data(data, train)
     if verbose > 0:
         print('Fitting inner estimator...')
+    start_time = time()
     estimator_ = clone(estimator).fit(**train_data)
+    info['fit_time'] = time() - start_time
     if verbose > 0:
         print('Fitting inner estimator complete.')
+    info['n_train'] = train_data['X'].shape[0]
+    return _predict_fold(estimator_, data, test, info)
+
+def _predict_fold(estimator_, data, test, info):
+    '''
+    The predict half of _fit_and_predict, for an estimator that has already been fit.  Adds 
+    predict_time, n_test and peak_rss_increase to info.
+    '''
     test_data = _subset_data(data, test)
+    start_time = time()
     prediction = safer_call(estimator_.predict, **test_data)
-    return estimator_, prediction, test
+    info['predict_time'] = time() - start_time
+    info['n_test'] = test_data['X'].shape[0]
+    _end_task_info(info)
+    return estimator_, prediction, test, info
+
+def _fit(estimator, data):
+    return clone(estimator).fit(**data)
 
 class SklearnTool(object):
     _version = __version__
@@ -325,6 +453,14 @@ class StagedEstimator(STEstimator, MetaEstimatorMixin):
             new_stages = [other] + new_stages
         return StagedEstimator(new_stages)
     
+    def _process_args(self, **kwargs):
+        result = super(StagedEstimator, self)._process_args(**kwargs)
+        
+        # Estimators such as LinearRegression reject column vectors of weights
+        if 'sample_weight' in result:
+            result['sample_weight'] = shrinkd(1, result['sample_weight'])
+        return result
+    
     def _transform_args(self, data):
         result = {'X': data['X']}
         if 'exposure' in data:
@@ -370,20 +506,23 @@ class StagedEstimator(STEstimator, MetaEstimatorMixin):
 #                 expressions = stage_expressions
 #         return expressions
     
+    def _fit_stage(self, stage, data):
+        # Stage knows to discard whatever it doesn't need
+        stage_ = clone(stage)
+        safe_call(stage_.fit, data)
+        try:
+            stage_.update(data)
+        except AttributeError:
+            try:
+                data['X'] = safe_call(stage_.transform, self._transform_args(data))
+            except:
+                data['X'] = safe_call(stage_.transform, self._transform_args(data))
+        return stage_
+    
     def fit_update(self, data):
         self.intermediate_stages_ = []
         for stage in self.intermediate_stages:
-            # Stage knows to discard whatever it doesn't need
-            stage_ = clone(stage)
-            safe_call(stage_.fit, data)
-            try:
-                stage_.update(data)
-            except AttributeError:
-                try:
-                    data['X'] = safe_call(stage_.transform, self._transform_args(data))
-                except:
-                    data['X'] = safe_call(stage_.transform, self._transform_args(data))
-            self.intermediate_stages_.append(stage_)
+            self.intermediate_stages_.append(self._fit_stage(stage, data))
         return data
     
     def fit(self, X, y=None, sample_weight=None, exposure=None):
@@ -394,7 +533,12 @@ class StagedEstimator(STEstimator, MetaEstimatorMixin):
     def fit_predict(self, X, y=None, sample_weight=None, exposure=None):
         data = self.fit_update(self._process_args(X=X, y=y, sample_weight=sample_weight, exposure=exposure))
         self.final_stage_ = clone(self.final_stage)
-        return safe_call(self.final_stage_.fit_predict, data)
+        if hasattr(self.final_stage_, 'fit_predict'):
+            return safe_call(self.final_stage_.fit_predict, data)
+        
+        # Final stages such as sklearn's regression trees can only be fit, then predict
+        safe_call(self.final_stage_.fit, data)
+        return safe_call(self.final_stage_.predict, data)
     
     def transform(self, X, exposure=None):
         data = self._process_args(X=X, exposure=exposure)
@@ -448,7 +592,7 @@ class StagedEstimator(STEstimator, MetaEstimatorMixin):
         return safe_call(self.final_stage_.predict_log_proba, data)
     
     def score(self, X, y=None, sample_weight=None, exposure=None):
-        data = self._process_args(X=X, exposure=exposure)
+        data = self._process_args(X=X, y=y, sample_weight=sample_weight, exposure=exposure)
         self._update(data)
         return safe_call(self.final_stage_.score, data)
     
@@ -567,6 +711,24 @@ class LinearCombination(STSimpleEstimator, MetaEstimatorMixin):
             prediction += self.coefficients[i+1] * (np.ravel(estimator.predict(**data)) if ravel else estimator.predict(**data))
         return prediction
     
+    def staged_predict(self, X, exposure=None):
+        '''
+        Generate the predictions of the first 1, 2, ..., len(estimators) terms of the linear 
+        combination.  Each estimator predicts once, into a running sum.
+        '''
+        data = self._process_args(X=X, exposure=exposure)
+        prediction = None
+        ravel = False
+        for coefficient, estimator in zip(self.coefficients, self.estimators):
+            if prediction is None:
+                prediction = coefficient * estimator.predict(**data)
+                ravel = len(prediction.shape) == 1 or (len(prediction.shape) == 2 and prediction.shape[1] == 1)
+                if ravel:
+                    prediction = np.ravel(prediction)
+            else:
+                prediction += coefficient * (np.ravel(estimator.predict(**data)) if ravel else estimator.predict(**data))
+            yield prediction.copy()
+    
     def __mul__(self, factor):
         estimators = [est for est in self.estimators]
         coefficients = [coeff * factor for coeff in self.coefficients]
@@ -1,8 +1,9 @@
 from sklearntools.sklearntools import STSimpleEstimator, growd
 from sklearn2code.utility import tupify
 from sklearn.base import clone
-from sklearn.externals.joblib.parallel import Parallel
-from sklearntools.kfold import CrossValidatingEstimator
+from sklearn.externals.joblib.parallel import Parallel, delayed
+from sklearntools.kfold import CrossValidatingEstimator, check_folds,\
+    PredefinedFolds
 import numpy as np
 from toolz.dicttoolz import assoc, get_in, keyfilter, valmap, dissoc
 from operator import __contains__
@@ -12,12 +13,24 @@ from sklearn2code.sym.function import VariableFactory, Function, cart
 from frozendict import frozendict
 from collections import OrderedDict
 from toolz.itertoolz import first
+from itertools import chain
 
 class SuperLearner(STSimpleEstimator):
     def __init__(self, regressors, meta_regressor, y_transformer=None, cv=2, n_jobs=1, verbose=0, 
-                 pre_dispatch='2*n_jobs'):
+                 pre_dispatch='2*n_jobs', cache=None, prune=False):
         '''
         regressors : should be a dict-like structure or items-like
+        
+        cache : FoldCache or str, optional (default=None)
+            Passed to the internal CrossValidatingEstimators so that base learners whose 
+            parameters and data haven't changed are loaded from disk instead of refit.
+        
+        prune : bool, optional (default=False)
+            If True and the fitted meta-regressor has a coef_ attribute with one coefficient per 
+            base learner prediction column, predict skips base learners whose coefficients are 
+            all zero (as often happens with non-negative or lasso stacking).  Meta-regressors 
+            whose coef_ is laid out any other way (with an intercept, or over basis functions) 
+            are never pruned.  Base learners predict in parallel threads either way.
         '''
         self.regressors = regressors
         self.meta_regressor = meta_regressor
@@ -26,30 +39,68 @@ class SuperLearner(STSimpleEstimator):
         self.n_jobs = n_jobs
         self.verbose = verbose
         self.pre_dispatch = pre_dispatch
+        self.cache = cache
+        self.prune = prune
         self.ordered_regressors = OrderedDict(self.regressors.items() if hasattr(self.regressors, 'items') else self.regressors)
     
     def fit(self, X, y=None, sample_weight=None, exposure=None):
         fit_args = self._process_args(X=X, y=y, sample_weight=sample_weight,
                                       exposure=exposure)
         
+        # Generate the folds once so that every base learner is fit on exactly the same splits
+        self.folds_ = check_folds(self.cv, X=fit_args['X'], y=fit_args.get('y'))
+        
+        # The base learners of the fitted model, which add_regressor and remove_regressor change 
+        # without touching the regressors parameter
+        self.regressors_ = OrderedDict(self.regressors.items() if hasattr(self.regressors, 'items') 
+                                       else self.regressors)
+        
         # Create internal cross-validating estimators
-        self.cross_validating_estimators_ = OrderedDict((k, CrossValidatingEstimator(v, cv=self.cv, n_jobs=self.n_jobs, 
-                                     verbose=self.verbose, 
-                                     pre_dispatch=self.pre_dispatch)) for k, v in self.ordered_regressors.items())
+        self.cross_validating_estimators_ = OrderedDict((k, self._cross_validating_estimator(v)) 
+                                                         for k, v in self.regressors_.items())
         
 #         frozendict(valmap(lambda x:
 #             CrossValidatingEstimator(x, cv=self.cv, n_jobs=self.n_jobs, 
 #                                      verbose=self.verbose, 
 #                                      pre_dispatch=self.pre_dispatch), self.regressors).items())
         
-        # Fit the inner regressors using cross-validation
-        for est_name, est in self.cross_validating_estimators_.items():
-            if self.verbose > 0:
-                print('Super learner is fitting %s...' % est_name)
-            est.fit(**fit_args)
-            if self.verbose > 0:
-                print('Super learner finished fitting %s.' % est_name)
+        # Fit the inner regressors using cross-validation.  The fold fits and full data fits of 
+        # all the base learners go into a single task pool, so that n_jobs workers stay busy 
+        # even when there are fewer folds than workers or some learners are much slower than 
+        # others.
+        if self.verbose > 0:
+            print('Super learner is fitting %s...' % ', '.join(map(str, self.cross_validating_estimators_.keys())))
+        estimators = list(self.cross_validating_estimators_.values())
+        plans = []
+        try:
+            for est in estimators:
+                plans.append(est._start_fit(**fit_args))
+            parallel = Parallel(n_jobs=self.n_jobs, verbose=self.verbose,
+                                pre_dispatch=self.pre_dispatch, max_nbytes=None)
+            results = parallel(chain(*[plan['tasks'] for plan in plans]))
+        finally:
+            for est, plan in zip(estimators, plans):
+                est._cleanup_fit(plan)
+        start = 0
+        for est, plan in zip(estimators, plans):
+            est._finish_fit(plan, results[start:start + plan['n_tasks']])
+            start += plan['n_tasks']
+        if self.verbose > 0:
+            print('Super learner finished fitting base learners.')
         
+        # Fit the outer meta-regressor
+        self._fit_meta_regressor(fit_args)
+            
+        # All scikit-learn compatible estimators must return self from fit
+        return self
+    
+    def _cross_validating_estimator(self, regressor):
+        return CrossValidatingEstimator(regressor, cv=PredefinedFolds(self.folds_), 
+                                        n_jobs=self.n_jobs, verbose=self.verbose, 
+                                        pre_dispatch=self.pre_dispatch, cache=self.cache, 
+                                        final_model='refit_in_parallel')
+    
+    def _fit_meta_regressor(self, fit_args):
         # Fit the outer meta-regressor.  Cross validation is not used here.  Instead,
         # users of the SuperLearner are free to wrap the SuperLearner in a 
         # CrossValidatingEstimator.
@@ -65,16 +116,94 @@ class SuperLearner(STSimpleEstimator):
         self.meta_regressor_ = clone(self.meta_regressor).fit(**meta_fit_args)
         if self.verbose > 0:
             print('Super learner meta-regressor fitting complete.')
-            
-        # All scikit-learn compatible estimators must return self from fit
+        
+        # Record which columns of the meta-regressor input belong to which base learner, and 
+        # which base learners actually affect the meta-regressor's predictions
+        self.base_widths_ = [growd(2, est.cv_predictions_).shape[1] 
+                             for est in self.cross_validating_estimators_.values()]
+        self.active_regressors_ = self._active_regressors()
+    
+    def _active_regressors(self):
+        names = list(self.cross_validating_estimators_.keys())
+        if not hasattr(self.meta_regressor_, 'coef_'):
+            return names
+        coef = np.asarray(self.meta_regressor_.coef_)
+        
+        # Coefficients can only be matched to base learners if there's one per input column
+        if coef.ndim == 0 or coef.shape[-1] != sum(self.base_widths_):
+            return names
+        coef = coef.reshape((-1, coef.shape[-1]))
+        bounds = np.cumsum([0] + self.base_widths_)
+        return [name for name, start, stop in zip(names, bounds[:-1], bounds[1:]) 
+                if np.any(coef[:, start:stop] != 0)]
+    
+    def add_regressor(self, name, regressor, X, y=None, sample_weight=None, exposure=None):
+        '''
+        Add a base learner to a fitted SuperLearner.  Only the new learner is fit, on the same 
+        folds as the existing ones, and then the meta-regressor is refit.  The data must be the 
+        same data the SuperLearner was fit on.  If name is already present its learner is 
+        replaced.  The base learners are recorded in regressors_; the regressors parameter is 
+        left alone.
+        '''
+        fit_args = self._process_args(X=X, y=y, sample_weight=sample_weight,
+                                      exposure=exposure)
+        if self.verbose > 0:
+            print('Super learner is fitting %s...' % name)
+        est = self._cross_validating_estimator(regressor).fit(**fit_args)
+        self.regressors_[name] = regressor
+        self.cross_validating_estimators_[name] = est
+        self._fit_meta_regressor(fit_args)
         return self
     
+    def remove_regressor(self, name, X, y=None, sample_weight=None, exposure=None):
+        '''
+        Remove a base learner from a fitted SuperLearner and refit the meta-regressor on the 
+        stored cross-validated predictions of the others.  The data must be the same data the 
+        SuperLearner was fit on.
+        '''
+        if name not in self.regressors_:
+            raise ValueError('No regressor named %s.' % str(name))
+        if len(self.regressors_) == 1:
+            raise ValueError('Cannot remove the only regressor.')
+        fit_args = self._process_args(X=X, y=y, sample_weight=sample_weight,
+                                      exposure=exposure)
+        del self.regressors_[name]
+        del self.cross_validating_estimators_[name]
+        self._fit_meta_regressor(fit_args)
+        return self
+    
+    def _base_predictions(self, args, names):
+        # Base learners not in names are left as zeros in the output
+        bounds = np.cumsum([0] + self.base_widths_)
+        out = np.zeros(shape=(args['X'].shape[0], bounds[-1]))
+        jobs = [(est, out[:, start:stop]) for (name, est), start, stop in 
+                zip(self.cross_validating_estimators_.items(), bounds[:-1], bounds[1:]) 
+                if name in names]
+        if self.n_jobs == 1 or len(jobs) <= 1:
+            for est, target in jobs:
+                _predict_into(est, args, target)
+        else:
+            # Threads share out, so each base learner writes its prediction directly into 
+            # its own columns.  Most of the work in predict happens in numpy or compiled 
+            # code that releases the GIL.
+            Parallel(n_jobs=self.n_jobs, backend='threading')(delayed(_predict_into)(est, args, target) 
+                                                               for est, target in jobs)
+        return out
+    
     def transform(self, X, exposure=None):
         args = self._process_args(X=X, exposure=exposure)
-        return np.concatenate(tuple(map(growd(2), [est.predict(**args) for est in self.cross_validating_estimators_.values()])), axis=1)
+        return self._base_predictions(args, list(self.cross_validating_estimators_.keys()))
     
     def predict(self, X, exposure=None):
-        return self.meta_regressor_.predict(self.transform(X, exposure=exposure))
+        args = self._process_args(X=X, exposure=exposure)
+        if self.prune:
+            names = self.active_regressors_
+        else:
+            names = list(self.cross_validating_estimators_.keys())
+        return self.meta_regressor_.predict(self._base_predictions(args, names))
+
+def _predict_into(estimator, args, out):
+    out[:] = growd(2, np.asarray(estimator.predict(**args)))
 
 @syms.register(SuperLearner)
 def syms_super_learner(estimator):
@@ -0,0 +1,54 @@
+import numpy as np
+import os
+import tempfile
+import shutil
+from sklearntools.cache import FoldCache
+from sklearntools.kfold import CrossValidatingEstimator
+from sklearn.linear_model.base import LinearRegression
+from sklearn.model_selection._split import KFold
+from numpy.testing.utils import assert_array_almost_equal
+from nose.tools import assert_true, assert_false, assert_equal
+
+def test_cross_validating_estimator_with_cache():
+    np.random.seed(0)
+    X = np.random.normal(size=(100,10))
+    y = np.dot(X, np.random.normal(size=10)) + np.random.normal(size=100)
+    directory = tempfile.mkdtemp()
+    try:
+        model = CrossValidatingEstimator(LinearRegression(), cv=KFold(5), cache=directory).fit(X, y)
+        assert_false(any(model.cv_from_cache_))
+        
+        cached_model = CrossValidatingEstimator(LinearRegression(), cv=KFold(5), cache=directory).fit(X, y)
+        assert_true(all(cached_model.cv_from_cache_))
+        assert_array_almost_equal(model.cv_predictions_, cached_model.cv_predictions_)
+        assert_array_almost_equal(model.predict(X), cached_model.predict(X))
+        
+        # Different parameters should not hit the cache
+        other_model = CrossValidatingEstimator(LinearRegression(fit_intercept=False), cv=KFold(5), 
+                                               cache=directory).fit(X, y)
+        assert_false(any(other_model.cv_from_cache_))
+    finally:
+        shutil.rmtree(directory)
+
+def test_fold_cache_eviction():
+    directory = tempfile.mkdtemp()
+    try:
+        cache = FoldCache(directory, max_bytes=3000)
+        for i in range(10):
+            cache.set(str(i), np.zeros(100))
+        total = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+        assert_true(total <= 3000)
+        assert_equal(cache.get('0'), None)
+        assert_array_almost_equal(cache.get('9'), np.zeros(100))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    import sys
+    import nose
+    # This code will run the test in this file.'
+    module_name = sys.modules[__name__].__file__
+
+    result = nose.run(argv=[sys.argv[0],
+                            module_name,
+                            '-s', '-v'])
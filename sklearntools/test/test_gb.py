@@ -1,12 +1,21 @@
 import numpy as np
+import tempfile
+import os
+import shutil
 from sklearntools.gb import GradientBoostingEstimator,\
     SmoothQuantileLossFunction, log_one_plus_exp_x, one_over_one_plus_exp_x,\
-    stop_after_n_iterations_without_percent_improvement_over_threshold
-from numpy.testing.utils import assert_approx_equal, assert_array_almost_equal
+    stop_after_n_iterations_without_percent_improvement_over_threshold,\
+    stop_after_n_iterations_without_improvement_over_threshold, STExponentialLossFunction,\
+    BoostingWorkspace, MultiQuantileGradientBoostingEstimator
+from numpy.testing.utils import assert_approx_equal, assert_array_almost_equal,\
+    assert_array_equal
 from sklearntools.earth import Earth
-from nose.tools import assert_less, assert_greater, assert_raises, assert_true
+from nose.tools import assert_less, assert_greater, assert_raises, assert_true,\
+    assert_equal
 from sklearn.ensemble.gradient_boosting import GradientBoostingRegressor,\
-    QuantileLossFunction, BinomialDeviance
+    QuantileLossFunction, BinomialDeviance, LeastSquaresError
+from sklearn.tree import DecisionTreeRegressor
+from sklearntools.sklearntools import LinearCombination
 from sklearn.ensemble.bagging import BaggingRegressor
 from sklearn.metrics.regression import r2_score
 from sklearn.cross_validation import train_test_split
@@ -17,6 +26,7 @@ import pandas
 from sklearn.datasets.samples_generator import make_classification
 from nose import SkipTest
 from sklearn.calibration import CalibratedClassifierCV
+from sklearn.linear_model.base import LinearRegression
 
 def test_smooth_quantile_loss_function():
     np.random.seed(0)
@@ -41,6 +51,36 @@ def test_one_over_one_plus_exp_x():
     y_2 = one_over_one_plus_exp_x(x)
     assert_array_almost_equal(y_1, y_2)
 
+def test_loss_kernels_out():
+    np.random.seed(0)
+    n = 1000
+    y = np.random.normal(size=n)
+    pred = np.random.normal(size=n)
+    weights = np.random.uniform(size=n)
+    out = np.empty(n)
+    
+    tau, alpha = .3, .5
+    loss = SmoothQuantileLossFunction(1, tau, alpha)
+    x = y - pred
+    expected = tau * x + alpha * np.log(1 + np.exp(-x / alpha))
+    assert_approx_equal(loss(y, pred, out=out), np.sum(expected))
+    assert_approx_equal(loss(y, pred, weights, out=out), np.dot(weights, expected))
+    expected = weights * (tau - 1. / (1. + np.exp(x / alpha)))
+    assert_true(loss.negative_gradient(y, pred, weights, out=out) is out)
+    assert_array_almost_equal(out, expected)
+    
+    y = np.sign(y)
+    loss = STExponentialLossFunction()
+    assert_approx_equal(loss(y, pred, out=out), np.sum(np.exp(-y * pred)))
+    assert_true(loss.negative_gradient(y, pred, out=out) is out)
+    assert_array_almost_equal(out, -y * np.exp(-y * pred))
+    
+    # The workspace reuses its buffers
+    workspace = BoostingWorkspace(SmoothQuantileLossFunction(1, tau, alpha), n)
+    assert_true(workspace.negative_gradient(pred, {'y': y}) is workspace.gradient)
+    workspace = BoostingWorkspace(LeastSquaresError(1), n)
+    assert_array_almost_equal(workspace.negative_gradient(pred, {'y': y}), y - pred)
+
 def test_gradient_boosting_estimator_with_binomial_deviance_loss():
     np.random.seed(0)
     X, y = make_classification(n_classes=2)
@@ -108,6 +148,274 @@ def test_gradient_boosting_estimator_with_smooth_quantile_loss():
     assert_greater(model.score_, 0.)
     assert_approx_equal(model.score(X_train, y_train), model.score_)
     
+def test_line_search_step_sizes():
+    np.random.seed(0)
+    X = np.random.normal(size=(500, 5))
+    y = np.dot(X, np.random.normal(size=5)) + np.random.normal(size=500)
+    
+    # Squared loss has a closed form step
+    kwargs = dict(base_estimator=DecisionTreeRegressor(max_depth=3), n_estimators=10)
+    exact = GradientBoostingEstimator(loss_function=LeastSquaresError(1), **kwargs).fit(X, y)
+    golden = GradientBoostingEstimator(loss_function=LeastSquaresError(1), line_search='golden', 
+                                       **kwargs).fit(X, y)
+    assert_true(all(n == 1 for n in exact.loss_evaluations_))
+    assert_true(all(n > 20 for n in golden.loss_evaluations_))
+    assert_array_almost_equal(exact.coefficients_, golden.coefficients_, decimal=5)
+    
+    # Smooth losses use a few Newton steps
+    X, y = make_classification(n_classes=2)
+    kwargs['base_estimator'] = DecisionTreeRegressor(max_depth=2)
+    newton = GradientBoostingEstimator(loss_function=BinomialDeviance(2), **kwargs).fit(X, y)
+    golden = GradientBoostingEstimator(loss_function=BinomialDeviance(2), line_search='golden', 
+                                       **kwargs).fit(X, y)
+    assert_less(sum(newton.loss_evaluations_), sum(golden.loss_evaluations_) / 3.)
+    assert_less(newton.losses_[-1], newton.losses_[0])
+    np.testing.assert_allclose(newton.losses_[-1], golden.losses_[-1], rtol=1e-3)
+
+def test_subsample_and_max_features():
+    np.random.seed(0)
+    X = np.random.normal(size=(500, 6))
+    y = np.dot(X, np.random.normal(size=6)) + np.random.normal(size=500)
+    model = GradientBoostingEstimator(DecisionTreeRegressor(max_depth=3, random_state=0), 
+                                      LeastSquaresError(1), n_estimators=30, subsample=.5, 
+                                      max_features=.5, random_state=0)
+    model.fit(X, y)
+    assert_less(model.losses_[-1], model.losses_[0])
+    assert_true(all(est.stages[0].x_cols.shape == (3,) for est in model.estimators_[1:]))
+    assert_true(all(est.final_stage_.tree_.n_node_samples[0] == 250 for est in model.estimators_[1:]))
+    assert_equal(model.predict(X).shape, (500,))
+    
+    # The same random state gives the same model
+    model2 = GradientBoostingEstimator(DecisionTreeRegressor(max_depth=3, random_state=0), 
+                                       LeastSquaresError(1), n_estimators=30, subsample=.5, 
+                                       max_features=.5, random_state=0)
+    assert_array_almost_equal(model.predict(X), model2.fit(X, y).predict(X))
+    
+    # Column subsampling alone fits every round on all the rows
+    model = GradientBoostingEstimator(DecisionTreeRegressor(max_depth=3, random_state=0), 
+                                      LeastSquaresError(1), n_estimators=30, max_features=.5, 
+                                      random_state=0)
+    model.fit(X, y)
+    assert_less(model.losses_[-1], model.losses_[0])
+    assert_true(all(est.stages[0].x_cols.shape == (3,) for est in model.estimators_[1:]))
+    assert_true(all(est.final_stage_.tree_.n_node_samples[0] == 500 for est in model.estimators_[1:]))
+    assert_raises(ValueError, GradientBoostingEstimator(DecisionTreeRegressor(), LeastSquaresError(1), 
+                                                        subsample=0.).fit, X, y)
+
+def test_held_out_early_stopping():
+    np.random.seed(0)
+    X = np.random.normal(size=(600, 5))
+    y = X[:, 0] + np.random.normal(size=600)
+    stopper = stop_after_n_iterations_without_improvement_over_threshold(5)
+    
+    # Deep trees overfit quickly, so the held out loss stops improving long before 
+    # n_estimators
+    model = GradientBoostingEstimator(DecisionTreeRegressor(max_depth=8), LeastSquaresError(1), 
+                                      learning_rate=.5, n_estimators=200, stopper=stopper, 
+                                      validation_fraction=.3, random_state=0)
+    model.fit(X, y)
+    assert_true(model.early_stop_)
+    assert_less(len(model.estimators_), 50)
+    assert_equal(len(model.validation_losses_), len(model.losses_))
+    assert_less(model.best_iteration_, len(model.estimators_))
+    assert_equal(np.sum(model.validation_mask_), 180)
+    
+    # Warm starts hold out the same rows as the fit they continue, even without a seed
+    model = GradientBoostingEstimator(DecisionTreeRegressor(max_depth=3, random_state=0), 
+                                      LeastSquaresError(1), n_estimators=5, 
+                                      validation_fraction=.3, warm_start=True).fit(X, y)
+    validation_mask = model.validation_mask_.copy()
+    validation_losses = list(model.validation_losses_)
+    model.set_params(n_estimators=10)
+    model.fit(X, y)
+    assert_array_equal(model.validation_mask_, validation_mask)
+    assert_array_almost_equal(model.validation_losses_[:len(validation_losses)], validation_losses)
+    assert_raises(ValueError, model.fit, X[:300], y[:300])
+    
+    # The incrementally updated held out predictions agree with predict
+    X_val = np.random.normal(size=(200, 5))
+    y_val = X_val[:, 0] + np.random.normal(size=200)
+    model = GradientBoostingEstimator(DecisionTreeRegressor(max_depth=3), LeastSquaresError(1), 
+                                      n_estimators=20)
+    model.fit(X, y, eval_set=(X_val, y_val))
+    assert_approx_equal(model.validation_losses_[-1], LeastSquaresError(1)(y_val, model.predict(X_val)))
+
+def test_staged_predict():
+    np.random.seed(0)
+    X = np.random.normal(size=(300, 5))
+    y = np.dot(X, np.random.normal(size=5)) + np.random.normal(size=300)
+    model = GradientBoostingEstimator(DecisionTreeRegressor(max_depth=3), LeastSquaresError(1), 
+                                      n_estimators=10).fit(X, y)
+    staged = list(model.staged_predict(X))
+    assert_equal(len(staged), len(model.estimators_))
+    assert_array_almost_equal(staged[-1], model.predict(X))
+    for j in [1, 4, 11]:
+        expected = LinearCombination(model.estimators_[:j], model.coefficients_[:j]).predict(X)
+        assert_array_almost_equal(staged[j - 1], expected)
+    assert_raises(AttributeError, model.staged_decision_function, X)
+    
+    statistic = lambda y_true, y_pred: np.mean((y_true - y_pred) ** 2)
+    all_steps = model.statistic_over_steps(X, y, statistic)
+    assert_array_almost_equal(all_steps, [statistic(y, pred) for pred in staged])
+    assert_array_almost_equal(model.statistic_over_steps(X, y, statistic, every=3), all_steps[2::3])
+    
+    X, y = make_classification(n_classes=2)
+    model = GradientBoostingEstimator(DecisionTreeRegressor(max_depth=2), BinomialDeviance(2), 
+                                      n_estimators=10).fit(X, y)
+    assert_array_almost_equal(list(model.staged_decision_function(X))[-1], model.decision_function(X))
+    assert_array_almost_equal(list(model.staged_predict(X))[-1], model.predict(X))
+
+class CountingTreeRegressor(DecisionTreeRegressor):
+    fit_count = 0
+    
+    def fit(self, *args, **kwargs):
+        CountingTreeRegressor.fit_count += 1
+        return super(CountingTreeRegressor, self).fit(*args, **kwargs)
+
+class TargetKeepingTreeRegressor(DecisionTreeRegressor):
+    def fit(self, X, y, *args, **kwargs):
+        self.y_ = y
+        return super(TargetKeepingTreeRegressor, self).fit(X, y, *args, **kwargs)
+
+def test_base_estimators_own_their_targets():
+    np.random.seed(0)
+    X = np.random.normal(size=(300, 5))
+    y = np.dot(X, np.random.normal(size=5)) + np.random.normal(size=300)
+    
+    # Losses that write their gradient into a reused buffer
+    model = GradientBoostingEstimator(TargetKeepingTreeRegressor(max_depth=3, random_state=0), 
+                                      SmoothQuantileLossFunction(1, .5, .0001), 
+                                      n_estimators=5).fit(X, y)
+    targets = [est.y_ for est in model.estimators_[1:]]
+    assert_true(not any(np.may_share_memory(a, b) for a, b in zip(targets[:-1], targets[1:])))
+    assert_true(not np.allclose(targets[0], targets[-1]))
+    
+    model = MultiQuantileGradientBoostingEstimator(TargetKeepingTreeRegressor(max_depth=3, random_state=0), 
+                                                   taus=(.1, .9), n_estimators=5).fit(X, y)
+    targets = [est.y_ for est in model.estimators_]
+    assert_true(not any(np.may_share_memory(a, b) for a, b in zip(targets[:-1], targets[1:])))
+
+def test_warm_start_and_checkpoint():
+    np.random.seed(0)
+    X = np.random.normal(size=(300, 5))
+    y = np.dot(X, np.random.normal(size=5)) + np.random.normal(size=300)
+    make_model = lambda **kwargs: GradientBoostingEstimator(CountingTreeRegressor(max_depth=3, random_state=0), 
+                                                            LeastSquaresError(1), subsample=.8, 
+                                                            random_state=0, **kwargs)
+    reference = make_model(n_estimators=20).fit(X, y)
+    
+    # Warm start adds rounds to an existing fit
+    model = make_model(n_estimators=10, warm_start=True).fit(X, y)
+    model.set_params(n_estimators=20)
+    CountingTreeRegressor.fit_count = 0
+    model.fit(X, y)
+    assert_equal(CountingTreeRegressor.fit_count, 10)
+    assert_array_almost_equal(model.losses_, reference.losses_)
+    assert_array_almost_equal(model.predict(X), reference.predict(X))
+    model.set_params(n_estimators=5)
+    assert_raises(ValueError, model.fit, X, y)
+    
+    # A fit on top of previous predictions has no initial estimator to resume after
+    model = make_model(n_estimators=10).fit(X, y, previous_prediction=np.zeros(y.shape[0]))
+    model.set_params(n_estimators=20, warm_start=True)
+    assert_raises(ValueError, model.fit, X, y)
+    
+    # A checkpointed fit can be resumed from disk by a new model
+    checkpoint_dir = tempfile.mkdtemp()
+    try:
+        make_model(n_estimators=10, checkpoint_dir=checkpoint_dir, checkpoint_every=3).fit(X, y)
+        CountingTreeRegressor.fit_count = 0
+        model = make_model(n_estimators=20, checkpoint_dir=checkpoint_dir, checkpoint_every=3).fit(X, y)
+        assert_equal(CountingTreeRegressor.fit_count, 10)
+        assert_array_almost_equal(model.losses_, reference.losses_)
+        assert_array_almost_equal(model.predict(X), reference.predict(X))
+        
+        # Different data means a fresh start
+        CountingTreeRegressor.fit_count = 0
+        make_model(n_estimators=20, checkpoint_dir=checkpoint_dir).fit(X, -y)
+        assert_equal(CountingTreeRegressor.fit_count, 20)
+    finally:
+        shutil.rmtree(checkpoint_dir)
+    
+    # Each checkpoint writes only the new estimators, and stoppers don't need to be picklable
+    checkpoint_dir = tempfile.mkdtemp()
+    try:
+        make_model(n_estimators=10, checkpoint_dir=checkpoint_dir, checkpoint_every=3, 
+                   stopper=lambda **kwargs: False).fit(X, y)
+        
+        # One state entry, plus the estimators saved after rounds 3, 6, 9, and 10
+        assert_equal(len([name for name in os.listdir(checkpoint_dir) if name.endswith('.pkl')]), 5)
+        CountingTreeRegressor.fit_count = 0
+        model = make_model(n_estimators=20, checkpoint_dir=checkpoint_dir, checkpoint_every=3, 
+                           stopper=lambda **kwargs: False).fit(X, y)
+        assert_equal(CountingTreeRegressor.fit_count, 10)
+        assert_array_almost_equal(model.predict(X), reference.predict(X))
+    finally:
+        shutil.rmtree(checkpoint_dir)
+
+def test_multi_quantile_gradient_boosting():
+    np.random.seed(0)
+    m = 3000
+    X = np.random.normal(size=(m, 3))
+    y = np.dot(X, np.random.normal(size=3)) + np.random.normal(size=m)
+    taus = (.1, .5, .9)
+    model = MultiQuantileGradientBoostingEstimator(CountingTreeRegressor(max_depth=3, random_state=0), 
+                                                   taus=taus, learning_rate=.5, n_estimators=30)
+    assert_raises(NotFittedError, lambda : model.predict(X))
+    CountingTreeRegressor.fit_count = 0
+    model.fit(X, y)
+    
+    # One base estimator fit per round serves every quantile
+    assert_equal(CountingTreeRegressor.fit_count, 30)
+    assert_true(all(hasattr(est, 'predict') for est in model.initial_estimators_))
+    prediction = model.predict(X)
+    assert_equal(prediction.shape, (m, len(taus)))
+    for j, tau in enumerate(taus):
+        assert_less(np.abs(np.mean(y <= prediction[:, j]) - tau), .05)
+        assert_less(model.losses_[-1, j], model.losses_[0, j])
+    
+def test_extra_fit():
+    np.random.seed(0)
+    m = 2000
+    basis = np.random.normal(size=(m, 4))
+    y = 1. + np.dot(basis, np.random.normal(size=4)) + np.random.normal(size=m)
+    weights = np.random.uniform(size=m)
+    
+    # For least squares loss the result is the weighted least squares fit of the residuals
+    loss = LeastSquaresError(1)
+    model = GradientBoostingEstimator(LinearRegression(), loss)
+    prediction = np.random.normal(size=m)
+    residual = y - prediction
+    loss_function = lambda pred: loss(y, pred, sample_weight=weights)
+    estimator, new_loss, _ = model._extra_fit(basis, prediction, loss_function, 
+                                              {'y': y, 'sample_weight': weights}, 
+                                              loss_function(prediction))
+    expected = LinearRegression().fit(basis, residual, sample_weight=weights)
+    assert_array_almost_equal(estimator.coef_, expected.coef_)
+    assert_approx_equal(estimator.intercept_, expected.intercept_)
+    assert_approx_equal(new_loss, loss_function(prediction))
+    assert_array_almost_equal(prediction, y - residual + expected.predict(basis))
+    
+    # For other losses the gradient ends up orthogonal to the basis
+    loss = BinomialDeviance(2)
+    labels = (np.random.uniform(size=m) < 1. / (1. + np.exp(-np.dot(basis, [1., -1., 0., .5])))).astype(float)
+    model = GradientBoostingEstimator(LinearRegression(), loss)
+    prediction = np.zeros(m)
+    loss_function = lambda pred: loss(labels, pred)
+    model._extra_fit(basis, prediction, loss_function, {'y': labels}, loss_function(prediction), 
+                     tolerance=1e-12)
+    gradient = loss.negative_gradient(labels, prediction)
+    assert_array_almost_equal(np.dot(basis.T, gradient) / m, np.zeros(4), decimal=3)
+    
+    # In the boosting loop each round gets one solve
+    X = np.random.normal(size=(m, 3))
+    y = np.sin(X[:, 0]) + X[:, 1] + .1 * np.random.normal(size=m)
+    model = GradientBoostingEstimator(Earth(max_degree=1, max_terms=5), LeastSquaresError(1), 
+                                      n_estimators=3, extra_fit=True).fit(X, y)
+    assert_equal(len(model.loss_evaluations_), 3)
+    assert_greater(model.score_, .9)
+    assert_approx_equal(model.losses_[-1], LeastSquaresError(1)(y, np.ravel(model.estimator_.predict(X))))
+    
 def test_sym_predict():
     np.random.seed(0)
     m = 5000
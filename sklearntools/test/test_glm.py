@@ -1,4 +1,5 @@
-from nose.tools import assert_greater
+from nose.tools import assert_greater, assert_true
+from numpy.testing.utils import assert_array_almost_equal
 import numpy as np
 from sklearntools.glm import BinomialRegressor, GammaRegressor, GaussianRegressor, \
     InverseGaussianRegressor, NegativeBinomialRegressor, PoissonRegressor
@@ -82,6 +83,21 @@ class TestGlm():
         rsq = 1 - np.mean(diff**2) / np.mean((y-np.mean(y))**2)
         assert_greater(rsq, .9)
     
+    def test_predict_without_copying(self):
+        model = PoissonRegressor()
+        y = Poisson().fitted(self.eta)
+        model.fit(self.X, y)
+        expected = Poisson().fitted(np.dot(self.X, model.coef_[1:]) + model.coef_[0])
+        assert_array_almost_equal(model.predict(self.X), expected)
+        
+        # Float arrays in either memory layout are used as they are
+        for X in [np.asfortranarray(self.X), self.X.astype(np.float32)]:
+            assert_true(model._scrub_x(X, None, None)[0] is X)
+            assert_array_almost_equal(model.predict(X), expected, decimal=4)
+        
+        # Other input is converted
+        assert_array_almost_equal(model.transform(self.X.tolist()), model.transform(self.X))
+    
     def test_with_pipeline(self):
         model = Pipeline([('PCA',PCA()), ('Poisson',PoissonRegressor())])
         y = Poisson().fitted(self.eta)
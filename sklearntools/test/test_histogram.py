@@ -0,0 +1,104 @@
+import numpy as np
+from sklearn.ensemble.gradient_boosting import LeastSquaresError
+from sklearn.linear_model.base import LinearRegression
+from numpy.testing.utils import assert_array_almost_equal, assert_array_equal
+from nose.tools import assert_equal, assert_true, assert_greater, assert_less_equal, assert_raises
+from sklearntools.gb import GradientBoostingEstimator
+from sklearntools.histogram import HistogramTreeRegressor, BinnedMatrix, bin_edges, apply_bins
+
+class DtypeRecordingTreeRegressor(HistogramTreeRegressor):
+    dtypes = []
+    binned = []
+    def fit(self, X, y, sample_weight=None):
+        DtypeRecordingTreeRegressor.dtypes.append(np.asarray(X).dtype)
+        DtypeRecordingTreeRegressor.binned.append(isinstance(X, BinnedMatrix))
+        return super(DtypeRecordingTreeRegressor, self).fit(X, y, sample_weight=sample_weight)
+
+def test_bin_edges():
+    np.random.seed(0)
+    X = np.random.normal(size=(2000, 2))
+    X[:, 1] = np.random.randint(0, 4, size=2000)
+    edges = bin_edges(X, max_bins=32)
+    assert_less_equal(len(edges[0]), 31)
+    assert_array_almost_equal(edges[1], [.5, 1.5, 2.5])
+    binned = apply_bins(X, edges)
+    assert_equal(binned.dtype, np.uint8)
+    assert_true(isinstance(binned, BinnedMatrix))
+    assert_array_equal(binned[:, 1], X[:, 1])
+    
+    # A row is at or below a bin's upper edge exactly when its bin is at or below that bin
+    for b in range(len(edges[0])):
+        assert_array_equal(binned[:, 0] <= b, X[:, 0] <= edges[0][b])
+    
+def test_histogram_tree_regressor():
+    np.random.seed(0)
+    X = np.random.normal(size=(3000, 4))
+    y = 2 * np.sin(X[:, 0]) + (X[:, 1] > 0) + .1 * np.random.normal(size=3000)
+    weights = np.random.uniform(size=3000)
+    tree = HistogramTreeRegressor(max_depth=5).fit(X, y, sample_weight=weights)
+    prediction = tree.predict(X)
+    assert_greater(np.corrcoef(prediction, y)[0, 1], .95)
+    assert_array_almost_equal(tree.fit_predict(X, y, sample_weight=weights), prediction)
+    
+    # Fitting on binned data with the same edges gives the same tree, and binned and 
+    # unbinned data give the same predictions
+    edges = bin_edges(X)
+    binned = apply_bins(X, edges)
+    binned_tree = HistogramTreeRegressor(max_depth=5, bin_edges=edges).fit(binned, y, sample_weight=weights)
+    assert_array_almost_equal(binned_tree.predict(X), prediction)
+    assert_array_almost_equal(binned_tree.predict(binned), prediction)
+    
+    # Raw uint8 data is binned like any other data, even with bin_edges set
+    pixels = np.random.randint(0, 256, size=(3000, 4)).astype(np.uint8)
+    pixel_y = pixels[:, 0] / 255. + .1 * np.random.normal(size=3000)
+    pixel_edges = bin_edges(pixels, max_bins=16)
+    pixel_tree = HistogramTreeRegressor(max_depth=4, bin_edges=pixel_edges).fit(pixels, pixel_y)
+    assert_array_almost_equal(pixel_tree.predict(pixels), 
+                              pixel_tree.predict(apply_bins(pixels, pixel_edges)))
+    assert_array_almost_equal(pixel_tree.predict(pixels), 
+                              HistogramTreeRegressor(max_depth=4, max_bins=16).fit(pixels, pixel_y).predict(pixels))
+    assert_raises(ValueError, HistogramTreeRegressor().fit, binned, y)
+    
+    # Each leaf's value is the weighted mean of its rows
+    leaves = tree.apply(X)
+    for leaf in np.unique(leaves):
+        rows = leaves == leaf
+        assert_array_almost_equal(tree.value_[leaf], np.dot(weights[rows], y[rows]) / np.sum(weights[rows]))
+
+def test_gradient_boosting_with_max_bins():
+    np.random.seed(0)
+    X = np.random.normal(size=(2000, 6))
+    y = np.dot(X, np.random.normal(size=6)) + np.sin(X[:, 0]) + .1 * np.random.normal(size=2000)
+    DtypeRecordingTreeRegressor.dtypes = []
+    DtypeRecordingTreeRegressor.binned = []
+    model = GradientBoostingEstimator(DtypeRecordingTreeRegressor(max_depth=3), LeastSquaresError(1), 
+                                      n_estimators=40, max_bins=64).fit(X, y)
+    
+    # X is binned once and every base estimator is fit on the binned matrix
+    assert_equal(len(DtypeRecordingTreeRegressor.dtypes), 40)
+    assert_true(all(binned for binned in DtypeRecordingTreeRegressor.binned))
+    assert_true(all(dtype == np.uint8 for dtype in DtypeRecordingTreeRegressor.dtypes))
+    assert_equal(len(model.bin_edges_), 6)
+    assert_greater(model.score_, .9)
+    
+    # The line search used the same predictions as predict gives on unbinned data
+    assert_array_almost_equal(model.losses_[-1], LeastSquaresError(1)(y, np.ravel(model.estimator_.predict(X))))
+    
+    # Column subsampling passes each tree the edges of its own columns
+    model = GradientBoostingEstimator(HistogramTreeRegressor(max_depth=3), LeastSquaresError(1), 
+                                      n_estimators=40, max_bins=64, max_features=.5, subsample=.5, 
+                                      random_state=0).fit(X, y)
+    assert_greater(model.score(X, y), .8)
+    
+    assert_raises(ValueError, GradientBoostingEstimator(LinearRegression(), LeastSquaresError(1), 
+                                                        max_bins=64).fit, X, y)
+
+if __name__ == '__main__':
+    import sys
+    import nose
+    # This code will run the test in this file.'
+    module_name = sys.modules[__name__].__file__
+
+    result = nose.run(argv=[sys.argv[0],
+                            module_name,
+                            '-s', '-v'])
@@ -1,9 +1,16 @@
-from sklearntools.kfold import ThresholdHybridCV
+from sklearntools.kfold import ThresholdHybridCV, CrossValidatingEstimator, ContiguousKFold
 import numpy as np
 from six.moves import reduce
 from operator import __add__
-from numpy.testing.utils import assert_array_equal
-from nose.tools import assert_equal
+from numpy.testing.utils import assert_array_equal, assert_array_almost_equal
+from nose.tools import assert_equal, assert_true, assert_raises
+from sklearn.linear_model.base import LinearRegression
+from sklearn.model_selection._split import KFold
+from sklearntools.glm import GaussianRegressor, downdate_fits_gaussian_regressor
+from statsmodels.genmod.families.links import log
+from sklearntools.sklearntools import _subset
+from sklearn.base import clone
+import pandas
 
 
 def test_hybrid_cv():
@@ -14,6 +21,141 @@ def test_hybrid_cv():
     assert_array_equal(reduce(__add__, folds), np.ones(100, dtype=int))
     assert_equal(len(folds), cv.get_n_splits(X, y))
 
+def test_hybrid_cv_split_indices():
+    np.random.seed(0)
+    X = np.random.normal(size=(100,10))
+    y = np.random.normal(size=100)
+    cv = ThresholdHybridCV(n_folds=5, upper=1., random_state=0)
+    n_loo = np.sum(y > 1.)
+    splits = list(cv.split(X, y))
+    assert_equal(len(splits), n_loo + 5)
+    for train, test in splits[:n_loo]:
+        assert_equal(len(test), 1)
+        assert_equal(len(train), 99)
+    assert_array_equal(np.sort(np.concatenate([test for _, test in splits])), np.arange(100))
+    assert_equal(len(list(cv.split_kfold(X, y))), 5)
+
+def test_cross_validating_estimator_analytic_loo():
+    np.random.seed(0)
+    X = np.random.normal(size=(100,10))
+    y = np.dot(X, np.random.normal(size=10)) + np.random.normal(size=100)
+    cv = ThresholdHybridCV(n_folds=5, upper=1., random_state=0)
+    model = CrossValidatingEstimator(LinearRegression(), cv=cv).fit(X, y)
+    analytic_model = CrossValidatingEstimator(LinearRegression(), cv=cv, analytic_loo=True).fit(X, y)
+    assert_array_almost_equal(model.cv_predictions_, analytic_model.cv_predictions_)
+    assert_array_equal(analytic_model.cv_loo_indices_, np.where(y > 1.)[0])
+    assert_equal(len(analytic_model.cv_estimators_), 5)
+
+def test_contiguous_kfold():
+    np.random.seed(0)
+    X = np.random.normal(size=(103,10))
+    cv = ContiguousKFold(4, random_state=0)
+    splits = list(cv.split(X))
+    assert_equal(len(splits), 4)
+    for train, test in splits:
+        assert_array_equal(np.sort(np.concatenate([train, test])), np.arange(103))
+    assert_array_equal(np.sort(np.concatenate([test for _, test in splits])), np.arange(103))
+    
+    # Slices of the layout are views of the permuted data
+    layout = X[cv.layout(103)]
+    for train, test in cv.split_slices(103):
+        assert_true(np.may_share_memory(_subset(layout, train), layout))
+        assert_true(np.may_share_memory(_subset(layout, test), layout))
+    df = _subset(pandas.DataFrame(layout), slice(10, 20))
+    assert_array_equal(df.index, np.arange(10))
+
+def test_cross_validating_estimator_contiguous_kfold():
+    np.random.seed(0)
+    X = np.random.normal(size=(103,10))
+    y = np.dot(X, np.random.normal(size=10)) + np.random.normal(size=103)
+    model = CrossValidatingEstimator(LinearRegression(), cv=KFold(5), downdate=False).fit(X, y)
+    contiguous_model = CrossValidatingEstimator(LinearRegression(), cv=ContiguousKFold(5, shuffle=False), 
+                                                downdate=False).fit(X, y)
+    assert_array_almost_equal(model.cv_predictions_, contiguous_model.cv_predictions_)
+    for indices, contiguous_indices in zip(model.cv_indices_, contiguous_model.cv_indices_):
+        assert_array_equal(indices, contiguous_indices)
+
+def test_cross_validating_estimator_share_data():
+    np.random.seed(0)
+    X = np.random.normal(size=(100,10))
+    y = np.dot(X, np.random.normal(size=10)) + np.random.normal(size=100)
+    model = CrossValidatingEstimator(LinearRegression(), cv=KFold(5), downdate=False, 
+                                     n_jobs=2).fit(X, y)
+    shared_model = CrossValidatingEstimator(LinearRegression(), cv=KFold(5), share_data=True, 
+                                            downdate=False, n_jobs=2).fit(X, y)
+    assert_array_almost_equal(model.cv_predictions_, shared_model.cv_predictions_)
+    assert_equal(len(shared_model.cv_data_nbytes_), 5)
+    assert_true(all(nbytes == 0 for nbytes in shared_model.cv_data_nbytes_))
+    assert_true(all(nbytes > 0 for nbytes in model.cv_data_nbytes_))
+    assert_true(shared_model.share_time_ >= 0)
+    assert_true(all(latency >= 0 for latency in shared_model.cv_dispatch_latencies_))
+    assert_true(all(info['peak_rss_increase'] is None or info['peak_rss_increase'] >= 0 
+                    for info in shared_model.cv_fold_info_))
+
+def test_cross_validating_estimator_fold_info():
+    np.random.seed(0)
+    X = np.random.normal(size=(100,10))
+    y = np.dot(X, np.random.normal(size=10)) + np.random.normal(size=100)
+    model = CrossValidatingEstimator(LinearRegression(), cv=KFold(4)).fit(X, y)
+    assert_equal(len(model.fit_times_), 4)
+    assert_equal(len(model.predict_times_), 4)
+    assert_true(all(t >= 0 for t in model.fit_times_))
+    assert_equal([info['n_test'] for info in model.cv_fold_info_], [25] * 4)
+    assert_equal([info['n_train'] for info in model.cv_fold_info_], [75] * 4)
+
+def test_cross_validating_estimator_downdate():
+    np.random.seed(0)
+    X = np.random.normal(size=(100,10))
+    y = np.dot(X, np.random.normal(size=10)) + np.random.normal(size=100)
+    sample_weight = np.random.uniform(.5, 2., size=100)
+    for fit_intercept in [True, False]:
+        estimator = LinearRegression(fit_intercept=fit_intercept)
+        model = CrossValidatingEstimator(estimator, cv=KFold(5), downdate=False)
+        model.fit(X, y, sample_weight=sample_weight)
+        downdated_model = CrossValidatingEstimator(estimator, cv=KFold(5))
+        downdated_model.fit(X, y, sample_weight=sample_weight)
+        assert_array_almost_equal(model.cv_predictions_, downdated_model.cv_predictions_)
+        for est, downdated_est in zip(model.cv_estimators_, downdated_model.cv_estimators_):
+            assert_array_almost_equal(est.coef_, downdated_est.coef_)
+            assert_array_almost_equal(est.intercept_, downdated_est.intercept_)
+    
+    model = CrossValidatingEstimator(GaussianRegressor(), cv=KFold(5), downdate=False).fit(X, y)
+    downdated_model = CrossValidatingEstimator(GaussianRegressor(), cv=KFold(5), downdate=True).fit(X, y)
+    assert_array_almost_equal(np.ravel(model.cv_predictions_), np.ravel(downdated_model.cv_predictions_))
+    
+    # Offsets are taken out of y, and links other than the identity fall back to refitting
+    holdouts = [test for _, test in KFold(5).split(X)]
+    offset = np.random.normal(size=100)
+    positive_y = np.exp(.2 * X[:, 0]) + .01 * np.random.normal(size=100)
+    for estimator, target, kwargs in [(GaussianRegressor(), y, {'offset': offset}), 
+                                      (LogGaussianRegressor(), positive_y, {})]:
+        fold_estimators = downdate_fits_gaussian_regressor(estimator, X, target, holdouts, **kwargs)
+        for holdout, fold_estimator in zip(holdouts, fold_estimators):
+            train = np.setdiff1d(np.arange(100), holdout)
+            refit = clone(estimator).fit(X[train], target[train], 
+                                         **{k: v[train] for k, v in kwargs.items()})
+            assert_array_almost_equal(fold_estimator.coef_, refit.coef_)
+
+class LogGaussianRegressor(GaussianRegressor):
+    args = (log,)
+
+def test_cross_validating_estimator_final_model():
+    np.random.seed(0)
+    X = np.random.normal(size=(100,10))
+    y = np.dot(X, np.random.normal(size=10)) + np.random.normal(size=100)
+    model = CrossValidatingEstimator(LinearRegression(), cv=KFold(5)).fit(X, y)
+    parallel_model = CrossValidatingEstimator(LinearRegression(), cv=KFold(5), 
+                                              final_model='refit_in_parallel').fit(X, y)
+    assert_array_almost_equal(model.predict(X), parallel_model.predict(X))
+    assert_array_almost_equal(model.cv_predictions_, parallel_model.cv_predictions_)
+    assert_equal(len(parallel_model.cv_estimators_), 5)
+    
+    ensemble_model = CrossValidatingEstimator(LinearRegression(), cv=KFold(5), 
+                                              final_model='fold_ensemble').fit(X, y)
+    expected = np.mean([est.predict(X) for est in ensemble_model.cv_estimators_], axis=0)
+    assert_array_almost_equal(np.ravel(ensemble_model.predict(X)), np.ravel(expected))
+    assert_raises(ValueError, CrossValidatingEstimator(LinearRegression(), final_model='bogus').fit, X, y)
+
 if __name__ == '__main__':
     import sys
     import nose
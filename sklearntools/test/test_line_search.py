@@ -1,5 +1,6 @@
-from sklearntools.line_search import golden_section_search, zoom, zoom_search
-from nose.tools import assert_almost_equal
+from sklearntools.line_search import golden_section_search, zoom, zoom_search,\
+    batched_grid_search, batched_zoom, batched_zoom_search
+from nose.tools import assert_almost_equal, assert_equal, assert_less, assert_less_equal
 import numpy as np
 
 def test_golden_section_search():
@@ -29,6 +30,54 @@ def test_zoom():
     alpha = zoom_search(golden_section_search(1e-12), zoom(1., 10, 2.), f, 0., 1.)
     assert_almost_equal(alpha, 2.**10)
 
+def test_batched_grid_search():
+    f = lambda x: (x-2) ** 2
+    alpha, _ = batched_grid_search(8, 1e-12, 0, 10, f, 0., 1.)
+    assert_almost_equal(alpha, 2.)
+    
+    alpha, _ = batched_grid_search(8, 1e-12, 0, 10, f, -1., 2.)
+    assert_almost_equal(alpha, 3./2.)
+    
+    # Each call to f gets a whole grid of steps, so there are far fewer calls than with 
+    # golden section search
+    calls = []
+    def counted(x):
+        calls.append(x.shape[-1])
+        return f(x)
+    alpha, n_evaluations = batched_grid_search(8, 1e-12, 0, 10, counted, 0., 1.)
+    assert_equal(n_evaluations, sum(calls))
+    assert_less(len(calls), 25)
+    
+    # The budget is respected
+    del calls[:]
+    alpha, n_evaluations = batched_grid_search(8, 1e-12, 0, 10, counted, 0., 1., max_evaluations=20)
+    assert_equal(n_evaluations, 20)
+    assert_equal(sum(calls), 20)
+    assert_less(abs(alpha - 2.), .5)
+    
+    # A tolerance finer than floating point spacing near the minimum still terminates
+    f = lambda x: (x - 700000.3) ** 2
+    alpha, _ = batched_grid_search(8, 1e-12, 0., 2. ** 20, f, 0., 1.)
+    assert_less(abs(alpha - 700000.3), 1e-6)
+
+def test_batched_zoom_search():
+    np.random.seed(0)
+    n = 1000
+    direction = np.random.normal(size=n)
+    target = 3. * direction + np.random.normal(size=n)
+    f = lambda predictions: np.sum((predictions - target[:, None]) ** 2, axis=0)
+    search = batched_grid_search(8, 1e-10)
+    alpha, _ = batched_zoom_search(search, batched_zoom(1., 20, 2.), f, np.zeros(n), direction)
+    assert_almost_equal(alpha, np.dot(target, direction) / np.dot(direction, direction))
+    
+    alpha, n_evaluations = batched_zoom_search(search, batched_zoom(1., 20, 2.), f, np.zeros(n), 
+                                               direction, max_evaluations=40)
+    assert_less_equal(n_evaluations, 40)
+    
+    f = lambda x: -x
+    alpha, _ = batched_zoom_search(search, batched_zoom(1., 10, 2.), f, 0., 1.)
+    assert_almost_equal(alpha, 2.**10)
+
 
 if __name__ == '__main__':
     import sys
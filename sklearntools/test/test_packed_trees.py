@@ -0,0 +1,53 @@
+import numpy as np
+from sklearn.tree import DecisionTreeRegressor
+from sklearn.ensemble.gradient_boosting import LeastSquaresError
+from numpy.testing.utils import assert_array_almost_equal
+from nose.tools import assert_equal, assert_true
+from sklearntools.gb import GradientBoostingEstimator
+from sklearntools.packed_trees import pack_trees
+from sklearntools.sklearntools import LinearCombination
+from sklearn.linear_model.base import LinearRegression
+
+def test_pack_trees():
+    np.random.seed(0)
+    X = np.random.normal(size=(1000, 6))
+    y = np.dot(X, np.random.normal(size=6)) + np.sin(X[:, 0]) + np.random.normal(size=1000)
+    model = GradientBoostingEstimator(DecisionTreeRegressor(max_depth=4, random_state=0), 
+                                      LeastSquaresError(1), n_estimators=50, max_features=.5, 
+                                      random_state=0).fit(X, y)
+    packed = pack_trees(model.estimator_)
+    
+    # Only the initial estimator isn't a tree
+    assert_equal(packed.roots.shape[0], 50)
+    assert_equal(len(packed.remainder.estimators), 1)
+    assert_true(packed.feature.flags['C_CONTIGUOUS'])
+    assert_array_almost_equal(packed.predict(X), np.ravel(model.estimator_.predict(X)))
+    
+    # Small chunks give the same answer
+    packed.chunk_size = 7
+    assert_array_almost_equal(packed.predict(X), np.ravel(model.estimator_.predict(X)))
+    
+    # Without column subsampling the base estimators are bare trees
+    plain = GradientBoostingEstimator(DecisionTreeRegressor(max_depth=4, random_state=0), 
+                                      LeastSquaresError(1), n_estimators=50).fit(X, y)
+    packed = pack_trees(plain.estimator_)
+    assert_equal(packed.roots.shape[0], 50)
+    assert_equal(len(packed.remainder.estimators), 1)
+    assert_array_almost_equal(packed.predict(X), np.ravel(plain.estimator_.predict(X)))
+    
+    # Anything else is evaluated as usual
+    linear = LinearRegression().fit(X, y)
+    combination = LinearCombination([linear, model.estimators_[1]], [2., 3.])
+    packed = pack_trees(combination)
+    assert_equal(packed.roots.shape[0], 1)
+    assert_array_almost_equal(packed.predict(X), np.ravel(combination.predict(X)))
+
+if __name__ == '__main__':
+    import sys
+    import nose
+    # This code will run the test in this file.'
+    module_name = sys.modules[__name__].__file__
+
+    result = nose.run(argv=[sys.argv[0],
+                            module_name,
+                            '-s', '-v'])
@@ -5,8 +5,10 @@ Created on Feb 23, 2016
 '''
 import numpy as np
 from sklearntools.sklearntools import StagedEstimator, MaskedEstimator,\
-    ColumnSubsetTransformer, NonNullSubsetFitter, safe_assign_column
+    ColumnSubsetTransformer, NonNullSubsetFitter, safe_assign_column,\
+    STSimpleEstimator
 from sklearn.linear_model.base import LinearRegression
+from sklearn.linear_model.ridge import Ridge
 from sklearn.linear_model.logistic import LogisticRegression
 from sklearntools.calibration import CalibratedEstimatorCV, ResponseTransformingEstimator,\
     LogTransformer, PredictorTransformer, HazardToRiskEstimator,\
@@ -20,7 +22,7 @@ from sklearntools.glm import GLM
 import statsmodels.api as sm
 import warnings
 import pandas
-from sklearntools.model_selection import ModelSelector
+from sklearntools.model_selection import ModelSelector, candidate_grid
 from sklearntools.scoring import log_loss_metric
 from sklearn.ensemble.forest import RandomForestRegressor
 from numpy.ma.testutils import assert_array_almost_equal
@@ -394,6 +396,114 @@ def test_model_selector():
     model.fit(X, rate, exposure=exposure)
     np.testing.assert_array_equal(model.best_estimator_.estimator_.intermediate_stages_[0].x_cols, best_subset)
 
+def test_model_selector_parallel():
+    np.random.seed(1)
+    X = np.random.normal(size=(500, 5))
+    y = np.dot(X, [1., 2., 0., 0., -1.]) + np.random.normal(size=500)
+    
+    # Two identical candidates tie, so the earlier one must always win
+    candidates = [('bad', ColumnSubsetTransformer(x_cols=[2, 3]) >> LinearRegression()),
+                  ('good', LinearRegression()),
+                  ('same', LinearRegression())]
+    for backend in ['threading', 'multiprocessing']:
+        model = ModelSelector(candidates, n_jobs=2, backend=backend)
+        model.fit(X, y)
+        assert model.best_candidate_name == 'good'
+        assert model.best_candidate_index_ == 1
+        assert len(model.candidate_scores_) == 3
+        assert len(model.candidate_fit_times_) == 3
+        serial = ModelSelector(candidates)
+        serial.fit(X, y)
+        np.testing.assert_array_almost_equal(model.predict(X), serial.predict(X))
+
+def test_staged_estimator_score():
+    np.random.seed(1)
+    X = np.random.normal(size=(1000, 5))
+    y = np.dot(X, [1., 2., 3., 4., 5.]) + np.random.normal(size=1000)
+    
+    # Staged estimators are scored on y and sample_weight like any other estimator
+    sample_weight = np.random.uniform(size=1000)
+    staged = (ColumnSubsetTransformer(x_cols=[0, 1]) >> LinearRegression()).fit(X, y, sample_weight=sample_weight)
+    plain = LinearRegression().fit(X[:, [0, 1]], y, sample_weight=sample_weight)
+    np.testing.assert_almost_equal(staged.score(X, y, sample_weight=sample_weight), 
+                                   plain.score(X[:, [0, 1]], y, sample_weight=sample_weight))
+
+def test_model_selector_racing():
+    np.random.seed(1)
+    X = np.random.normal(size=(1000, 5))
+    y = np.dot(X, [1., 2., 3., 4., 5.]) + np.random.normal(size=1000)
+    candidates = [('cols_%d' % i, ColumnSubsetTransformer(x_cols=list(range(i))) >> LinearRegression()) 
+                  for i in range(1, 6)]
+    candidates += [('drop_%d' % i, ColumnSubsetTransformer(x_cols=[j for j in range(5) if j != i]) >> LinearRegression()) 
+                   for i in range(4)]
+    model = ModelSelector(candidates, racing=True, min_samples=50, eta=3, random_state=0)
+    model.fit(X, y)
+    assert model.best_candidate_name == 'cols_5'
+    assert_list_equal([r['n_samples'] for r in model.race_history_], [50, 150])
+    assert_list_equal([len(r['candidates']) for r in model.race_history_], [9, 3])
+    assert_list_equal([len(r['eliminated']) for r in model.race_history_], [6, 2])
+    assert model.race_sample_fits_ == 9 * 50 + 3 * 150 + 1000
+    np.testing.assert_almost_equal(model.compute_saved_, 1. - 1900. / 9000.)
+    assert sum(score is not None for score in model.candidate_scores_) == 1
+    
+    # Racing works the same way for candidates that aren't staged
+    candidates = [('ridge_%g' % alpha, Ridge(alpha=alpha)) for alpha in [1e4, 1e3, 1., 1e2]]
+    model = ModelSelector(candidates, racing=True, min_samples=50, eta=3, random_state=0)
+    model.fit(X, y)
+    assert model.best_candidate_name == 'ridge_1'
+    assert_list_equal([len(r['candidates']) for r in model.race_history_], [4, 2])
+    assert model.race_sample_fits_ == 4 * 50 + 2 * 150 + 1000
+
+class CountingTransformer(STSimpleEstimator):
+    fit_count = 0
+    
+    def __init__(self, scale=1.):
+        self.scale = scale
+    
+    def fit(self, X, y=None):
+        CountingTransformer.fit_count += 1
+        return self
+    
+    def transform(self, X):
+        return self.scale * np.asarray(X)
+
+def test_candidate_grid():
+    np.random.seed(1)
+    X = np.random.normal(size=(200, 3))
+    y = np.dot(X, [1., 2., 3.]) + np.random.normal(size=200)
+    estimator = CountingTransformer() >> LinearRegression() 
+    candidates = candidate_grid(estimator, {'0__scale': [1., 2.], '1__fit_intercept': [True, False]})
+    assert len(candidates) == 4
+    assert_raises(ValueError, candidate_grid, estimator, {'2__scale': [1.]})
+    assert_raises(ValueError, candidate_grid, estimator, {'scale': [1.]})
+    
+    # Each distinct leading stage is fit once, no matter how many candidates share it
+    CountingTransformer.fit_count = 0
+    model = ModelSelector(candidates)
+    model.fit(X, y)
+    assert CountingTransformer.fit_count == 2
+    assert 'fit_intercept=True' in model.best_candidate_name
+    
+    # The shared cache is emptied once the fit is done
+    assert len(candidates[0][1].prefix_cache.entries) == 0
+    
+    # A cache that only holds one entry evicts the other scale, so it's fit again
+    CountingTransformer.fit_count = 0
+    candidates = candidate_grid(estimator, {'0__scale': [1., 2.], '1__fit_intercept': [True, False]})
+    prefix_cache = candidates[0][1].prefix_cache
+    prefix_cache.max_entries = 1
+    ModelSelector(candidates).fit(X, y)
+    assert CountingTransformer.fit_count == 2
+    for _, candidate in candidates:
+        candidate.fit(X, y)
+        assert len(prefix_cache.entries) == 1
+    
+    # Without sharing every candidate fits its own
+    CountingTransformer.fit_count = 0
+    ModelSelector(candidate_grid(estimator, {'0__scale': [1., 2.], '1__fit_intercept': [True, False]}, 
+                                 share_prefixes=False)).fit(X, y)
+    assert CountingTransformer.fit_count == 4
+
 def test_cross_validating_estimator():
     np.random.seed(1)
     
@@ -4,7 +4,10 @@ from sklearn.linear_model.base import LinearRegression
 from pyearth import Earth
 from sklearn.ensemble.forest import RandomForestRegressor
 from sklearn.metrics.regression import r2_score
-from sklearntools.kfold import CrossValidatingEstimator
+from sklearntools.kfold import CrossValidatingEstimator, PredefinedFolds
+from sklearn.model_selection import KFold
+from sklearn.dummy import DummyRegressor
+from sklearn.linear_model import Lasso
 import numpy as np
 from sklearn2code.sklearn2code import sklearn2code
 from sklearn2code.languages import numpy_flat
@@ -12,6 +15,7 @@ from sklearn2code.utility import exec_module
 import pandas
 from numpy.ma.testutils import assert_array_almost_equal
 from toolz.itertoolz import first
+from sklearn.base import clone
 
 def test_super_learner():
     np.random.seed(0)
@@ -40,6 +44,101 @@ def test_super_learner():
     
     print(max([r2_score(y, first(model.estimator_.cross_validating_estimators_.values()).cv_predictions_) for i in range(2)]))
 
+def test_super_learner_shared_folds():
+    np.random.seed(0)
+    X = np.random.normal(size=(200, 3))
+    y = np.dot(X, [1., -2., .5]) + .1 * np.random.normal(size=200)
+    model = SuperLearner([('linear', LinearRegression()), 
+                          ('forest', RandomForestRegressor(n_estimators=5, random_state=0))],
+                         LinearRegression(), cv=KFold(3, shuffle=True), n_jobs=2).fit(X, y)
+    
+    # Every base learner was fit on the same shuffled folds
+    assert len(model.folds_) == 3
+    for est in model.cross_validating_estimators_.values():
+        assert len(est.cv_estimators_) == 3
+        for (_, test), indices in zip(model.folds_, est.cv_indices_):
+            np.testing.assert_array_equal(test, indices)
+    
+    # The pooled fits give the same results as fitting each learner on its own.  The 
+    # SuperLearner passes y to its inner estimators as a column, so compare flattened.
+    linear = CrossValidatingEstimator(LinearRegression(), cv=PredefinedFolds(model.folds_)).fit(X, y)
+    np.testing.assert_array_almost_equal(np.ravel(model.cross_validating_estimators_['linear'].cv_predictions_),
+                                         np.ravel(linear.cv_predictions_))
+    np.testing.assert_array_almost_equal(np.ravel(model.cross_validating_estimators_['linear'].predict(X)),
+                                         np.ravel(linear.predict(X)))
+    assert model.predict(X).shape[0] == 200
+
+def test_super_learner_add_remove_regressor():
+    np.random.seed(0)
+    X = np.random.normal(size=(200, 3))
+    y = np.dot(X, [1., -2., .5]) + X[:, 0] ** 2 + .1 * np.random.normal(size=200)
+    model = SuperLearner([('linear', LinearRegression())], LinearRegression(), 
+                         cv=KFold(3, shuffle=True)).fit(X, y)
+    linear = model.cross_validating_estimators_['linear']
+    
+    # Adding a learner leaves the existing ones alone and uses the same folds
+    model.add_regressor('forest', RandomForestRegressor(n_estimators=5, random_state=0), X, y)
+    assert list(model.cross_validating_estimators_.keys()) == ['linear', 'forest']
+    assert model.cross_validating_estimators_['linear'] is linear
+    for (_, test), indices in zip(model.folds_, model.cross_validating_estimators_['forest'].cv_indices_):
+        np.testing.assert_array_equal(test, indices)
+    assert model.meta_regressor_.coef_.shape[-1] == 2
+    
+    # The constructor parameters are left alone, so clones are what the user created
+    assert list(model.regressors_.keys()) == ['linear', 'forest']
+    assert len(model.regressors) == 1
+    assert len(clone(model).regressors) == 1
+    
+    # The result matches fitting from scratch on the same folds
+    full = SuperLearner(list(model.regressors_.items()), LinearRegression(), 
+                        cv=PredefinedFolds(model.folds_)).fit(X, y)
+    np.testing.assert_array_almost_equal(full.predict(X), model.predict(X))
+    
+    # Removing a learner refits only the meta-regressor
+    model.remove_regressor('forest', X, y)
+    assert list(model.cross_validating_estimators_.keys()) == ['linear']
+    assert list(model.regressors_.keys()) == ['linear']
+    assert model.cross_validating_estimators_['linear'] is linear
+    assert model.meta_regressor_.coef_.shape[-1] == 1
+
+def test_super_learner_prune():
+    np.random.seed(0)
+    X = np.random.normal(size=(200, 3))
+    y = np.dot(X, [1., -2., .5]) + .1 * np.random.normal(size=200)
+    
+    # The dummy regressor's constant predictions get zero weight from the lasso
+    model = SuperLearner([('linear', LinearRegression()), ('dummy', DummyRegressor()), 
+                          ('forest', RandomForestRegressor(n_estimators=5, random_state=0))], 
+                         Lasso(alpha=.01), cv=3, n_jobs=2, prune=True).fit(X, y)
+    assert 'dummy' not in model.active_regressors_
+    assert 'linear' in model.active_regressors_
+    assert model.transform(X).shape == (200, 3)
+    np.testing.assert_array_almost_equal(model.predict(X), 
+                                         model.meta_regressor_.predict(model.transform(X)))
+    model.prune = False
+    np.testing.assert_array_almost_equal(model.predict(X), 
+                                         model.meta_regressor_.predict(model.transform(X)))
+    
+    # Coefficients that don't line up with the base learners' columns never prune anything
+    model = SuperLearner([('linear', LinearRegression()), ('dummy', DummyRegressor()), 
+                          ('forest', RandomForestRegressor(n_estimators=5, random_state=0))], 
+                         InterceptFirstRegression(), cv=3, prune=True).fit(X, y)
+    assert model.active_regressors_ == ['linear', 'dummy', 'forest']
+    np.testing.assert_array_almost_equal(model.predict(X), 
+                                         model.meta_regressor_.predict(model.transform(X)))
+
+class InterceptFirstRegression(LinearRegression):
+    '''
+    A linear regression whose coef_ starts with the intercept, as in some GLM implementations.
+    '''
+    def fit(self, X, y, sample_weight=None):
+        super(InterceptFirstRegression, self).fit(X, y, sample_weight=sample_weight)
+        self.coef_ = np.concatenate([np.atleast_1d(self.intercept_), np.ravel(self.coef_)])
+        return self
+    
+    def predict(self, X):
+        return self.coef_[0] + np.dot(X, self.coef_[1:])
+
 
 if __name__ == '__main__':
     import sys